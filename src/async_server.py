@@ -0,0 +1,233 @@
+''' async_server.py
+'   asyncio implementation of the server in server.py, selected with
+'   `python server.py --engine asyncio` so the two engines can be
+'   benchmarked against the same workload.
+'   Reuses the packet classes and FrameDecoder from conf.py and Room from
+'   server.py. Each connection is one task; keepalives run on loop timers
+'   and each connection's StreamWriter provides flow control.
+'''
+
+import asyncio
+
+from conf import *
+from server import Room, fanout_log
+from irclog import get_logger
+
+log = get_logger('async_server')
+
+
+class AsyncUser:
+    ''' represents a connected user with a username, its wire label,
+    '   the stream writer for its connection and the rooms it joined
+    '''
+
+    def __init__(self, username, writer):
+        self.username = username = wire_label(username)
+        self.label = username.wire
+        self.writer = writer
+        self.rooms = set()  # Rooms this user has joined
+
+
+class AsyncServer:
+    ''' represents the server with users and rooms, driven by asyncio
+    '   high_watermark, low_watermark: write buffer limits of every
+    '   connection; a connection over its high watermark is not read from
+    '   until it drains below the low watermark
+    '   queue_cap: buffered bytes past which slow_consumer_policy applies,
+    '   SLOW_CONSUMER_DROP or SLOW_CONSUMER_DISCONNECT
+    '''
+
+    def __init__(self, high_watermark=OUTBOUND_HIGH_WATERMARK,
+                 low_watermark=OUTBOUND_LOW_WATERMARK, queue_cap=OUTBOUND_QUEUE_CAP,
+                 slow_consumer_policy=SLOW_CONSUMER_DISCONNECT):
+        self.users = {}  # username -> AsyncUser
+        self.rooms = {}  # room name -> Room
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.queue_cap = queue_cap
+        self.slow_consumer_policy = slow_consumer_policy
+        self.loop = None
+
+    def queue_packet(self, user, packet_bytes):
+        ''' hands a packet to the user's transport without waiting
+        '   returns False if the packet was dropped or the user disconnected
+        '''
+        transport = user.writer.transport
+        if transport.is_closing():
+            return False
+        if transport.get_write_buffer_size() + len(packet_bytes) > self.queue_cap:
+            if self.slow_consumer_policy == SLOW_CONSUMER_DROP:
+                fanout_log.warning('dropped %d byte packet for slow consumer %s',
+                                   len(packet_bytes), user.username)
+            else:
+                log.warning('disconnecting slow consumer %s', user.username)
+                self.close_user(user, IRC_ERR_UNKNOWN)
+            return False
+        user.writer.write(packet_bytes)
+        return True
+
+    def close_user(self, user, err_code=None):
+        ''' sends an error packet if err_code is given, then closes the
+        '   connection and removes the user from the server and its rooms
+        '''
+        if not user.writer.transport.is_closing():
+            if err_code is not None:
+                log.warning('closing %s due to error %#x', user.username, err_code)
+                user.writer.write(IrcPacketErr(err_code).to_bytes())
+            user.writer.close()
+        self.forget_user(user)
+
+    def forget_user(self, user):
+        if self.users.get(user.username) is user:
+            del self.users[user.username]
+        for room in list(user.rooms):
+            room.remove(user)
+
+    def send_user_list(self, user, room_name):
+        ''' sends a list of users in a room to a user, empty if no such room '''
+        room = self.rooms.get(room_name)
+        payload = room.usernames() if room is not None else []
+        identifier = room.name if room is not None else room_name
+        packet = IrcPacketListUsersResp(payload=payload, identifier=identifier)
+        self.queue_packet(user, packet.to_bytes())
+
+    def add_user_to_room(self, user, room_name):
+        room = self.rooms.get(room_name)
+        if room is None:
+            room_name = wire_label(room_name)
+            room = self.rooms[room_name] = Room(room_name)
+        if not room.add(user):
+            self.send_user_list(user, room_name)
+            return
+        for other_user in list(room.members):
+            self.send_user_list(other_user, room_name)
+
+    def send_msg(self, user, payload, room_label):
+        ''' relays a validated SENDMSG body to every user in the room '''
+        room_name = strip_null_bytes(bytes(room_label)).decode('ascii')
+        room = self.rooms.get(room_name)
+        if room is None:  # behavior not defined in RFC!
+            log.debug('no room named "%s" exists... silently ignoring send for now', room_name)
+            return
+        tell_msg_bytes = build_tellmsg_frame(payload, user.label, room_label)
+        for member in list(room.members):
+            self.queue_packet(member, tell_msg_bytes)
+
+    def send_priv_msg(self, user, msg):
+        target_user = self.users.get(msg.target_label)
+        if target_user is None:  # behavior not defined in RFC!
+            log.debug('no user named "%s" exists... silently ignoring send for now',
+                      msg.target_label)
+            return
+        tell_msg = IrcPacketTellPrivMsg(
+            payload=msg.payload,
+            target_label=target_user.username,
+            sending_user=user.username
+        )
+        self.queue_packet(target_user, tell_msg.to_bytes())
+
+    def send_keepalives(self):
+        ''' queues a keepalive for every user and re-arms its own timer '''
+        keepalive_bytes = IrcPacketKeepalive().to_bytes()
+        for user in list(self.users.values()):
+            self.queue_packet(user, keepalive_bytes)
+        self.loop.call_later(KEEPALIVE_INTERVAL, self.send_keepalives)
+
+    def handle_packet(self, user, packet_bytes):
+        ''' reacts to one complete packet received from the given user '''
+        header_obj = IrcHeader().from_bytes(packet_bytes)
+        opcode = header_obj.opcode
+        if opcode == IRC_KEEPALIVE:
+            pass  # RFC only says we SHOULD receive them
+        elif opcode == IRC_SENDMSG:
+            payload, room_label = split_sendmsg_frame(packet_bytes)
+            self.send_msg(user, payload, room_label)
+        elif opcode == IRC_SENDPRIVMSG:
+            self.send_priv_msg(user, IrcPacketSendPrivMsg().from_bytes(packet_bytes))
+        elif opcode == IRC_ERR:
+            err_msg = IrcPacketErr().from_bytes(packet_bytes)
+            log.warning('closed on by %s due to error %#x', user.username, err_msg.payload)
+            self.close_user(user, err_msg.payload)
+        elif opcode == IRC_JOINROOM:
+            self.add_user_to_room(user, IrcPacketJoinRoom().from_bytes(packet_bytes).payload)
+        elif opcode == IRC_LEAVEROOM:
+            room = self.rooms.get(IrcPacketLeaveRoom().from_bytes(packet_bytes).payload)
+            if room is not None:
+                room.remove(user)
+        elif opcode == IRC_LISTROOMS:
+            packet = IrcPacketListRoomsResp(payload=list(self.rooms.keys()))
+            self.queue_packet(user, packet.to_bytes())
+        elif opcode == IRC_LISTUSERS:
+            self.send_user_list(user, IrcPacketListUsers().from_bytes(packet_bytes).payload)
+        else:
+            log.warning('opcode %#x from %s is not known to the server', opcode, user.username)
+
+    async def read_frame(self, reader, decoder):
+        ''' waits until the decoder holds a complete packet and returns a copy
+        '   of it, since the caller only gets to parse it after other tasks ran
+        '''
+        frame = decoder.next_frame()
+        while frame is None:
+            data = await reader.read(RECV_BUFSIZE)
+            if not data:
+                raise ConnectionResetError('peer closed the connection')
+            decoder.feed(data)
+            frame = decoder.next_frame()
+        return bytes(frame)
+
+    async def handle_connection(self, reader, writer):
+        ''' serves one client from hello until it disconnects '''
+        writer.transport.set_write_buffer_limits(high=self.high_watermark, low=self.low_watermark)
+        decoder = FrameDecoder(shared=False)  # views outlive awaits
+        user = None
+        try:
+            hello_bytes = await asyncio.wait_for(self.read_frame(reader, decoder), TIMEOUT)
+            username = IrcPacketHello().from_bytes(hello_bytes).payload
+            if username in self.users:
+                raise IRCException(IRC_ERR_NAME_EXISTS, f'name {username} taken')
+            user = AsyncUser(username, writer)
+            self.users[username] = user
+            log.info('added %s at %s to server', username, writer.get_extra_info('peername'))
+            while not writer.transport.is_closing():
+                # packets sent right behind the hello are handled first
+                for packet_bytes in decoder:
+                    self.handle_packet(user, packet_bytes)
+                    if writer.transport.is_closing():
+                        return
+                # flow control: stop reading this client while its own
+                # responses are backed up past the high watermark
+                await writer.drain()
+                data = await reader.read(RECV_BUFSIZE)
+                if not data:
+                    break
+                decoder.feed(data)
+        except IRCException as e:
+            if user is None:
+                writer.write(IrcPacketErr(e.err_code).to_bytes())
+            else:
+                self.close_user(user, e.err_code)
+        except asyncio.TimeoutError:
+            log.warning('no hello from %s', writer.get_extra_info('peername'))
+            writer.write(IrcPacketErr(IRC_ERR_UNKNOWN).to_bytes())
+        except (ValueError, OSError):
+            pass  # undecodable label or lost connection
+        finally:
+            if user is not None:
+                self.forget_user(user)
+            writer.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_connection, '', IRC_SERVER_PORT)
+        log.info('listening on port %d', IRC_SERVER_PORT)
+        self.loop.call_later(KEEPALIVE_INTERVAL, self.send_keepalives)
+        async with server:
+            await server.serve_forever()
+
+    def main(self):
+        try:
+            asyncio.run(self.serve())
+        except OSError as e:
+            log.error('cannot listen: %s', e)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,185 @@
+''' bench_codec.py
+'   microbenchmark suite for the conf.py codec: encode (construct + to_bytes)
+'   and decode (from_bytes) of every packet class from IrcHeader through
+'   IrcPacketListUsersResp, messages of 1 char up to MAX_MSG_LENGTH, list
+'   responses of 0 to 10k labels, plus validate_string, validate_label and
+'   label_to_bytes on their own
+'   each case reports ops/s (best of --repeat timing runs) and the bytes it
+'   allocates per call, as the tracemalloc peak above the memory in use
+'   before the call
+'   --save writes the results as JSON; --compare checks them against such a
+'   file and exits with status 1 if any case lost more than --threshold of
+'   its ops/s or allocates that much more
+'   usage: python bench_codec.py [--filter SUBSTRING] [--min-time 0.2]
+'          [--save baseline.json] [--compare baseline.json --threshold 0.1]
+'''
+
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from time import perf_counter, time
+
+from conf import *
+
+MESSAGE_SIZES = [1, 64, 1024, MAX_MSG_LENGTH - 1]  # chars before the null terminator
+LIST_SIZES = [0, 10, 1000, 10000]  # labels per list response
+ALLOCATION_SAMPLES = 5  # calls averaged for the allocation figure
+
+
+def make_message(size):
+    text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+    return (text * (size // len(text) + 1))[:size] + '\0'
+
+
+def make_labels(count):
+    return [f'user{i:06d}' for i in range(count)]
+
+
+def codec_cases(cls, make_packet, name=None):
+    ''' the encode and decode cases of one packet, decoding what it encodes '''
+    name = name or cls.__name__
+    frame = make_packet().to_bytes()
+    return [(f'{name}.encode', lambda: make_packet().to_bytes()),
+            (f'{name}.decode', lambda: cls().from_bytes(frame))]
+
+
+def build_cases():
+    ''' [(case name, zero-argument callable)] '''
+    cases = []
+    cases += codec_cases(IrcHeader, lambda: IrcHeader(IRC_KEEPALIVE, 0))
+    cases += codec_cases(IrcPacketErr, lambda: IrcPacketErr(IRC_ERR_NAME_EXISTS))
+    cases += codec_cases(IrcPacketHello, lambda: IrcPacketHello('xX_ChickenWing_Xx'))
+    cases += codec_cases(IrcPacketJoinRoom, lambda: IrcPacketJoinRoom('lobby'))
+    cases += codec_cases(IrcPacketLeaveRoom, lambda: IrcPacketLeaveRoom('lobby'))
+    for size in MESSAGE_SIZES:
+        message = make_message(size)
+        cases += codec_cases(IrcPacketSendMsg, lambda m=message: IrcPacketSendMsg(m, 'lobby'),
+                             f'IrcPacketSendMsg[{size}]')
+        cases += codec_cases(IrcPacketTellMsg, lambda m=message: IrcPacketTellMsg(m, 'lobby', 'alice'),
+                             f'IrcPacketTellMsg[{size}]')
+        cases += codec_cases(IrcPacketSendPrivMsg,
+                             lambda m=message: IrcPacketSendPrivMsg(m, 'bob', 'alice'),
+                             f'IrcPacketSendPrivMsg[{size}]')
+        cases += codec_cases(IrcPacketTellPrivMsg,
+                             lambda m=message: IrcPacketTellPrivMsg(m, 'bob', 'alice'),
+                             f'IrcPacketTellPrivMsg[{size}]')
+    keepalive = EMPTY_FRAMES[IRC_KEEPALIVE]
+    cases += [('IrcPacketKeepalive.encode', lambda: IrcPacketKeepalive().to_bytes()),
+              ('IrcPacketKeepalive.decode', lambda: IrcHeader().from_bytes(keepalive))]
+    listrooms = EMPTY_FRAMES[IRC_LISTROOMS]
+    cases += [('IrcPacketListRooms.encode', lambda: IrcPacketListRooms().to_bytes()),
+              ('IrcPacketListRooms.decode', lambda: IrcHeader().from_bytes(listrooms))]
+    cases += codec_cases(IrcPacketListUsers, lambda: IrcPacketListUsers('lobby'))
+    for count in LIST_SIZES:
+        labels = make_labels(count)
+        cases += codec_cases(IrcPacketListRoomsResp, lambda l=labels: IrcPacketListRoomsResp(l),
+                             f'IrcPacketListRoomsResp[{count}]')
+        cases += codec_cases(IrcPacketListUsersResp,
+                             lambda l=labels: IrcPacketListUsersResp(l, 'lobby'),
+                             f'IrcPacketListUsersResp[{count}]')
+    for size in MESSAGE_SIZES:
+        message = make_message(size)
+        cases.append((f'validate_string[{size}]', lambda m=message: validate_string(m)))
+        message_bytes = message.encode('ascii')
+        cases.append((f'validate_string[{size}](bytes)', lambda m=message_bytes: validate_string(m)))
+    label_bytes = label_to_bytes('xX_ChickenWing_Xx')
+    cases += [('validate_label', lambda: validate_label(label_bytes)),
+              ('label_to_bytes', lambda: label_to_bytes('xX_ChickenWing_Xx'))]
+    return cases
+
+
+def ops_per_second(func, min_time, repeat):
+    ''' best rate over repeat runs, each at least min_time seconds long '''
+    number = 1
+    while True:  # find a loop count that takes long enough, like timeit.autorange
+        started = perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number = number * 10 if elapsed < min_time / 10 else int(number * min_time / elapsed) + 1
+    best = number / elapsed
+    for _ in range(repeat - 1):
+        started = perf_counter()
+        for _ in range(number):
+            func()
+        best = max(best, number / (perf_counter() - started))
+    return best
+
+
+def allocated_bytes(func):
+    ''' mean tracemalloc peak per call above what was in use before it '''
+    func()  # warm caches so they don't count against the first sample
+    total = 0
+    tracemalloc.start()
+    try:
+        for _ in range(ALLOCATION_SAMPLES):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total / ALLOCATION_SAMPLES
+
+
+def compare(results, baseline, threshold):
+    ''' returns a line for every case that regressed beyond threshold '''
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result['ops_per_s'] < old['ops_per_s'] * (1 - threshold):
+            regressions.append(f'{name}: {old["ops_per_s"]:.0f} -> {result["ops_per_s"]:.0f} ops/s')
+        if result['alloc_bytes'] > old['alloc_bytes'] * (1 + threshold) + 64:
+            regressions.append(f'{name}: {old["alloc_bytes"]:.0f} -> {result["alloc_bytes"]:.0f} '
+                               + 'bytes allocated')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='594irc codec microbenchmarks')
+    parser.add_argument('--filter', default='', help='only run cases containing this text')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per case')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from --save to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction of ops/s lost (or allocations gained) that counts as a regression')
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    results = {}
+    print(f'{"case":<44} {"ops/s":>12} {"bytes/op":>10}{"  vs baseline" if baseline else ""}')
+    for name, func in build_cases():
+        if args.filter not in name:
+            continue
+        result = {'ops_per_s': ops_per_second(func, args.min_time, args.repeat),
+                  'alloc_bytes': allocated_bytes(func)}
+        results[name] = result
+        change = ''
+        if baseline and name in baseline:
+            change = f'  {result["ops_per_s"] / baseline[name]["ops_per_s"] - 1:+8.1%}'
+        print(f'{name:<44} {result["ops_per_s"]:12.0f} {result["alloc_bytes"]:10.0f}{change}')
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump({'time': time(), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'results': results}, output, indent=2)
+        print(f'wrote {args.save}')
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions beyond {args.threshold:.0%}')
+
+
+if __name__ == '__main__':
+    main()
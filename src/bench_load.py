@@ -0,0 +1,383 @@
+''' bench_load.py
+'   end-to-end load generator: starts server.py locally (unless --no-server)
+'   and drives it with many simulated clients speaking the real protocol
+'   through the conf.py packet classes
+'   clients are spread over --processes driver processes, each running one
+'   selectors loop; every SENDMSG / SENDPRIVMSG payload starts with the
+'   monotonic send time, so each TELLMSG / TELLPRIVMSG receipt gives a
+'   send-to-delivery latency (CLOCK_MONOTONIC is shared by all processes)
+'   --mix weights the operations picked for each send slot:
+'     hello        reconnect a random client under a fresh name
+'     joinroom     join a random room, leaving the oldest if over --rooms-per-client
+'     sendmsg      message one of the client's rooms
+'     sendprivmsg  message another client of the same driver
+'     listusers    ask for the members of a random room
+'   results (config, rates, latency percentiles) are printed and written as
+'   JSON to --output so runs can be compared
+'   usage: python bench_load.py [--clients 2000] [--duration 10] [--rate 5000]
+'          [--mix sendmsg=80,sendprivmsg=10,listusers=5,joinroom=4,hello=1]
+'          [--server-arg=--workers --server-arg=4] [--output bench_load.json]
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import selectors
+import socket
+import subprocess
+import sys
+from time import monotonic, monotonic_ns, sleep, time
+
+from conf import *
+
+OPERATIONS = ['hello', 'joinroom', 'sendmsg', 'sendprivmsg', 'listusers']
+DEFAULT_MIX = 'sendmsg=80,sendprivmsg=10,listusers=5,joinroom=4,hello=1'
+CONNECT_BATCH = 256  # connections opened per step, below MAX_PENDING_HANDSHAKES
+PAYLOAD_OFFSET = IrcHeader.header_length  # TELLMSG / TELLPRIVMSG bodies start here
+
+
+class LoadClient:
+    ''' one simulated user: its socket, inbound decoder and pending output '''
+
+    def __init__(self, name):
+        self.base_name = name
+        self.name = name
+        self.sock = None
+        self.decoder = FrameDecoder(max_length=None)
+        self.outbound = bytearray()
+        self.rooms = []  # joined room names, oldest first
+        self.joined_at = {}  # room label bytes -> monotonic ns the join was sent
+        self.last_sent = 0.0
+
+    def connect(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.setblocking(False)
+        self.outbound += IrcPacketHello(self.name).to_bytes()
+
+
+def parse_mix(text):
+    ''' "sendmsg=80,hello=1" -> ([operations], [weights]) '''
+    mix = {}
+    for item in text.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in OPERATIONS:
+            raise ValueError(f'unknown operation {operation!r}, expected one of {OPERATIONS}')
+        mix[operation] = float(weight)
+    return list(mix), list(mix.values())
+
+
+def make_payload(size):
+    ''' a message of size chars (null terminator included) starting with
+    '   the current monotonic time in ns
+    '''
+    stamp = f'{monotonic_ns()} '
+    return stamp + 'x' * max(0, size - 1 - len(stamp))
+
+
+class Driver:
+    ''' runs a share of the clients in one process and keeps its statistics '''
+
+    def __init__(self, config, first, count, seed):
+        self.config = config
+        self.address = ('127.0.0.1', config['port'])
+        self.random = random.Random(seed)
+        self.operations, self.weights = parse_mix(config['mix'])
+        self.sel = selectors.DefaultSelector()
+        self.clients = [LoadClient(f'load{i}') for i in range(first, first + count)]
+        self.renamed = 0
+        self.measuring = False
+        self.sent = dict.fromkeys(OPERATIONS, 0)
+        self.received = {}  # opcode name -> packets
+        self.received_bytes = 0
+        self.fanout_bytes = 0  # TELLMSG bytes, the server's fanout
+        self.latencies = {'tellmsg': [], 'tellprivmsg': []}  # ns
+        self.errors = 0
+        self.disconnects = 0
+        self.replayed = 0
+
+    def random_room(self):
+        return f'room{self.random.randrange(self.config["rooms"])}'
+
+    def send(self, client, packet_bytes):
+        client.outbound += packet_bytes
+        client.last_sent = monotonic()
+        self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.outbound)
+            del client.outbound[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop(client)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbound else 0)
+        self.sel.modify(client.sock, events, client)
+
+    def drop(self, client):
+        self.disconnects += 1
+        self.sel.unregister(client.sock)
+        client.sock.close()
+        client.sock = None
+
+    def connect_all(self):
+        ''' connects every client in batches and joins its starting rooms '''
+        for start in range(0, len(self.clients), CONNECT_BATCH):
+            for client in self.clients[start:start + CONNECT_BATCH]:
+                self.start_client(client)
+            self.poll(0.05)
+        for index, client in enumerate(self.clients):
+            for n in range(self.config['rooms_per_client']):
+                self.join(client, f'room{(index + n) % self.config["rooms"]}')
+
+    def start_client(self, client):
+        client.connect(self.address)
+        self.sel.register(client.sock, selectors.EVENT_READ, client)
+        self.flush(client)
+
+    def join(self, client, room_name):
+        if room_name in client.rooms:
+            return
+        client.rooms.append(room_name)
+        client.joined_at[label_to_bytes(room_name)] = monotonic_ns()
+        self.send(client, IrcPacketJoinRoom(room_name).to_bytes())
+        if len(client.rooms) > self.config['rooms_per_client']:
+            self.send(client, IrcPacketLeaveRoom(client.rooms.pop(0)).to_bytes())
+
+    def perform(self, operation, client):
+        if operation == 'hello':  # churn: the same seat under a new name
+            if client.sock is not None:
+                self.sel.unregister(client.sock)
+                client.sock.close()
+            self.renamed += 1
+            client.name = f'{client.base_name}r{self.renamed}'
+            client.decoder = FrameDecoder(max_length=None)
+            client.outbound.clear()
+            rooms, client.rooms = client.rooms, []
+            self.start_client(client)
+            for room_name in rooms:
+                self.join(client, room_name)
+        elif operation == 'joinroom':
+            self.join(client, self.random_room())
+        elif operation == 'sendmsg':
+            room_name = self.random.choice(client.rooms) if client.rooms else self.random_room()
+            payload = make_payload(self.config['message_size'])
+            self.send(client, IrcPacketSendMsg(payload, room_name).to_bytes())
+        elif operation == 'sendprivmsg':
+            target = self.random.choice(self.clients).name
+            payload = make_payload(self.config['message_size'])
+            self.send(client, IrcPacketSendPrivMsg(payload, target, client.name).to_bytes())
+        elif operation == 'listusers':
+            self.send(client, IrcPacketListUsers(self.random_room()).to_bytes())
+        if self.measuring:
+            self.sent[operation] += 1
+
+    def receive(self, client):
+        try:
+            if client.decoder.recv_from(client.sock) == 0:
+                raise ConnectionResetError
+        except BlockingIOError:
+            return
+        except OSError:
+            self.drop(client)
+            return
+        now = monotonic_ns()
+        for frame in client.decoder:
+            opcode = frame[0]
+            if opcode == IRC_ERR:
+                self.errors += 1
+            if not self.measuring:
+                continue
+            name = IRC_OPCODE_NAMES.get(opcode, hex(opcode))
+            self.received[name] = self.received.get(name, 0) + 1
+            self.received_bytes += len(frame)
+            if opcode == IRC_TELLMSG or opcode == IRC_TELLPRIVMSG:
+                if opcode == IRC_TELLMSG:
+                    self.fanout_bytes += len(frame)
+                stamp = bytes(frame[PAYLOAD_OFFSET:PAYLOAD_OFFSET + 20]).split(b' ', 1)[0]
+                if not stamp.isdigit():
+                    continue
+                stamp = int(stamp)
+                if opcode == IRC_TELLMSG and stamp < client.joined_at.get(bytes(frame[-LABEL_LENGTH:]), 0):
+                    self.replayed += 1  # room history sent on join, not a live delivery
+                    continue
+                self.latencies[name].append(now - stamp)
+
+    def poll(self, timeout):
+        for key, mask in self.sel.select(timeout):
+            client = key.data
+            if client.sock is None:
+                continue
+            if mask & selectors.EVENT_WRITE:
+                self.flush(client)
+            if mask & selectors.EVENT_READ and client.sock is not None:
+                self.receive(client)
+
+    def keep_alive(self, now):
+        for client in self.clients:
+            if client.sock is not None and now - client.last_sent >= KEEPALIVE_INTERVAL:
+                self.send(client, EMPTY_FRAMES[IRC_KEEPALIVE])
+
+    def run_until(self, deadline, rate):
+        ''' sends at rate operations/s (none if 0) and reads until deadline '''
+        interval = 1 / rate if rate else None
+        next_send = monotonic()
+        next_keepalive = monotonic() + 1
+        while True:
+            now = monotonic()
+            if now >= deadline:
+                return
+            while interval is not None and next_send <= now:
+                client = self.random.choice(self.clients)
+                if client.sock is not None:
+                    operation = self.random.choices(self.operations, self.weights)[0]
+                    self.perform(operation, client)
+                next_send += interval
+            if now >= next_keepalive:
+                self.keep_alive(now)
+                next_keepalive = now + 1
+            wait = deadline if interval is None else min(deadline, next_send)
+            self.poll(max(0, wait - monotonic()))
+
+    def run(self):
+        config = self.config
+        self.connect_all()
+        self.run_until(monotonic() + config['warmup'], 0)
+        self.measuring = True
+        started = monotonic()
+        self.run_until(started + config['duration'], config['rate'] / config['processes'])
+        self.run_until(monotonic() + config['drain'], 0)  # in-flight deliveries still count
+        self.measuring = False
+        for client in self.clients:
+            if client.sock is not None:
+                self.sel.unregister(client.sock)
+                client.sock.close()
+        return {'sent': self.sent, 'received': self.received,
+                'received_bytes': self.received_bytes, 'fanout_bytes': self.fanout_bytes,
+                'latencies': self.latencies, 'replayed': self.replayed, 'errors': self.errors,
+                'disconnects': self.disconnects}
+
+
+def run_driver(args):
+    config, first, count, seed = args
+    return Driver(config, first, count, seed).run()
+
+
+def percentile(sorted_values, fraction):
+    ''' nearest-rank percentile of an ascending list, None if empty '''
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies_ns):
+    values = sorted(latencies_ns)
+    summary = {'count': len(values)}
+    for label, fraction in [('p50', 0.5), ('p99', 0.99), ('p999', 0.999), ('max', 1.0)]:
+        value = percentile(values, fraction)
+        summary[f'{label}_ms'] = None if value is None else value / 1e6
+    return summary
+
+
+def wait_for_port(port, timeout):
+    ''' returns once something accepts connections on port '''
+    deadline = monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if monotonic() > deadline:
+                raise
+            sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='594irc end-to-end load benchmark')
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--processes', type=int, default=max(1, min(4, os.cpu_count() or 1)),
+                        help='driver processes the clients are spread over')
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--rooms-per-client', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=2000,
+                        help='operations per second across all clients')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'operation weights, from {", ".join(OPERATIONS)}')
+    parser.add_argument('--message-size', type=int, default=100,
+                        help=f'chars per message, up to {MAX_MSG_LENGTH}')
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds before measuring')
+    parser.add_argument('--drain', type=float, default=1,
+                        help='seconds to keep reading after the last send')
+    parser.add_argument('--port', type=int, default=IRC_SERVER_PORT)
+    parser.add_argument('--no-server', action='store_true',
+                        help='load a server that is already running on --port')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='extra argument for server.py, repeatable')
+    parser.add_argument('--seed', type=int, default=594)
+    parser.add_argument('--output', default='bench_load.json')
+    args = parser.parse_args()
+    parse_mix(args.mix)  # fail early on typos
+    if not 2 <= args.message_size <= MAX_MSG_LENGTH:
+        parser.error(f'--message-size must be between 2 and {MAX_MSG_LENGTH}')
+    config = {key: value for key, value in vars(args).items() if key not in ['output', 'no_server']}
+    server = None
+    if not args.no_server:
+        if args.port != IRC_SERVER_PORT:
+            parser.error('server.py always listens on IRC_SERVER_PORT; use --no-server for other ports')
+        server_log = open(os.devnull, 'w')
+        server = subprocess.Popen([sys.executable, 'server.py'] + args.server_arg,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  stdout=server_log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(args.port, TIMEOUT)
+        shares = [args.clients // args.processes + (i < args.clients % args.processes)
+                  for i in range(args.processes)]
+        jobs = [(config, sum(shares[:i]), shares[i], args.seed + i) for i in range(args.processes)]
+        with multiprocessing.Pool(args.processes) as pool:
+            parts = pool.map(run_driver, jobs)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    seconds = args.duration
+    sent = {operation: sum(part['sent'][operation] for part in parts) for operation in OPERATIONS}
+    received = {}
+    for part in parts:
+        for name, count in part['received'].items():
+            received[name] = received.get(name, 0) + count
+    replayed = sum(part['replayed'] for part in parts)
+    delivered = received.get('tellmsg', 0) + received.get('tellprivmsg', 0) - replayed
+    results = {
+        'sent': sent,
+        'received': received,
+        'messages_sent_per_s': (sent['sendmsg'] + sent['sendprivmsg']) / seconds,
+        'messages_delivered_per_s': delivered / seconds,
+        'fanout_bytes_per_s': sum(part['fanout_bytes'] for part in parts) / seconds,
+        'received_bytes_per_s': sum(part['received_bytes'] for part in parts) / seconds,
+        'latency': {name: summarize([ns for part in parts for ns in part['latencies'][name]])
+                    for name in ['tellmsg', 'tellprivmsg']},
+        'replayed': replayed,
+        'errors': sum(part['errors'] for part in parts),
+        'disconnects': sum(part['disconnects'] for part in parts),
+    }
+    report = {'time': time(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'config': config, 'results': results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f'{results["messages_sent_per_s"]:.0f} msgs/s sent, '
+          + f'{results["messages_delivered_per_s"]:.0f} msgs/s delivered, '
+          + f'{results["fanout_bytes_per_s"] / 1e6:.2f} MB/s fanout')
+    for name, summary in results['latency'].items():
+        if summary['count']:
+            print(f'{name:<12} n={summary["count"]:<8} p50 {summary["p50_ms"]:.2f} ms  '
+                  + f'p99 {summary["p99_ms"]:.2f} ms  p999 {summary["p999_ms"]:.2f} ms')
+    print(f'{results["errors"]} errors, {results["disconnects"]} disconnects, wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
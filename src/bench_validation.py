@@ -0,0 +1,80 @@
+''' bench_validation.py
+'   microbenchmark for the table-driven validate_string / validate_label /
+'   validate_message in conf.py against the per-character loop they replaced
+'   usage: python bench_validation.py [iterations]
+'''
+
+from sys import argv
+from timeit import timeit
+
+from conf import *
+
+
+def legacy_validate_string(string):
+    ''' the previous per-character validate_string, kept as the baseline '''
+    bytestring = type(string) is bytes
+    if not bytestring:
+        try:
+            string.encode('ascii')
+        except UnicodeEncodeError:
+            return False
+    for i, char in enumerate(string):
+        if not bytestring:
+            if ord(char) < 0x20 or ord(char) > 0x7E and (ord(char) != 0x0A or ord(char) != 0x0D):
+                if ord(char) == 0x00 and i != 0:
+                    break
+                return False
+        elif (char < 0x20 or char > 0x7E) and (char != 0x0A and char != 0x0D):
+            if char == 0x00 and i != 0:
+                break
+            return False
+    return True
+
+
+def legacy_validate_message(message):
+    ''' the previous validate_message, kept as the baseline '''
+    if message[-1] != '\0':
+        return False
+    if message[:-1].find('\0') != -1:
+        return False
+    if not legacy_validate_string(message):
+        return False
+    if not len(message) <= MAX_MSG_LENGTH:
+        return False
+    return True
+
+
+def make_message(size):
+    ''' a valid, null-terminated message of exactly size chars '''
+    text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+    return (text * (size // len(text) + 1))[:size - 1] + '\0'
+
+
+def bench(label, func, arg, iterations):
+    seconds = timeit(lambda: func(arg), number=iterations)
+    usec = seconds / iterations * 1e6
+    print(f'{label:<40} {usec:10.2f} us/call')
+    return usec
+
+
+def main(iterations):
+    message = make_message(MAX_MSG_LENGTH)  # ~8 KB, the largest legal payload
+    message_bytes = message.encode('ascii')
+    label = 'xX_ChickenWing_Xx'.ljust(LABEL_LENGTH, '\0')
+    assert validate_message(message) and legacy_validate_message(message)
+    print(f'{len(message)} byte message, {iterations} iterations')
+    old = bench('legacy validate_message (str)', legacy_validate_message, message, iterations)
+    new = bench('validate_message (str)', validate_message, message, iterations)
+    print(f'{"speedup":<40} {old / new:10.1f}x')
+    old = bench('legacy validate_string (bytes)', legacy_validate_string, message_bytes, iterations)
+    new = bench('validate_string (bytes)', validate_string, message_bytes, iterations)
+    print(f'{"speedup":<40} {old / new:10.1f}x')
+    bench('validate_message (memoryview)', validate_message, memoryview(message_bytes), iterations)
+    old = bench('legacy validate_string (label)', legacy_validate_string, label, iterations * 10)
+    new = bench('validate_string (label)', validate_string, label, iterations * 10)
+    print(f'{"speedup":<40} {old / new:10.1f}x')
+    bench('validate_label', validate_label, label, iterations * 10)
+
+
+if __name__ == '__main__':
+    main(int(argv[1]) if len(argv) > 1 else 1000)
@@ -0,0 +1,123 @@
+''' capture.py
+'   records the inbound byte stream of every client connection of a server
+'   (python server.py --capture-file traffic.cap) so replay.py can play it
+'   back later
+'   a capture file is CAPTURE_MAGIC and FILE_STRUCT (wall clock time the
+'   capture started), then one record per event: RECORD_STRUCT (kind,
+'   connection id, nanoseconds since the start, data length) and the data
+'   kinds: OPEN when a connection is accepted, DATA with the bytes of one
+'   recv exactly as the socket handed them over (so replays reproduce the
+'   segmentation too), CLOSE when the server forgets the connection
+'   records go through a CAPTURE_BUFFER_BYTES write buffer, so capturing
+'   costs the event loop a memcpy per recv and one write per buffer-full;
+'   the rest is written when the server shuts down (Ctrl-C, not SIGKILL)
+'   usage: python capture.py traffic.cap   (prints a summary)
+'''
+
+import argparse
+import struct
+import time
+from collections import Counter
+from time import monotonic_ns
+
+from conf import *
+
+CAPTURE_MAGIC = b'594IRCAP'
+FILE_STRUCT = struct.Struct('>d')  # wall clock start
+RECORD_STRUCT = struct.Struct('>BIQI')  # kind, connection id, ns since start, data length
+
+CAPTURE_OPEN = 1
+CAPTURE_DATA = 2
+CAPTURE_CLOSE = 3
+
+
+class CaptureWriter:
+    ''' appends the traffic of the connections it is told about to path
+    '   connections are identified by any hashable object (the server's
+    '   Users); ones never passed to opened() are ignored
+    '''
+
+    def __init__(self, path, buffer_bytes=CAPTURE_BUFFER_BYTES):
+        self.path = path
+        self.file = open(path, 'wb', buffering=buffer_bytes)
+        self.file.write(CAPTURE_MAGIC + FILE_STRUCT.pack(time.time()))
+        self.started = monotonic_ns()
+        self.ids = {}  # connection -> id
+        self.next_id = 1
+
+    def opened(self, connection):
+        connection_id = self.ids[connection] = self.next_id
+        self.next_id += 1
+        self.file.write(RECORD_STRUCT.pack(CAPTURE_OPEN, connection_id,
+                                           monotonic_ns() - self.started, 0))
+
+    def received(self, connection, data):
+        connection_id = self.ids.get(connection)
+        if connection_id is None:
+            return
+        self.file.write(RECORD_STRUCT.pack(CAPTURE_DATA, connection_id,
+                                           monotonic_ns() - self.started, len(data)))
+        self.file.write(data)
+
+    def closed(self, connection):
+        connection_id = self.ids.pop(connection, None)
+        if connection_id is None:
+            return
+        self.file.write(RECORD_STRUCT.pack(CAPTURE_CLOSE, connection_id,
+                                           monotonic_ns() - self.started, 0))
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    ''' returns (wall clock start, [(kind, connection id, ns since start, data)])
+    '   a record torn off by a crash ends the list
+    '''
+    with open(path, 'rb') as capture_file:
+        contents = capture_file.read()
+    if not contents.startswith(CAPTURE_MAGIC):
+        raise ValueError(f'{path} is not a capture file')
+    offset = len(CAPTURE_MAGIC)
+    started, = FILE_STRUCT.unpack_from(contents, offset)
+    offset += FILE_STRUCT.size
+    records = []
+    while offset + RECORD_STRUCT.size <= len(contents):
+        kind, connection_id, elapsed, length = RECORD_STRUCT.unpack_from(contents, offset)
+        start = offset + RECORD_STRUCT.size
+        offset = start + length
+        if offset > len(contents):
+            break
+        records.append((kind, connection_id, elapsed, contents[start:offset]))
+    return started, records
+
+
+def split_packets(data_chunks):
+    ''' the opcodes of the whole packets in a connection's byte stream '''
+    decoder = FrameDecoder(max_length=None)
+    opcodes = []
+    for data in data_chunks:
+        decoder.feed(data)
+        opcodes.extend(frame[0] for frame in decoder)
+    return opcodes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='summarize a traffic capture')
+    parser.add_argument('path')
+    args = parser.parse_args()
+    started, records = read_capture(args.path)
+    streams = {}
+    for kind, connection_id, _, data in records:
+        if kind == CAPTURE_DATA:
+            streams.setdefault(connection_id, []).append(data)
+    opcodes = Counter()
+    for chunks in streams.values():
+        opcodes.update(split_packets(chunks))
+    duration = records[-1][2] / 1e9 if records else 0
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))
+    print(f'captured {stamp}, {duration:.3f}s, '
+          + f'{sum(kind == CAPTURE_OPEN for kind, *_ in records)} connections, '
+          + f'{sum(len(data) for *_, data in records)} bytes')
+    for opcode, count in opcodes.most_common():
+        print(f'{IRC_OPCODE_NAMES.get(opcode, hex(opcode)):<20} {count:>10}')
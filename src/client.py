@@ -2,14 +2,18 @@
 # '   Implements the client side of the chatroom as specified in RFC.pdf under /docs.
 # '   ...
 # '''
+import argparse
 import socket
 import sys
 import threading
-from time import sleep
+from time import monotonic, sleep
 import multiprocessing
 
+import irclog
 from conf import *
 
+log = irclog.get_logger('client')
+
 CLIENT_MANUAL = """ 
 CLIENT MANUAL
 ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
@@ -45,153 +49,241 @@ class Client:
         self.server_room_list = []
         self.receiving_thread = None
         self.keep_alive_thread = None
+        self.keepalives = KeepaliveScheduler()  # tracks the one server connection
+        self.caps = 0  # extensions the server agreed to, see IRC_CAPS
+        self.paged_lists = {}  # None (rooms) or room name -> labels of the pages so far
+        self.send_lock = threading.Lock()  # the input, receiving and keepalive threads all send
 
     def receive_from_server(self):
         sock = self.client_socket
+        decoder = FrameDecoder(max_length=None)  # list responses have no upper bound
         while True:
             if self.event.is_set():
-                print('Exiting receive_from_server thread')
+                log.debug('exiting receive_from_server thread')
                 break
             else:
                 try:
-                    header_bytes = sock.recv(IrcHeader.header_length)
-                    header_obj = IrcHeader().from_bytes(header_bytes)
-                    payload_bytes = sock.recv(header_obj.length)
-                    packet_bytes = header_bytes + payload_bytes
-
-                    if not header_obj.opcode == 1:
-                        # print(f'DEBUG {header_obj.opcode}')
-                        pass
-
-                    # depending on opcode do stuff.
-                    if header_obj.opcode == IRC_ERR:
-                        print('Got error packet from server...')
-                        try:
-                            msg_obj = IrcPacketErr().from_bytes(packet_bytes)
-                            print(f'Error Code : {msg_obj.payload}')
-                            self.disconnect_and_close()
-                            break
-                        except IRCException as e:
-                            print(f'Error parsing error packet from server: {e}')
-
-                    elif header_obj.opcode == IRC_KEEPALIVE:
-                        # do nothing
-                        pass
-
-                    elif header_obj.opcode == IRC_LISTROOMS_RESP:
-                        try:
-                            msg_obj = IrcPacketListRoomsResp().from_bytes(packet_bytes)
-                        except IRCException as e:
-                            print(f'Error parsing listrooms packet from server: {e}')
-                            continue
-                        self.server_room_list = msg_obj.payload
-                        if self.silent_server_room_request is False:
-                            if len(self.server_room_list) != 0:
-                                print('List of all rooms on server:')
-                                for element in self.server_room_list:
-                                    print(element)
-                            else:
-                                print('No rooms created on server.')
-                        else:
-                            self.silent_server_room_request = False
-
-
-                    elif header_obj.opcode == IRC_LISTUSERS_RESP:
-                        try:
-                            msg_obj = IrcPacketListUsersResp().from_bytes(packet_bytes)
-                            print(f"New list of Users for room {msg_obj.identifier} : ")
-                            print(msg_obj.payload)
-                        except IRCException as e:
-                            print(f'Error parsing listusers packet from server: {e}')
-                            continue
-
-                        # if self.silent_current_room_member_request == True:
-                        #     # client requested the list of current
-                        #     self.room_members.update({msg_obj.identifier: msg_obj.payload})
-                        #     self.silent_current_room_member_request = False
-                        #     if self.client_name in msg_obj.payload:
-                        #         print(f"Joined room '{msg_obj.identifier}'.")
-                        # else:
-                        #     # someone joined the server
-                        #     try:
-                        #         old_room_members = set(self.room_members.get(msg_obj.identifier)) if self.room_members.get(
-                        #             msg_obj.identifier) else set([])
-                        #         new_user = list(set(msg_obj.payload) - old_room_members)
-                        #         # print('new_user')
-                        #         # print(new_user)
-                        #         if len(new_user) <= 0:
-                        #             # print('DEBUG outlier')
-                        #             print(msg_obj.payload)  # just catching outliers
-                        #         else:
-                        #             self.room_members.update({msg_obj.identifier: msg_obj.payload})
-                        #             print(f"'{new_user[0]}' Joined '{msg_obj.identifier}'")
-                        except KeyError as e:
-                            print('error IRC_LISTUSERS_RESP');
-                            print(e);
-                            pass
-
-
-                    elif header_obj.opcode == IRC_TELLMSG:
-                        try:
-                            msg_obj = IrcPacketTellMsg().from_bytes(packet_bytes)
-                        except IRCException as e:
-                            print(f'Error parsing tellmsg packet from server: {e}')
-                            continue
-                        if msg_obj.sending_user != self.client_name:
-                            print(f'{msg_obj.sending_user} in room {msg_obj.target_label} : {msg_obj.payload}')
-                        else:
-                            print(f'You in room {msg_obj.target_label} : {msg_obj.payload}')
-
-                    elif header_obj.opcode == IRC_TELLPRIVMSG:
-                        try:
-                            msg_obj = IrcPacketTellPrivMsg().from_bytes(packet_bytes)
-                        except IRCException as e:
-                            print(f'Error parsing priv msg packet from server: {e}')
-                            continue
-                        print(f'{msg_obj.sending_user} says: {msg_obj.payload}')
-
+                    if decoder.recv_from(sock) == 0:
+                        raise ConnectionResetError('server closed the connection')
+                    self.keepalives.received(sock)
+                    if any(self.handle_server_packet(packet_bytes) for packet_bytes in decoder):
+                        break  # connection closed while handling a packet
 
                 except IRCException as e:
-                    print(f'KEEPALIVE THREAD: error constructing keepalive packet: {e}')
+                    log.error('error constructing keepalive packet: %s', e)
                     sock.close()
                     self.event.set()
                     exit()
 
                 except socket.error as e:
-                    print(f'KEEPALIVE THREAD: connection to fd {sock} errored: {e}')  # ERR
-                    print('Closing the socket')
+                    log.error('connection to fd %d errored, closing the socket: %s',
+                              sock.fileno(), e)
                     sock.close()
                     self.event.set()
                     exit()
 
+    def handle_server_packet(self, packet_bytes):
+        ''' reacts to one complete packet from the server
+        '   returns True if the connection was closed and receiving should stop
+        '''
+        header_obj = IrcHeader().from_bytes(packet_bytes)
+
+        if not header_obj.opcode == 1:
+            log.debug('received opcode %#x', header_obj.opcode)
+
+        # depending on opcode do stuff.
+        if header_obj.opcode == IRC_ERR:
+            print('Got error packet from server...')
+            try:
+                msg_obj = IrcPacketErr().from_bytes(packet_bytes)
+                print(f'Error Code : {msg_obj.payload}')
+                self.disconnect_and_close()
+                return True
+            except IRCException as e:
+                log.error('error parsing error packet from server: %s', e)
+
+        elif header_obj.opcode == IRC_KEEPALIVE:
+            # do nothing
+            pass
+
+        elif header_obj.opcode == IRC_LISTROOMS_RESP:
+            try:
+                msg_obj = IrcPacketListRoomsResp().from_bytes(packet_bytes)
+            except IRCException as e:
+                log.error('error parsing listrooms packet from server: %s', e)
+                return False
+            self.show_room_list(msg_obj.payload)
+
+        elif header_obj.opcode in (IRC_LISTROOMS_PAGE_RESP, IRC_LISTUSERS_PAGE_RESP):
+            rooms_page = header_obj.opcode == IRC_LISTROOMS_PAGE_RESP
+            packet_class = IrcPacketListRoomsPageResp if rooms_page else IrcPacketListUsersPageResp
+            try:
+                msg_obj = packet_class().from_bytes(packet_bytes)
+            except IRCException as e:
+                log.error('error parsing list page from server: %s', e)
+                return False
+            # an unsolicited or repeated page just starts a list of its own
+            labels = self.paged_lists.setdefault(msg_obj.identifier, [])
+            labels += msg_obj.payload
+            if msg_obj.more and msg_obj.payload:
+                self.request_list_page(msg_obj.identifier, cursor=msg_obj.payload[-1])
+                return False
+            self.paged_lists.pop(msg_obj.identifier, None)
+            if rooms_page:
+                self.show_room_list(labels)
+            else:
+                self.show_user_list(msg_obj.identifier, labels)
+
+
+        elif header_obj.opcode == IRC_LISTUSERS_RESP:
+            try:
+                msg_obj = IrcPacketListUsersResp().from_bytes(packet_bytes)
+                self.show_user_list(msg_obj.identifier, msg_obj.payload)
+            except IRCException as e:
+                log.error('error parsing listusers packet from server: %s', e)
+                return False
+
+            # if self.silent_current_room_member_request == True:
+            #     # client requested the list of current
+            #     self.room_members.update({msg_obj.identifier: msg_obj.payload})
+            #     self.silent_current_room_member_request = False
+            #     if self.client_name in msg_obj.payload:
+            #         print(f"Joined room '{msg_obj.identifier}'.")
+            # else:
+            #     # someone joined the server
+            #     try:
+            #         old_room_members = set(self.room_members.get(msg_obj.identifier)) if self.room_members.get(
+            #             msg_obj.identifier) else set([])
+            #         new_user = list(set(msg_obj.payload) - old_room_members)
+            #         # print('new_user')
+            #         # print(new_user)
+            #         if len(new_user) <= 0:
+            #             # print('DEBUG outlier')
+            #             print(msg_obj.payload)  # just catching outliers
+            #         else:
+            #             self.room_members.update({msg_obj.identifier: msg_obj.payload})
+            #             print(f"'{new_user[0]}' Joined '{msg_obj.identifier}'")
+            except KeyError as e:
+                log.error('IRC_LISTUSERS_RESP for unknown room %s', e)
+
+
+        elif header_obj.opcode == IRC_CAPS:
+            try:
+                self.caps = IrcPacketCaps().from_bytes(packet_bytes).payload
+            except IRCException as e:
+                log.error('error parsing caps packet from server: %s', e)
+
+        elif header_obj.opcode in (IRC_USERS_JOINED, IRC_USERS_LEFT):
+            packet_class = IrcPacketUsersJoined if header_obj.opcode == IRC_USERS_JOINED else IrcPacketUsersLeft
+            try:
+                msg_obj = packet_class().from_bytes(packet_bytes)
+            except IRCException as e:
+                log.error('error parsing membership packet from server: %s', e)
+                return False
+            # deltas are set operations on the last known member list
+            members = self.room_members.setdefault(msg_obj.identifier, [])
+            for username in msg_obj.payload:
+                if header_obj.opcode == IRC_USERS_JOINED and username not in members:
+                    members.append(username)
+                    print(f"'{username}' joined '{msg_obj.identifier}'")
+                elif header_obj.opcode == IRC_USERS_LEFT and username in members:
+                    members.remove(username)
+                    print(f"'{username}' left '{msg_obj.identifier}'")
+
+        elif header_obj.opcode == IRC_TELLMSG:
+            try:
+                msg_obj = IrcPacketTellMsg().from_bytes(packet_bytes)
+            except IRCException as e:
+                log.error('error parsing tellmsg packet from server: %s', e)
+                return False
+            if msg_obj.sending_user != self.client_name:
+                print(f'{msg_obj.sending_user} in room {msg_obj.target_label} : {msg_obj.payload}')
+            else:
+                print(f'You in room {msg_obj.target_label} : {msg_obj.payload}')
+
+        elif header_obj.opcode == IRC_TELLPRIVMSG:
+            try:
+                msg_obj = IrcPacketTellPrivMsg().from_bytes(packet_bytes)
+            except IRCException as e:
+                log.error('error parsing priv msg packet from server: %s', e)
+                return False
+            print(f'{msg_obj.sending_user} says: {msg_obj.payload}')
+        return False
+
     def send_keepalives(self):
+        ''' sends a keepalive whenever the connection has been quiet for
+        '   KEEPALIVE_INTERVAL seconds and gives up on a server that has been
+        '   silent for KEEPALIVE_MAX_MISSED intervals
+        '''
         sock = self.client_socket
         while True:
             if self.event.is_set():
-                print('Exiting send_keepalives thread')
+                log.debug('exiting send_keepalives thread')
                 break
             else:
                 try:
-                    sock.sendall(IrcPacketKeepalive().to_bytes())
-                    sleep(4)
+                    idle, dead = self.keepalives.due()
+                    if dead:
+                        raise TimeoutError('server stopped sending keepalives')
+                    for _ in idle:
+                        self.send_packet(EMPTY_FRAMES[IRC_KEEPALIVE])
+                    # wakes early if the client is shutting down
+                    self.event.wait(max(0, self.keepalives.next_deadline() - monotonic()))
                 except IRCException as e:
-                    print(f'KEEPALIVE THREAD: error constructing keepalive packet: {e}')
+                    log.error('error constructing keepalive packet: %s', e)
                     sock.close()
                     self.event.set()
                     exit()
                 except socket.error as e:
-                    print(f'KEEPALIVE THREAD: connection to fd {sock} errored: {e}')  # ERR
-                    print('Closing the socket')
+                    log.error('connection to fd %d errored, closing the socket: %s',
+                              sock.fileno(), e)
                     sock.close()
                     self.event.set()
                     exit()
 
+    def show_room_list(self, rooms):
+        self.server_room_list = rooms
+        if self.silent_server_room_request is False:
+            if len(self.server_room_list) != 0:
+                print('List of all rooms on server:')
+                for element in self.server_room_list:
+                    print(element)
+            else:
+                print('No rooms created on server.')
+        else:
+            self.silent_server_room_request = False
+
+    def show_user_list(self, room_name, usernames):
+        print(f"New list of Users for room {room_name} : ")
+        print(usernames)
+        self.room_members[room_name] = list(usernames)
+
+    def send_packet(self, packet_bytes):
+        ''' writes one whole packet, never interleaved with another thread's '''
+        with self.send_lock:
+            self.client_socket.sendall(packet_bytes)
+            self.keepalives.sent(self.client_socket)  # traffic doubles as a keepalive
+
+    def request_list_page(self, room_name=None, cursor=''):
+        ''' asks for the page after cursor of the room list, or of the user
+        '   list of room_name (IRC_CAP_LIST_PAGES)
+        '''
+        if room_name is None:
+            packet = IrcPacketListRoomsPage(cursor=cursor)
+        else:
+            packet = IrcPacketListUsersPage(room_name, cursor=cursor)
+        self.send_packet(packet.to_bytes())
+
     def list_all_server_rooms(self, is_silently):
         if is_silently:
             self.silent_server_room_request = True
         try:
+            if self.caps & IRC_CAP_LIST_PAGES:  # big directories come in bounded chunks
+                self.paged_lists[None] = []
+                self.request_list_page()
+                return
             packet = IrcPacketListRooms()
-            self.client_socket.sendall(packet.to_bytes())
+            self.send_packet(packet.to_bytes())
         except IRCException as e:
             print(f'Error constructing listrooms packet: {e}')
             return
@@ -201,12 +293,16 @@ class Client:
             print('Your are not in a room. Please join a room.')
         else:
             try:
+                if self.caps & IRC_CAP_LIST_PAGES:
+                    self.paged_lists[self.current_room] = []
+                    self.request_list_page(self.current_room)
+                    return
                 packet = IrcPacketListUsers(self.current_room)
             except IRCException as e:
                 print(f'Error constructing listusers packet: {e}')
                 return
             try:
-                self.client_socket.sendall(packet.to_bytes())
+                self.send_packet(packet.to_bytes())
             except BrokenPipeError as e:
                 print(f'Error sending packet to server.')
 
@@ -218,7 +314,7 @@ class Client:
             print(f'Error constructing listusers packet: {e}')
             return
         try:
-            self.client_socket.sendall(packet.to_bytes())
+            self.send_packet(packet.to_bytes())
         except BrokenPipeError as e:
             print(f'Error sending packet to server.')
 
@@ -233,7 +329,7 @@ class Client:
             print(f'Error constructing joinroom packet: {e}')
             return
         try:
-            self.client_socket.sendall(packet.to_bytes())
+            self.send_packet(packet.to_bytes())
             self.current_room = room_name
             # self.request_all_room_clients_silently()
             # self.list_all_server_rooms(is_silently=True)
@@ -291,7 +387,7 @@ class Client:
             print(f'Removing yourself from {self.current_room}')
             try:
                 packet = IrcPacketLeaveRoom(room_name=self.current_room)
-                self.client_socket.sendall(packet.to_bytes());
+                self.send_packet(packet.to_bytes());
             except IRCException as e:
                 print(f'Error constructing leaveroom packet: {e}')
                 return
@@ -316,7 +412,7 @@ class Client:
             message = input()
         try:
             packet = IrcPacketSendMsg(payload=message, target_label=room)
-            self.client_socket.sendall(packet.to_bytes());
+            self.send_packet(packet.to_bytes());
         except IRCException as e:
             print(f'Error constructing sendmsg packet: {e}')
             return
@@ -350,7 +446,7 @@ class Client:
         message = input()
         try:
             packet = IrcPacketSendPrivMsg(payload=message, sending_user=self.client_name, target_label=target_label)
-            self.client_socket.sendall(packet.to_bytes())
+            self.send_packet(packet.to_bytes())
             print('Sent.')
         except IRCException as e:
             print(f'Error constructing send priv msg packet: {e}')
@@ -369,14 +465,16 @@ class Client:
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect(server_address)
-            self.client_socket.sendall(join_bytes)
+            # offer our extensions right behind the hello
+            self.send_packet(join_bytes + IrcPacketCaps(IRC_SUPPORTED_CAPS).to_bytes())
+            self.keepalives.add(self.client_socket)
         except ConnectionRefusedError as e:
             print("Connection reused by server. Either can't find server, or server is not online")
             self.event.set()
             exit(-1)
         finally:
             if self.event.is_set():
-                print('Exiting receive_from_server thread')
+                log.debug('exiting receive_from_server thread')
                 exit()
             else:
                 print(CLIENT_MANUAL)
@@ -423,7 +521,7 @@ class Client:
 
         while True:
             if self.event.is_set():
-                print('Exiting main loop')
+                log.debug('exiting main loop')
                 break
             else:
                 try:
@@ -512,4 +610,8 @@ class Client:
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='594irc chat client')
+    parser.add_argument('--log-level', choices=irclog.LEVELS, default='warning',
+                        help='least severe diagnostic lines written to stderr')
+    irclog.setup(parser.parse_args().log_level)
     Client().main()
@@ -0,0 +1,496 @@
+''' cluster.py
+'   multi-process mode of server.py, selected with `python server.py --workers N`
+'   N worker processes bind IRC_SERVER_PORT with SO_REUSEPORT so the kernel
+'   spreads connections across them; each runs the ordinary Server event
+'   loop for its own clients. The parent process runs a BusHub that every
+'   worker connects to over a Unix domain socket. Through the hub workers
+'   claim usernames (so IRC_ERR_NAME_EXISTS holds cluster-wide), publish
+'   room joins and leaves, and hand over TELLMSG / TELLPRIVMSG frames for
+'   users connected to other workers.
+'   Bus frames reuse the IRC header (opcode, length) with opcodes outside the
+'   RFC's range; labels travel as 32 byte null-padded wire labels, and
+'   relayed frames travel as the exact bytes the recipients are sent.
+'''
+
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import tempfile
+from collections import deque
+
+import irclog
+from conf import *
+from server import Server, User, serve_diagnostics
+
+log = irclog.get_logger('cluster')
+
+# bus opcodes ~ never seen by clients
+BUS_CLAIM = 0x40  # worker -> hub: username label
+BUS_CLAIM_OK = 0x41  # hub -> worker: username label
+BUS_CLAIM_TAKEN = 0x42  # hub -> worker: username label
+BUS_RELEASE = 0x43  # username label; hub rebroadcasts to the other workers
+BUS_JOIN = 0x44  # room label + username label (all null: the room alone)
+BUS_LEAVE = 0x45  # room label + username label
+BUS_ROOM_MSG = 0x46  # TELLMSG frame; the room is its last LABEL_LENGTH bytes
+BUS_PRIV_MSG = 0x47  # TELLPRIVMSG frame; the recipient is its last LABEL_LENGTH bytes
+BUS_OPCODE_NAMES = {
+    BUS_CLAIM: 'bus_claim', BUS_CLAIM_OK: 'bus_claim_ok', BUS_CLAIM_TAKEN: 'bus_claim_taken',
+    BUS_RELEASE: 'bus_release', BUS_JOIN: 'bus_join', BUS_LEAVE: 'bus_leave',
+    BUS_ROOM_MSG: 'bus_room_msg', BUS_PRIV_MSG: 'bus_priv_msg',
+}
+
+NO_USER_LABEL = bytes(LABEL_LENGTH)
+
+
+def bus_frame(opcode, *parts):
+    ''' frames the concatenated parts as one bus packet '''
+    return b''.join((HEADER_STRUCT.pack(opcode, sum(len(part) for part in parts)), *parts))
+
+
+def label_to_name(label):
+    ''' converts a 32 byte null-padded wire label back to its (interned)
+    '   WireLabel name
+    '''
+    return wire_label(strip_null_bytes(bytes(label)).decode('ascii'))
+
+
+class BusLink:
+    ''' one worker's connection to the hub and the usernames it holds '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder(max_length=None)
+        self.outbound = deque()
+        self.names = set()  # username labels claimed through this link
+
+
+class BusHub:
+    ''' routes bus packets between workers and owns the cluster directory
+    '   every key is a raw wire label, so the hub never decodes a name
+    '   owners: username label -> BusLink of the worker that admitted it
+    '   rooms: room label -> {username label: BusLink}, insertion ordered
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.sel = selectors.DefaultSelector()
+        self.links = {}  # socket -> BusLink
+        self.owners = {}
+        self.rooms = {}
+        self.user_rooms = {}  # username label -> set of room labels
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.sel.register(self.listener, selectors.EVENT_READ)
+
+    def close(self):
+        for link in list(self.links.values()):
+            link.sock.close()
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def send(self, link, frame):
+        was_idle = not link.outbound
+        link.outbound.append(frame)
+        if was_idle:
+            self.flush(link)
+
+    def flush(self, link):
+        ''' writes as much of the link's queue as its socket will take '''
+        try:
+            while link.outbound:
+                head = link.outbound[0]
+                sent = link.sock.send(head)
+                if sent < len(head):
+                    link.outbound[0] = memoryview(head)[sent:]
+                    break
+                link.outbound.popleft()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop(link)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if link.outbound else 0)
+        self.sel.modify(link.sock, events, data=link)
+
+    def broadcast(self, origin, frame):
+        ''' sends a frame to every worker except the one it came from '''
+        for link in list(self.links.values()):
+            if link is not origin:
+                self.send(link, frame)
+
+    def accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        link = self.links[sock] = BusLink(sock)
+        self.sel.register(sock, selectors.EVENT_READ, data=link)
+        # a late worker starts from the current directory
+        for room_label, members in self.rooms.items():
+            self.send(link, bus_frame(BUS_JOIN, room_label, NO_USER_LABEL))
+            for name_label in members:
+                self.send(link, bus_frame(BUS_JOIN, room_label, name_label))
+
+    def drop(self, link):
+        ''' forgets a worker that went away, releasing all of its names '''
+        if self.links.pop(link.sock, None) is None:
+            return
+        log.error('bus: lost a worker holding %d users', len(link.names))
+        self.sel.unregister(link.sock)
+        link.sock.close()
+        for name_label in list(link.names):
+            self.release(link, name_label)
+
+    def release(self, link, name_label):
+        if self.owners.get(name_label) is not link:
+            return
+        del self.owners[name_label]
+        link.names.discard(name_label)
+        for room_label in self.user_rooms.pop(name_label, ()):
+            self.rooms[room_label].pop(name_label, None)
+        self.broadcast(link, bus_frame(BUS_RELEASE, name_label))
+
+    def receive(self, link):
+        try:
+            if link.decoder.recv_from(link.sock) == 0:
+                raise ConnectionResetError('worker closed the bus')
+        except BlockingIOError:
+            return
+        except OSError:
+            self.drop(link)
+            return
+        for frame in link.decoder:
+            self.handle_packet(link, frame)
+            if link.sock.fileno() == -1:
+                return
+
+    def handle_packet(self, link, frame):
+        opcode, _ = HEADER_STRUCT.unpack_from(frame, 0)
+        body = frame[IrcHeader.header_length:]
+        if opcode == BUS_CLAIM:
+            name_label = bytes(body)
+            if name_label in self.owners:
+                self.send(link, bus_frame(BUS_CLAIM_TAKEN, name_label))
+            else:
+                self.owners[name_label] = link
+                link.names.add(name_label)
+                self.send(link, bus_frame(BUS_CLAIM_OK, name_label))
+        elif opcode == BUS_RELEASE:
+            self.release(link, bytes(body))
+        elif opcode == BUS_JOIN:
+            room_label, name_label = bytes(body[:LABEL_LENGTH]), bytes(body[LABEL_LENGTH:])
+            self.rooms.setdefault(room_label, {})[name_label] = link
+            self.user_rooms.setdefault(name_label, set()).add(room_label)
+            self.broadcast(link, bus_frame(BUS_JOIN, room_label, name_label))
+        elif opcode == BUS_LEAVE:
+            room_label, name_label = bytes(body[:LABEL_LENGTH]), bytes(body[LABEL_LENGTH:])
+            self.rooms.get(room_label, {}).pop(name_label, None)
+            self.user_rooms.get(name_label, set()).discard(room_label)
+            self.broadcast(link, bus_frame(BUS_LEAVE, room_label, name_label))
+        elif opcode == BUS_ROOM_MSG:
+            members = self.rooms.get(bytes(frame[-LABEL_LENGTH:]), {})
+            relay = bytes(frame)  # copied once, shared by every worker
+            for target in set(members.values()):
+                if target is not link:
+                    self.send(target, relay)
+        elif opcode == BUS_PRIV_MSG:
+            target = self.owners.get(bytes(frame[-LABEL_LENGTH:]))
+            if target is not None and target is not link:
+                self.send(target, bytes(frame))
+        else:
+            log.error('bus: unknown opcode %#x', opcode)
+
+    def poll(self, timeout=None):
+        ''' handles whatever the selector reports within timeout seconds '''
+        for key, mask in self.sel.select(timeout=timeout):
+            if key.data is None:
+                self.accept()
+                continue
+            link = key.data
+            if mask & selectors.EVENT_WRITE:
+                self.flush(link)
+            if mask & selectors.EVENT_READ and link.sock.fileno() != -1:
+                self.receive(link)
+
+    def serve(self, workers):
+        ''' routes bus traffic until every worker process has exited '''
+        while any(worker.is_alive() for worker in workers):
+            self.poll(timeout=TIMEOUT)
+
+
+class ClusterServer(Server):
+    ''' a Server that shares its users and rooms with the rest of the cluster
+    '   bus: the connection to the hub, driven by the selector as a User
+    '   claims: username -> Users waiting on the hub to grant that name
+    '   remote_rooms: room name -> {username: None} for users of other workers
+    '''
+    opcode_names = {**IRC_OPCODE_NAMES, **BUS_OPCODE_NAMES}
+
+    def __init__(self, bus_path, **kwargs):
+        super().__init__(reuse_port=True, **kwargs)
+        self.bus_path = bus_path
+        self.bus = None
+        self.claims = {}
+        self.remote_rooms = {}
+        self.remote_user_rooms = {}  # username -> set of room names
+
+    def connect_bus(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.bus_path)
+        sock.setblocking(False)
+        self.bus = User('<bus>', sock)
+        self.bus.decoder = FrameDecoder(max_length=None)
+        self.connections[sock] = self.bus
+        self.sel.register(sock, selectors.EVENT_READ, data=self.bus)
+
+    def send_to_bus(self, opcode, *parts):
+        ''' queues a bus packet built from parts (buffers, or tuples of
+        '   buffers such as a relayed TELLMSG); like client packets it goes out
+        '   with flush_dirty, but the bus is exempt from the slow consumer cap
+        '''
+        bus = self.bus
+        if bus is None or bus.sock.fileno() == -1:
+            return
+        buffers = []
+        for part in parts:
+            if type(part) is tuple:
+                buffers.extend(part)
+            else:
+                buffers.append(part)
+        length = sum(len(buffer) for buffer in buffers)
+        bus.outbound.append(HEADER_STRUCT.pack(opcode, length))
+        bus.outbound.extend(buffers)
+        bus.outbound_bytes += IrcHeader.header_length + length
+        bus.frame_lengths.append(IrcHeader.header_length + length)
+        if not bus.reading_paused and bus.outbound_bytes >= self.high_watermark:
+            self.update_interest(bus)
+        self.dirty[bus] = None
+
+    def main(self):
+        self.connect_bus()
+        super().main()
+
+    def setup_err(self, e=None):
+        log.error('worker %d cannot listen: %s', os.getpid(), e)
+        exit(1)
+
+    def close_and_clean(self, sock=None, err_code=IRC_ERR_UNKNOWN):
+        if sock is not None and self.bus is not None and sock is self.bus.sock:
+            # the hub speaks bus opcodes, so it gets no IRC error packet
+            self.connections.pop(sock, None)
+            try:
+                self.sel.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            sock.close()
+            return
+        super().close_and_clean(sock, err_code)
+
+    def drop_lost_connection(self, this_user):
+        if this_user is not self.bus:
+            return super().drop_lost_connection(this_user)
+        log.error('lost the bus, shutting down this worker')
+        self.close_and_clean()
+        exit(1)
+
+    # username directory
+
+    def receive_hello(self, new_user):
+        if not new_user.username:
+            return super().receive_hello(new_user)
+        # hello already read; buffer what follows until the hub answers
+        try:
+            received = new_user.decoder.recv_from(new_user.sock)
+            if received == 0:
+                raise ConnectionResetError('connection closed before admission')
+            if self.capture is not None:
+                self.capture.received(new_user, new_user.decoder.last_received(received))
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop_lost_connection(new_user)
+
+    def claim_username(self, new_user, username):
+        ''' asks the hub for username; the connection stays pending until
+        '   BUS_CLAIM_OK or BUS_CLAIM_TAKEN comes back
+        '''
+        if username in self.users:
+            self.metrics.handshake_failures.inc()
+            self.close_and_clean(new_user.sock, IRC_ERR_NAME_EXISTS)
+            return
+        new_user.username = username
+        self.claims.setdefault(username, deque()).append(new_user)
+        self.send_to_bus(BUS_CLAIM, label_to_bytes(username))
+
+    def resolve_claim(self, name_label, granted):
+        username = label_to_name(name_label)
+        waiting = self.claims.get(username)
+        if not waiting:
+            return
+        new_user = waiting.popleft()
+        if not waiting:
+            del self.claims[username]
+        if new_user.sock not in self.pending:  # hung up or timed out meanwhile
+            if granted:
+                self.send_to_bus(BUS_RELEASE, name_label)
+            return
+        if not granted:
+            self.metrics.handshake_failures.inc()
+            self.close_and_clean(new_user.sock, IRC_ERR_NAME_EXISTS)
+            return
+        try:
+            self.admit_user(new_user, username)
+        except OSError:  # peer gone before admission finished
+            self.drop_lost_connection(new_user)
+
+    def clean_userlist(self, bad_sock=None):
+        user = self.connections.get(bad_sock)
+        admitted = user is not None and self.users.get(user.username) is user
+        super().clean_userlist(bad_sock)
+        if admitted:
+            self.send_to_bus(BUS_RELEASE, user.label)
+
+    # rooms
+
+    def add_user_to_room(self, user, join_msg):
+        room = self.rooms.get(join_msg.payload)
+        joined_before = room is not None and user in room.members
+        super().add_user_to_room(user, join_msg)
+        if not joined_before and user.sock.fileno() != -1:
+            self.send_to_bus(BUS_JOIN, label_to_bytes(join_msg.payload), user.label)
+
+    def remove_user_from_room(self, user, room_to_leave=None):
+        rooms_before = set(user.rooms)
+        super().remove_user_from_room(user, room_to_leave)
+        for room in rooms_before - user.rooms:
+            self.send_to_bus(BUS_LEAVE, label_to_bytes(room.name), user.label)
+
+    def room_usernames(self, room_name):
+        return super().room_usernames(room_name) + list(self.remote_rooms.get(room_name, ()))
+
+    def room_names(self):
+        local_names = super().room_names()
+        return local_names + [name for name in self.remote_rooms if name not in self.rooms]
+
+    def deliver_to_room(self, room_name, tell_msg_bytes):
+        delivered = super().deliver_to_room(room_name, tell_msg_bytes)
+        if self.remote_rooms.get(room_name):
+            self.send_to_bus(BUS_ROOM_MSG, tell_msg_bytes)
+            return True
+        return delivered or room_name in self.remote_rooms
+
+    def deliver_to_user(self, username, tell_msg_bytes):
+        if not super().deliver_to_user(username, tell_msg_bytes):
+            self.send_to_bus(BUS_PRIV_MSG, tell_msg_bytes)  # the hub drops unknown names
+        return True
+
+    # bus packets
+
+    def handle_packet(self, this_user, packet_bytes):
+        if this_user is self.bus:
+            return self.handle_bus_packet(packet_bytes)
+        return super().handle_packet(this_user, packet_bytes)
+
+    def handle_bus_packet(self, frame):
+        opcode, _ = HEADER_STRUCT.unpack_from(frame, 0)
+        body = frame[IrcHeader.header_length:]
+        if opcode in (BUS_CLAIM_OK, BUS_CLAIM_TAKEN):
+            self.resolve_claim(bytes(body), opcode == BUS_CLAIM_OK)
+        elif opcode == BUS_JOIN:
+            room_name = label_to_name(body[:LABEL_LENGTH])
+            if room_name not in self.remote_rooms and room_name not in self.rooms:
+                self.rooms_changed()
+            members = self.remote_rooms.setdefault(room_name, {})
+            if bytes(body[LABEL_LENGTH:]) == NO_USER_LABEL:
+                return
+            username = label_to_name(body[LABEL_LENGTH:])
+            members[username] = None
+            self.members_changed(room_name)
+            self.remote_user_rooms.setdefault(username, set()).add(room_name)
+            # local members hear about it as they would about a local join
+            self.note_membership_change(room_name, username, True)
+        elif opcode == BUS_LEAVE:
+            room_name = label_to_name(body[:LABEL_LENGTH])
+            username = label_to_name(body[LABEL_LENGTH:])
+            members = self.remote_rooms.get(room_name, {})
+            if username in members:
+                del members[username]
+                self.note_membership_change(room_name, username, False)
+            self.remote_user_rooms.get(username, set()).discard(room_name)
+            self.members_changed(room_name)
+        elif opcode == BUS_RELEASE:
+            username = label_to_name(body)
+            for room_name in self.remote_user_rooms.pop(username, ()):
+                self.remote_rooms[room_name].pop(username, None)
+                self.members_changed(room_name)
+                self.note_membership_change(room_name, username, False)
+        elif opcode == BUS_ROOM_MSG:
+            # the frame outlives this call in recipients' queues, so copy it
+            Server.deliver_to_room(self, label_to_name(frame[-LABEL_LENGTH:]), bytes(body))
+        elif opcode == BUS_PRIV_MSG:
+            Server.deliver_to_user(self, label_to_name(frame[-LABEL_LENGTH:]), bytes(body))
+        else:
+            log.error('unknown bus opcode %#x', opcode)
+
+
+def run_worker(bus_path, index=0, log_dir=None, log_options=None, log_level=None, admin_port=0,
+               trace_options=None, profile_options=None, profile_now=False, capture_path=None):
+    if log_level is not None:  # the listener thread does not survive the fork
+        irclog.setup(log_level)
+    room_log = None
+    if log_dir is not None:  # the writer thread has to start in this process
+        from roomlog import RoomLog
+        room_log = RoomLog(os.path.join(log_dir, f'worker{index}'), **log_options)
+    tracer = None
+    if trace_options is not None:
+        from tracing import Tracer
+        tracer = Tracer(**{**trace_options, 'path': f'{trace_options["path"]}.worker{index}'})
+    capture = None
+    if capture_path is not None:
+        from capture import CaptureWriter
+        capture = CaptureWriter(f'{capture_path}.worker{index}')
+    server = ClusterServer(bus_path, room_log=room_log, tracer=tracer, capture=capture)
+    profile_options = dict(profile_options or {})
+    profile_options['path'] = f'{profile_options.get("path", PROFILE_FILE)}.worker{index}'
+    serve_diagnostics(server, admin_port and admin_port + index, profile_options, profile_now)
+    server.main()
+
+
+def run_cluster(workers, log_dir=None, log_options=None, log_level=None, admin_port=0,
+                trace_options=None, profile_options=None, profile_now=False, capture_path=None):
+    ''' starts the hub and the worker processes, then routes bus traffic
+    '   until the workers exit
+    '   with log_dir, each worker logs the messages sent by its own users to
+    '   a directory of its own, so every message is logged exactly once
+    '''
+    bus_path = os.path.join(tempfile.gettempdir(), f'594irc-bus-{os.getpid()}.sock')
+    hub = BusHub(bus_path)  # listening before any worker tries to connect
+    processes = [multiprocessing.Process(target=run_worker, daemon=True,
+                                         args=(bus_path, index, log_dir, log_options or {},
+                                               log_level, admin_port, trace_options,
+                                               profile_options, profile_now, capture_path))
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+    # SIGUSR2 toggles the profilers; passing it on lets the parent stand in for them
+    signal.signal(signal.SIGUSR2, lambda signum, frame: [os.kill(process.pid, signum)
+                                                         for process in processes])
+    log.info('started %d workers', workers)
+    try:
+        hub.serve(processes)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.close()  # workers shut down once they lose the bus
+        for process in processes:
+            process.join(timeout=TIMEOUT)
+            if process.is_alive():
+                process.terminate()
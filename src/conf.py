@@ -14,18 +14,86 @@
 '''
 
 from abc import ABC
+import heapq
 import socket
+import struct
+import sys
+import threading
+import weakref
+from time import monotonic
+
+from irclog import get_logger as _get_logger
+
+_log = _get_logger('conn')
 
 # network config
 IRC_SERVER_PORT = 7734
 TIMEOUT = 5
 LABEL_LENGTH = 32
 MAX_MSG_LENGTH = 7999
+RECV_BUFSIZE = 65536  # bytes asked of each recv; one read may hold many packets
+KEEPALIVE_INTERVAL = 4  # seconds of silence after which a keepalive is sent
+KEEPALIVE_MAX_MISSED = 3  # silent intervals after which a peer counts as dead
+HANDSHAKE_TIMEOUT = TIMEOUT  # seconds a new connection has to send its hello
+MAX_PENDING_HANDSHAKES = 1024  # connections accepted but still waiting on hello
+ACCEPT_BATCH = 64  # accept() calls per readiness event of the listening socket
+SENDMSG_MAX_BUFFERS = 1024  # buffers per sendmsg call (IOV_MAX on Linux)
+# outbound queueing (server): past the high watermark a connection's input is
+# no longer read until its queue drains below the low watermark; past the cap
+# the slow consumer policy decides between dropping packets and disconnecting
+OUTBOUND_HIGH_WATERMARK = 256 * 1024
+OUTBOUND_LOW_WATERMARK = 64 * 1024
+OUTBOUND_QUEUE_CAP = 4 * 1024 * 1024
+SLOW_CONSUMER_DROP = 'drop'
+SLOW_CONSUMER_DISCONNECT = 'disconnect'
+# per-room history (server): the last ROOM_HISTORY_COUNT relayed messages, at
+# most ROOM_HISTORY_BYTES of them, are replayed to new members; rooms quiet
+# for ROOM_HISTORY_IDLE seconds drop theirs
+ROOM_HISTORY_COUNT = 50
+ROOM_HISTORY_BYTES = 256 * 1024
+ROOM_HISTORY_IDLE = 600
+# on-disk room log (server, --log-dir): records are written in batches of up
+# to LOG_BATCH_RECORDS, fsync'd every LOG_FSYNC_INTERVAL seconds and indexed
+# every LOG_INDEX_INTERVAL bytes; segments roll over at LOG_SEGMENT_BYTES and
+# records past LOG_QUEUE_MAX waiting for the writer are dropped
+LOG_FSYNC_INTERVAL = 1.0
+LOG_SEGMENT_BYTES = 64 * 1024 * 1024
+LOG_INDEX_INTERVAL = 4096
+LOG_BATCH_RECORDS = 4096
+LOG_QUEUE_MAX = 65536
+
+# diagnostic logging (irclog.py): per-recipient and per-dropped-packet lines
+# are logged once in every FANOUT_LOG_EVERY
+FANOUT_LOG_EVERY = 100
+
+# admin endpoint (server, --admin-port, off unless given): Prometheus text at
+# /metrics on localhost only; histogram bucket upper bounds in seconds and in
+# recipients
+ADMIN_PORT = 7735
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# relay tracing (server, --trace-file): one room message in every
+# TRACE_SAMPLE_EVERY is traced, naming its TRACE_SLOWEST slowest recipients
+TRACE_SAMPLE_EVERY = 1000
+TRACE_SLOWEST = 10
+# sampling profiler (server, SIGUSR2 or /profile on the admin port): the
+# event loop's stack is sampled every PROFILE_INTERVAL seconds and the
+# collapsed stacks rewritten to PROFILE_FILE every PROFILE_WRITE_INTERVAL
+PROFILE_INTERVAL = 0.005
+PROFILE_WRITE_INTERVAL = 10.0
+PROFILE_FILE = 'server-profile.collapsed'
+# traffic capture (server, --capture-file): inbound bytes are buffered up to
+# CAPTURE_BUFFER_BYTES before each write to the capture file
+CAPTURE_BUFFER_BYTES = 1024 * 1024
+
+# largest payload a client may legally send (sendprivmsg: msg + sender + target)
+MAX_CLIENT_PAYLOAD_LENGTH = MAX_MSG_LENGTH + 2 * LABEL_LENGTH
 
 # IRC version
 IRC_VERSION = 0x1337
 
-IRC_COMMAND_VALUES = [i for i in range(0x00, 0x0D)]  # for validation
+IRC_COMMAND_VALUES = [i for i in range(0x00, 0x14)]  # for validation
 # IRC commands ~ client or server
 IRC_ERR = 0x00
 IRC_KEEPALIVE = 0x01
@@ -43,6 +111,33 @@ IRC_TELLMSG = 0x0A
 # Extra credit
 IRC_SENDPRIVMSG = 0x0B
 IRC_TELLPRIVMSG = 0x0C
+# Extensions ~ a client offers capabilities with IRC_CAPS after its hello and
+# the server answers with the subset it will use; peers that never negotiate
+# (or a server that never answers) speak the plain RFC protocol
+IRC_CAPS = 0x0D
+IRC_USERS_JOINED = 0x0E  # server only, with IRC_CAP_MEMBERSHIP_DELTAS
+IRC_USERS_LEFT = 0x0F  # server only, with IRC_CAP_MEMBERSHIP_DELTAS
+IRC_LISTROOMS_PAGE = 0x10  # client only, with IRC_CAP_LIST_PAGES
+IRC_LISTUSERS_PAGE = 0x11  # client only, with IRC_CAP_LIST_PAGES
+IRC_LISTROOMS_PAGE_RESP = 0x12  # server only, with IRC_CAP_LIST_PAGES
+IRC_LISTUSERS_PAGE_RESP = 0x13  # server only, with IRC_CAP_LIST_PAGES
+IRC_OPCODE_NAMES = {  # for logs and metrics labels
+    IRC_ERR: 'err', IRC_KEEPALIVE: 'keepalive', IRC_HELLO: 'hello',
+    IRC_LISTROOMS: 'listrooms', IRC_LISTUSERS: 'listusers', IRC_JOINROOM: 'joinroom',
+    IRC_LEAVEROOM: 'leaveroom', IRC_SENDMSG: 'sendmsg', IRC_LISTROOMS_RESP: 'listrooms_resp',
+    IRC_LISTUSERS_RESP: 'listusers_resp', IRC_TELLMSG: 'tellmsg', IRC_SENDPRIVMSG: 'sendprivmsg',
+    IRC_TELLPRIVMSG: 'tellprivmsg', IRC_CAPS: 'caps', IRC_USERS_JOINED: 'users_joined',
+    IRC_USERS_LEFT: 'users_left', IRC_LISTROOMS_PAGE: 'listrooms_page',
+    IRC_LISTUSERS_PAGE: 'listusers_page', IRC_LISTROOMS_PAGE_RESP: 'listrooms_page_resp',
+    IRC_LISTUSERS_PAGE_RESP: 'listusers_page_resp',
+}
+
+# capability bits carried by IRC_CAPS
+IRC_CAP_MEMBERSHIP_DELTAS = 0x00000001  # joins/leaves as deltas instead of full user lists
+IRC_CAP_LIST_PAGES = 0x00000002  # sorted room/user lists fetched page by page
+IRC_SUPPORTED_CAPS = IRC_CAP_MEMBERSHIP_DELTAS | IRC_CAP_LIST_PAGES
+MEMBERSHIP_COALESCE_WINDOW = 0.05  # seconds of joins/leaves batched into one notification
+LIST_PAGE_MAX = 1000  # labels per page response, whatever the client asks for
 
 IRC_ERR_VALUES = [i for i in range(0x10, 0x19)]  # for validation
 # IRC error codes
@@ -56,6 +151,20 @@ IRC_ERR_NAME_EXISTS = 0x16
 IRC_ERR_TOO_MANY_USERS = 0x17
 IRC_ERR_TOO_MANY_ROOMS = 0x18
 
+# precompiled wire layouts ~ all multi-byte fields are big-endian
+# packet classes pack/unpack through these instead of int.to_bytes and
+# slicing; they accept bytes, bytearrays and memoryviews alike
+HEADER_STRUCT = struct.Struct('>BI')  # opcode, length
+ERR_STRUCT = struct.Struct('>BIB')  # header, error code
+HELLO_STRUCT = struct.Struct(f'>BI{LABEL_LENGTH}sH')  # header, username, version
+LABEL_PACKET_STRUCT = struct.Struct(f'>BI{LABEL_LENGTH}s')  # header, label (join/leave/listusers)
+LABEL_STRUCT = struct.Struct(f'{LABEL_LENGTH}s')  # null-padded label
+CAPS_STRUCT = struct.Struct('>BII')  # header, capability bits
+# header, limit, cursor, prefix
+LIST_ROOMS_PAGE_STRUCT = struct.Struct(f'>BIH{LABEL_LENGTH}s{LABEL_LENGTH}s')
+# header, limit, cursor, prefix, room name
+LIST_USERS_PAGE_STRUCT = struct.Struct(f'>BIH{LABEL_LENGTH}s{LABEL_LENGTH}s{LABEL_LENGTH}s')
+
 
 class IRCException(Exception):
     def __init__(self, code, msg=None):
@@ -96,23 +205,24 @@ class IrcHeader:
         '   returns a byte representation of the header
         '''
         self.validate()
-        opcode_bytes = self.opcode.to_bytes(1, 'big')
-        length_bytes = self.length.to_bytes(4, 'big')
-        return opcode_bytes + length_bytes
+        return HEADER_STRUCT.pack(self.opcode, self.length)
+
+    def pack_into(self, buffer, offset=0):
+        ''' validates fields
+        '   writes the header into a writable buffer at offset
+        '''
+        self.validate()
+        HEADER_STRUCT.pack_into(buffer, offset, self.opcode, self.length)
 
     def from_bytes(self, received_header):
         ''' parses a byte representation of the packet and validates the results
         '   returns an IrcHeader object
         '   intended to consume the output of socket.recv()
+        '   only the first header_length bytes are read, so a whole packet may be passed
         '''
-        # define field boundaries
-        opcode_bytes = received_header[0:IrcHeader.opcode_length]
-        len_bytes = received_header[IrcHeader.opcode_length:IrcHeader.header_length]
-        # construct and return self
-        opcode = int.from_bytes(opcode_bytes, 'big')
-        length = int.from_bytes(len_bytes, 'big')
-        self.opcode = opcode
-        self.length = length
+        if len(received_header) < IrcHeader.header_length:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Truncated header: {len(received_header)} bytes')
+        self.opcode, self.length = HEADER_STRUCT.unpack_from(received_header, 0)
         return self
 
 
@@ -143,25 +253,21 @@ class IrcPacketErr:
         '   returns a byte representation of the packet
         '''
         self.validate()
-        header_bytes = self.header.to_bytes()
-        payload_bytes = self.payload.to_bytes(1, 'big')
-        return header_bytes + payload_bytes
+        return ERR_STRUCT.pack(self.header.opcode, self.header.length, self.payload)
 
-    def from_bytes(self, received_hello):
+    def from_bytes(self, received_err):
         ''' parses a byte representation of the packet and validates the results
         '   returns an IrcPacketErr object
         '   intended to consume the output of socket.recv()
         '  !!! DOES NOT call self.validate() !!!
         '   if we are parsing an err message, the connection has been terminated
         '''
-        # define field boundaries - may be a better way to do this, remove bytes as they're parsed?
-        # error code
-        errcode_bytes = received_hello[IrcHeader.header_length: IrcHeader.header_length + IrcPacketErr.errcode_length]
+        self.header = IrcHeader().from_bytes(received_err)
         # parse bytes and do not validate (connection dead)
-        errcode = int.from_bytes(errcode_bytes, 'big')
-        # construct and return
-        self.header = IrcHeader().from_bytes(received_hello[0:IrcHeader.header_length])
-        self.payload = errcode
+        if len(received_err) >= IrcPacketErr.packet_length:
+            self.payload = ERR_STRUCT.unpack_from(received_err, 0)[2]
+        else:
+            self.payload = IRC_ERR_UNKNOWN  # peer hung up mid-packet
         return self
 
 
@@ -192,7 +298,7 @@ class IrcPacketHello:
         if self.version != IRC_VERSION:
             raise IRCException(IRC_ERR_WRONG_VERSION, f'Invalid version: {self.version}')
         if native_labels:
-            if not validate_label(label_to_bytes(self.payload)):
+            if not validate_native_label(self.payload):
                 raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid username: {self.payload}')
         elif not validate_label(self.payload):
             raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid username: {self.payload}')
@@ -202,26 +308,21 @@ class IrcPacketHello:
         '   returns a byte representation of the packet
         '''
         self.validate(native_labels=True)
-        header_bytes = self.header.to_bytes()
-        payload_bytes = label_to_bytes(self.payload)
-        version_bytes = self.version.to_bytes(IrcPacketHello.version_length, 'big')
-        return header_bytes + payload_bytes + version_bytes
+        return HELLO_STRUCT.pack(self.header.opcode, self.header.length,
+                                 label_to_bytes(self.payload), self.version)
 
     def from_bytes(self, received_hello):
         ''' parses a byte representation of the packet and validates the results
         '   returns an IrcPacketHello object
         '   intended to consume the output of socket.recv()
         '''
-        # define field boundaries - may be a better way to do this, remove bytes as they're parsed?
-        self.header = IrcHeader().from_bytes(received_hello[0:IrcHeader.header_length])
-        name_bytes = received_hello[
-                     IrcHeader.header_length: IrcHeader.header_length + LABEL_LENGTH
-                     ]
-        version_bytes = received_hello[IrcHeader.header_length + LABEL_LENGTH:]
+        if len(received_hello) != IrcPacketHello.packet_length:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid hello size: {len(received_hello)}')
+        opcode, length, name_bytes, version = HELLO_STRUCT.unpack_from(received_hello, 0)
+        self.header = IrcHeader(opcode, length)
         # parse bytes into self
         username_as_received = name_bytes.decode('ascii')
         self.payload = username_as_received  # keep as is for validation for now
-        version = int.from_bytes(version_bytes, 'big')
         self.version = version
         # validate
         self.validate()
@@ -230,6 +331,38 @@ class IrcPacketHello:
         return self
 
 
+class IrcPacketCaps:
+    ''' has a header, holds a capability bitmask (IRC_CAP_* bits)
+    '   client -> server: the extensions the client understands
+    '   server -> client: the extensions the server will use with it
+    '''
+    payload_length = 4
+    packet_length = IrcHeader.header_length + payload_length
+
+    def __init__(self, payload=None):
+        self.header = IrcHeader(IRC_CAPS, IrcPacketCaps.payload_length)
+        self.payload = payload
+
+    def validate(self):
+        self.header.validate()
+        if self.header.opcode != IRC_CAPS:
+            raise IRCException(IRC_ERR_ILLEGAL_OPCODE, f'Invalid opcode: {self.header.opcode}')
+        if self.header.length != IrcPacketCaps.payload_length:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid length: {self.header.length}')
+
+    def to_bytes(self):
+        self.validate()
+        return CAPS_STRUCT.pack(self.header.opcode, self.header.length, self.payload)
+
+    def from_bytes(self, received_caps):
+        if len(received_caps) != IrcPacketCaps.packet_length:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid packet size: {len(received_caps)}')
+        opcode, length, self.payload = CAPS_STRUCT.unpack_from(received_caps, 0)
+        self.header = IrcHeader(opcode, length)
+        self.validate()
+        return self
+
+
 class IrcPacketRoomOp(ABC):
     ''' has a header, holds the body of an IRC join or leave message
     '   header: irc_header object
@@ -250,7 +383,7 @@ class IrcPacketRoomOp(ABC):
         if self.header.length != len(label_to_bytes(self.payload)):
             raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid length: {self.header.length}')
         if native_labels:
-            if not validate_label(label_to_bytes(self.payload)):
+            if not validate_native_label(self.payload):
                 raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid room name: {self.payload}')
         elif not validate_label(self.payload):
             raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid room name: {self.payload}')
@@ -260,20 +393,18 @@ class IrcPacketRoomOp(ABC):
         '   returns a byte representation of the packet
         '''
         self.validate(native_labels=True)
-        header_bytes = self.header.to_bytes()
-        payload_bytes = label_to_bytes(self.payload)
-        return header_bytes + payload_bytes
+        return LABEL_PACKET_STRUCT.pack(self.header.opcode, self.header.length,
+                                        label_to_bytes(self.payload))
 
     def from_bytes(self, received_hello):
         ''' parses a byte representation of the packet and validates the results
         '   returns an IrcPacketHello object
         '   intended to consume the output of socket.recv()
         '''
-        # define field boundaries - may be a better way to do this, remove bytes as they're parsed?
-        self.header = IrcHeader().from_bytes(received_hello[0:IrcHeader.header_length])
-        room_name_bytes = received_hello[
-                          IrcHeader.header_length: IrcHeader.header_length + LABEL_LENGTH
-                          ]
+        if len(received_hello) != IrcPacketRoomOp.packet_length:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid packet size: {len(received_hello)}')
+        opcode, length, room_name_bytes = LABEL_PACKET_STRUCT.unpack_from(received_hello, 0)
+        self.header = IrcHeader(opcode, length)
         # parse bytes into self
         roomname_as_received = room_name_bytes.decode('ascii')
         self.payload = roomname_as_received  # keep as is for validation for now
@@ -341,38 +472,34 @@ class IrcPacketMsgOp(ABC):
             expected_length += LABEL_LENGTH
         if self.header.length != expected_length:
             raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid length: {self.header.length}')
-        payload = self.payload
-        target_label = self.target_label
-        sending_user = self.sending_user
-        if native_labels:
-            target_label = label_to_bytes(target_label)
-            sending_user = label_to_bytes(sending_user) if sending_user is not None else None
-        if not validate_label(target_label):
+        check_label = validate_native_label if native_labels else validate_label
+        if not check_label(self.target_label):
             raise IRCException(IRC_ERR_ILLEGAL_LABEL)
-        if not temp_msg and not validate_message(payload):
+        if not temp_msg and not validate_message(self.payload):
             raise IRCException(IRC_ERR_ILLEGAL_MSG)
-        if sending_user is not None and not validate_label(sending_user):
+        if self.sending_user is not None and not check_label(self.sending_user):
             raise IRCException(IRC_ERR_ILLEGAL_LABEL)
 
     def to_bytes(self):
         ''' validates fields
         '   returns a byte representation of the packet
         '''
-        # validate fields
+        # validate fields (validate_message guarantees the null terminator)
         self.validate(native_labels=True)
         # construct and return bytestring
         payload_bytes = self.payload.encode('ascii')
-        if payload_bytes[-1] != 0:
-            payload_bytes += 0
-            self.header.length += 1 # for null byte
-        header_bytes = self.header.to_bytes()
-        room_bytes = label_to_bytes(self.target_label)
-        sender_bytes = b''  # should be empty for sendmsg
+        packet = bytearray(IrcHeader.header_length + self.header.length)
+        self.header.pack_into(packet)
+        offset = IrcHeader.header_length
+        packet[offset:offset + len(payload_bytes)] = payload_bytes
+        offset += len(payload_bytes)
+        # sender is next-to-last LABEL_LENGTH bytes for tellmsg, absent for sendmsg
         if self.sending_user is not None:
-            sender_bytes = label_to_bytes(self.sending_user)
-        # target room is last LABEL_LENGTH bytes for sendmsg
-        # sender is last next-to-last LABEL_LENGTH bytes for tellmsg
-        return header_bytes + payload_bytes + sender_bytes + room_bytes
+            LABEL_STRUCT.pack_into(packet, offset, label_to_bytes(self.sending_user))
+            offset += LABEL_LENGTH
+        # target room is always the last LABEL_LENGTH bytes
+        LABEL_STRUCT.pack_into(packet, offset, label_to_bytes(self.target_label))
+        return bytes(packet)
 
     def from_bytes(self, received_msg, temp_msg=False):
         ''' parses a byte representation of the packet and validates the results
@@ -380,14 +507,14 @@ class IrcPacketMsgOp(ABC):
         '   intended to consume the output of socket.recv()
         '   last LABEL_LENGTH bytes of message should be converted into sending_user for tell
         '''
-        # define field boundaries - may be a better way to do this, remove bytes as they're parsed?
-        self.header = IrcHeader().from_bytes(received_msg[0:IrcHeader.header_length])
+        view = memoryview(received_msg)
+        self.header = IrcHeader().from_bytes(view)
+        if len(view) < IrcHeader.header_length + LABEL_LENGTH:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid packet size: {len(view)}')
         # message body
-        payload_bytes = received_msg[IrcHeader.header_length: -LABEL_LENGTH]
-        msg_body_as_received = payload_bytes.decode('ascii')
+        msg_body_as_received = str(view[IrcHeader.header_length:-LABEL_LENGTH], 'ascii')
         # other label
-        room_bytes = received_msg[-LABEL_LENGTH:]
-        room_as_received = room_bytes.decode('ascii')
+        room_as_received = str(view[-LABEL_LENGTH:], 'ascii')
         # parse bytes and validate
         self.payload = msg_body_as_received
         self.target_label = room_as_received
@@ -483,8 +610,9 @@ class IrcPacketEmpty(ABC):
         '''
         if self.header.opcode != self.init_opcode:
             raise IRCException(IRC_ERR_ILLEGAL_OPCODE, f'Invalid opcode: {self.header.opcode}')
-        header_bytes = self.header.to_bytes()
-        return header_bytes
+        if self.header.length == IrcPacketEmpty.payload_length and self.init_opcode in EMPTY_FRAMES:
+            return EMPTY_FRAMES[self.init_opcode]  # constant frame, nothing to pack
+        return self.header.to_bytes()
 
 
 class IrcPacketKeepalive(IrcPacketEmpty):
@@ -537,13 +665,15 @@ class IrcPacketListUsers():
     def to_bytes(self):
         ''' returns a byte representation of the packet '''
         self.validate(native_labels=True)
-        header_bytes = self.header.to_bytes()
-        payload_bytes = label_to_bytes(self.payload)
-        return header_bytes + payload_bytes
+        return LABEL_PACKET_STRUCT.pack(self.header.opcode, self.header.length,
+                                        label_to_bytes(self.payload))
     
     def from_bytes(self, received_msg):
-        self.header = IrcHeader().from_bytes(received_msg[0:IrcHeader.header_length])
-        self.payload = received_msg[IrcHeader.header_length:].decode('ascii')
+        if len(received_msg) != IrcPacketListUsers.packet_length:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid packet size: {len(received_msg)}')
+        opcode, length, room_name_bytes = LABEL_PACKET_STRUCT.unpack_from(received_msg, 0)
+        self.header = IrcHeader(opcode, length)
+        self.payload = room_name_bytes.decode('ascii')
         self.validate()
         self.payload = strip_null_bytes(self.payload)
         return self
@@ -554,68 +684,83 @@ class IrcPacketListResp(ABC):
     '   header: irc_header object
     '   payload: list of labels
     '   identifier: used for listusers, name of room to list users in
+    '   to_bytes and from_bytes convert and validate every label exactly once
+    '   (see encode_labels / decode_labels), so time is linear in the
+    '   number of labels
     '''
+    has_identifier = False  # decoded frames carry the identifier as their last label
+    fixed_length = 0  # payload bytes ahead of the labels
 
     def __init__(self, opcode, payload=None, identifier=None):
         self.init_opcode = opcode
-        packet_length = 0
+        packet_length = self.fixed_length
         if payload is not None:
-            packet_length = len(payload) * LABEL_LENGTH
+            packet_length += len(payload) * LABEL_LENGTH
         if identifier is not None:
             packet_length += LABEL_LENGTH
         self.header = IrcHeader(opcode, packet_length)
         self.payload = payload
         self.identifier = identifier
-    
+
     def validate(self, native_labels=False):
         ''' validates fields '''
+        self.validate_header()
+        labels = list(self.payload)
+        if self.identifier is not None:
+            labels.append(self.identifier)
+        check_label = validate_native_label if native_labels else validate_label
+        for label in labels:
+            if not check_label(label):
+                raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {label}')
+
+    def validate_header(self):
         self.header.validate()
         if self.header.opcode != self.init_opcode:
             raise IRCException(IRC_ERR_ILLEGAL_OPCODE, f'Invalid opcode: {self.header.opcode}')
-        if self.header.length != len(self.payload) * LABEL_LENGTH + LABEL_LENGTH if self.identifier is not None else 0:
+        expected_length = self.fixed_length + len(self.payload) * LABEL_LENGTH
+        if self.identifier is not None:
+            expected_length += LABEL_LENGTH
+        if self.header.length != expected_length:
             raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid length: {self.header.length}')
-        if native_labels:
-            if self.identifier is not None and not validate_label(label_to_bytes(self.identifier)):
-                raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {self.identifier}')
-            for label in self.payload:
-                if not validate_label(label_to_bytes(label)):
-                    raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {label}')
-        else:
-            if self.identifier is not None and not validate_label(self.identifier):
-                raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {self.identifier}')
-            for label in self.payload:
-                if not validate_label(label):
-                    raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {label}')
-    
+
+    def fixed_bytes(self):
+        ''' the payload bytes ahead of the labels, fixed_length long '''
+        return b''
+
+    def parse_fixed(self, fixed_view):
+        pass
+
     def to_bytes(self):
         ''' validates fields
         '   returns a byte representation of the packet
         '''
-        self.validate(native_labels=True)
-        header_bytes = self.header.to_bytes()
-        payload_bytes = b''
-        for label in self.payload:
-            payload_bytes += label_to_bytes(label)
+        self.validate_header()
+        labels = list(self.payload)
         if self.identifier is not None:
-            payload_bytes += label_to_bytes(self.identifier)  # Last 32 bytes are always identifier for listusers
-        return header_bytes + payload_bytes
+            labels.append(self.identifier)  # Last 32 bytes are always identifier for listusers
+        return b''.join([HEADER_STRUCT.pack(self.header.opcode, self.header.length),
+                         self.fixed_bytes(), encode_labels(labels)])
 
     def from_bytes(self, packet_bytes):
         ''' parses a byte representation of the packet and validates the results
-        '   returns an IrcPacketListResp object (will this be an issue in consuming code? Expecting subclass?)
+        '   returns self, with the identifier split off for subclasses that have one
         '   intended to consume the output of socket.recv()
         '''
-        # define field boundaries - may be a better way to do this, remove bytes as they're parsed?
-        self.header = IrcHeader().from_bytes(packet_bytes[0:IrcHeader.header_length])
+        view = memoryview(packet_bytes)
+        self.header = IrcHeader().from_bytes(view)
+        payload_start = IrcHeader.header_length + self.fixed_length
         # message body
-        payload_bytes = packet_bytes[IrcHeader.header_length:]
+        payload_view = view[payload_start:]
+        if len(view) < payload_start or len(payload_view) % LABEL_LENGTH != 0:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid list size: {len(payload_view)}')
+        if self.has_identifier and not payload_view:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, 'Missing identifier')
+        self.parse_fixed(view[IrcHeader.header_length:payload_start])
         # parse bytes and validate
-        userlist = [payload_bytes[i:i + LABEL_LENGTH] for i in range(0, len(payload_bytes), LABEL_LENGTH)]
-        userlist = [lbl.decode('ascii') for lbl in userlist]
-        self.payload = userlist
-        self.identifier = None  # will be updated in subclass if needed
-        self.validate(native_labels=True)
-        self.payload = [strip_null_bytes(lbl) for lbl in self.payload]
+        labels = decode_labels(payload_view)
+        self.identifier = labels.pop() if self.has_identifier else None
+        self.payload = labels
+        self.validate_header()
         return self
 
 
@@ -636,106 +781,606 @@ class IrcPacketListUsersResp(IrcPacketListResp):
     '   payload: list of labels
     '   identifier: used for listusers, name of room to list users in
     '''
+    has_identifier = True  # identifier is always last 32 bytes of payload
 
     def __init__(self, payload=None, identifier=None):
         super().__init__(IRC_LISTUSERS_RESP, payload, identifier)
 
-    def from_bytes(self, packet_bytes):
-        superclass_bytes = super().from_bytes(packet_bytes)
-        # identifier is always last 32 bytes of payload
-        self.identifier = self.payload[-1]
-        self.payload = self.payload[:-1]
+
+class IrcPacketUsersJoined(IrcPacketListUsersResp):
+    ''' has a header, holds the users that joined a room since the last
+    '   notification (IRC_CAP_MEMBERSHIP_DELTAS)
+    '   payload: list of usernames
+    '   identifier: room name, the last 32 bytes like in listusers resp
+    '''
+
+    def __init__(self, payload=None, identifier=None):
+        IrcPacketListResp.__init__(self, IRC_USERS_JOINED, payload, identifier)
+
+
+class IrcPacketUsersLeft(IrcPacketListUsersResp):
+    ''' has a header, holds the users that left a room since the last
+    '   notification (IRC_CAP_MEMBERSHIP_DELTAS)
+    '   payload: list of usernames
+    '   identifier: room name, the last 32 bytes like in listusers resp
+    '''
+
+    def __init__(self, payload=None, identifier=None):
+        IrcPacketListResp.__init__(self, IRC_USERS_LEFT, payload, identifier)
+
+
+class IrcPacketListPage(ABC):
+    ''' has a header, asks for one page of a list sorted by name
+    '   (IRC_CAP_LIST_PAGES); pages are fetched by passing the last label of
+    '   one page as the cursor of the next until a response has more unset
+    '   limit: most labels wanted, 0 for LIST_PAGE_MAX (the server's cap)
+    '   cursor: last label of the previous page, '' to start at the beginning
+    '   prefix: only labels starting with this, '' for all of them
+    '''
+    layout = LIST_ROOMS_PAGE_STRUCT
+
+    def __init__(self, opcode, limit=0, cursor='', prefix=''):
+        self.init_opcode = opcode
+        self.header = IrcHeader(opcode, self.layout.size - IrcHeader.header_length)
+        self.limit = limit
+        self.cursor = cursor
+        self.prefix = prefix
+
+    def labels(self):
+        return [self.cursor, self.prefix]
+
+    def set_labels(self, labels):
+        self.cursor, self.prefix = labels
+
+    def validate(self):
+        self.header.validate()
+        if self.header.opcode != self.init_opcode:
+            raise IRCException(IRC_ERR_ILLEGAL_OPCODE, f'Invalid opcode: {self.header.opcode}')
+        if self.header.length != self.layout.size - IrcHeader.header_length:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid length: {self.header.length}')
+        if not 0 <= self.limit <= 0xFFFF:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid limit: {self.limit}')
+
+    def validate_labels(self, label_bytes):
+        ''' the cursor and any trailing labels are labels or empty; the
+        '   prefix only has to be a valid string, since a label's first
+        '   characters may end in a space
+        '''
+        for i, data in enumerate(label_bytes):
+            if i == 1:
+                valid = len(data) <= LABEL_LENGTH and validate_string(data.rstrip(b'\x00'))
+            else:
+                valid = not data.strip(b'\x00') or validate_label(data)
+            if not valid:
+                raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {data}')
+
+    def to_bytes(self):
+        ''' validates fields
+        '   returns a byte representation of the packet
+        '''
+        self.validate()
+        label_bytes = [label_to_bytes(label) for label in self.labels()]
+        self.validate_labels(label_bytes)
+        return self.layout.pack(self.header.opcode, self.header.length, self.limit, *label_bytes)
+
+    def from_bytes(self, received_msg):
+        ''' parses a byte representation of the packet and validates the results
+        '   returns self
+        '''
+        if len(received_msg) != self.layout.size:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid packet size: {len(received_msg)}')
+        opcode, length, self.limit, *label_bytes = self.layout.unpack_from(received_msg, 0)
+        self.header = IrcHeader(opcode, length)
+        self.validate()
+        self.validate_labels(label_bytes)
+        self.set_labels([data.rstrip(b'\x00').decode('ascii') for data in label_bytes])
         return self
 
 
+class IrcPacketListRoomsPage(IrcPacketListPage):
+    ''' asks for a page of the server's rooms, see IrcPacketListPage '''
+
+    def __init__(self, limit=0, cursor='', prefix=''):
+        super().__init__(IRC_LISTROOMS_PAGE, limit, cursor, prefix)
+
+
+class IrcPacketListUsersPage(IrcPacketListPage):
+    ''' asks for a page of the users in room_name, see IrcPacketListPage '''
+    layout = LIST_USERS_PAGE_STRUCT
+
+    def __init__(self, room_name=None, limit=0, cursor='', prefix=''):
+        super().__init__(IRC_LISTUSERS_PAGE, limit, cursor, prefix)
+        self.room_name = room_name
+
+    def labels(self):
+        return [self.cursor, self.prefix, self.room_name]
+
+    def set_labels(self, labels):
+        self.cursor, self.prefix, self.room_name = labels
+
+    def validate_labels(self, label_bytes):
+        super().validate_labels(label_bytes)
+        if not validate_label(label_bytes[2]):
+            raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid room name: {label_bytes[2]}')
+
+
+class IrcPacketListPageResp(IrcPacketListResp):
+    ''' has a header, holds one page of a paginated list: a byte that is 1
+    '   when later pages exist, then the labels in ascending order
+    '   payload: list of labels; the next page starts after payload[-1]
+    '   more: whether to ask for another page
+    '''
+    fixed_length = 1
+
+    def __init__(self, opcode, payload=None, identifier=None, more=False):
+        super().__init__(opcode, payload, identifier)
+        self.more = more
+
+    def fixed_bytes(self):
+        return b'\x01' if self.more else b'\x00'
+
+    def parse_fixed(self, fixed_view):
+        if fixed_view[0] > 1:
+            raise IRCException(IRC_ERR_ILLEGAL_MSG, f'Invalid more flag: {fixed_view[0]}')
+        self.more = fixed_view[0] == 1
+
+
+class IrcPacketListRoomsPageResp(IrcPacketListPageResp):
+    ''' one page of room names, answering IrcPacketListRoomsPage '''
+
+    def __init__(self, payload=None, more=False):
+        super().__init__(IRC_LISTROOMS_PAGE_RESP, payload, None, more)
+
+
+class IrcPacketListUsersPageResp(IrcPacketListPageResp):
+    ''' one page of the users in a room, answering IrcPacketListUsersPage
+    '   identifier: room name, the last 32 bytes like in listusers resp
+    '''
+    has_identifier = True
+
+    def __init__(self, payload=None, identifier=None, more=False):
+        super().__init__(IRC_LISTUSERS_PAGE_RESP, payload, identifier, more)
+
+
+# constant frames are packed once at import and reused for every send
+EMPTY_FRAMES = {
+    IRC_KEEPALIVE: HEADER_STRUCT.pack(IRC_KEEPALIVE, IrcPacketEmpty.payload_length),
+    IRC_LISTROOMS: HEADER_STRUCT.pack(IRC_LISTROOMS, IrcPacketEmpty.payload_length),
+}
+
+
+# relay fast path ~ the server forwards SENDMSG bodies as TELLMSG without
+# decoding them to str, re-validating or re-encoding them
+
+def split_sendmsg_frame(frame):
+    ''' validates a raw SENDMSG packet the same way IrcPacketSendMsg.from_bytes does
+    '   returns (payload, room_label) as memoryviews into frame: the
+    '   null-terminated message body and the 32 byte null-padded room label
+    '   raises an IRCException on protocol violations
+    '''
+    view = memoryview(frame)
+    if len(view) < IrcHeader.header_length + LABEL_LENGTH:
+        raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid packet size: {len(view)}')
+    opcode, length = HEADER_STRUCT.unpack_from(view, 0)
+    if opcode != IRC_SENDMSG:
+        raise IRCException(IRC_ERR_ILLEGAL_OPCODE, f'Invalid opcode: {opcode}')
+    if length != len(view) - IrcHeader.header_length:
+        raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid length: {length}')
+    payload = view[IrcHeader.header_length:-LABEL_LENGTH]
+    room_label = view[-LABEL_LENGTH:]
+    if not validate_label(room_label):
+        raise IRCException(IRC_ERR_ILLEGAL_LABEL)
+    if not validate_message(payload):
+        raise IRCException(IRC_ERR_ILLEGAL_MSG)
+    return payload, room_label
+
+
+def tellmsg_frame_parts(payload, sender_label, room_label):
+    ''' returns a TELLMSG packet as a tuple of buffers, in wire order, for
+    '   scatter-gather writes (socket.sendmsg) that never join them
+    '   payload: null-terminated message body (bytes-like)
+    '   sender_label, room_label: 32 byte null-padded labels (bytes-like)
+    '''
+    header = HEADER_STRUCT.pack(IRC_TELLMSG, len(payload) + 2 * LABEL_LENGTH)
+    return (header, payload, sender_label, room_label)
+
+
+def frame_length(frame):
+    ''' length in bytes of a packet given as bytes or as a tuple of buffers '''
+    if type(frame) is tuple:
+        return sum(len(part) for part in frame)
+    return len(frame)
+
+
+def build_tellmsg_frame(payload, sender_label, room_label):
+    ''' assembles a TELLMSG packet from already validated wire pieces
+    '   same arguments as tellmsg_frame_parts; the pieces are copied exactly
+    '   once, into the returned bytes
+    '''
+    return b''.join(tellmsg_frame_parts(payload, sender_label, room_label))
+
+
+_recv_scratch = threading.local()  # .buffer: the thread's shared receive buffer, .owner: who reads into it
+
+
+class FrameDecoder:
+    ''' splits a TCP byte stream into whole IRC packets, one per connection
+    '   feed() or recv_from() append whatever the socket handed over, which may
+    '   be part of a packet or many packets at once; iterating the decoder then
+    '   yields every complete packet (header included) as a memoryview
+    '   all decoders of a thread read into one shared scratch buffer; a decoder
+    '   only keeps a private copy of its unfinished packet once another one
+    '   takes the scratch over, so idle connections hold no receive buffer
+    '   yielded views point into the scratch and are only valid until the next
+    '   feed()/recv_from() on any decoder of the same thread - copy them with
+    '   bytes() to keep them
+    '   max_length: largest payload length accepted in a header, None for no limit
+    '   bufsize: smallest scratch buffer this decoder reads into
+    '   shared: False gives the decoder a private buffer, dropped whenever it
+    '   drains, so its views stay valid until its own next read; for decoders
+    '   that take turns with others between reading and handling a packet,
+    '   like asyncio tasks
+    '''
+
+    def __init__(self, max_length=MAX_CLIENT_PAYLOAD_LENGTH, bufsize=RECV_BUFSIZE, shared=True):
+        self.bufsize = bufsize
+        self.max_length = max_length
+        self.shared = shared
+        self.buffer = bytearray()  # the thread's scratch or this decoder's partial packet
+        self.start = 0  # first byte not yet handed out as a packet
+        self.end = 0  # one past the last byte received
+
+    def pending(self):
+        ''' number of buffered bytes that are not part of a yielded packet '''
+        return self.end - self.start
+
+    def _reserve(self, nbytes):
+        ''' makes room for nbytes more at the end of the thread's scratch buffer
+        '   the decoder that read into it before keeps a copy of just its
+        '   unfinished packet; never resizes the scratch in place since yielded
+        '   views may still reference it, grows by swapping in a new one
+        '''
+        pending = self.end - self.start
+        if not self.shared:
+            if len(self.buffer) - self.end < nbytes:
+                new_buffer = bytearray(max(pending + nbytes, self.bufsize))
+                new_buffer[:pending] = self.buffer[self.start:self.end]
+                self.buffer = new_buffer
+                self.start, self.end = 0, pending
+            return
+        scratch = getattr(_recv_scratch, 'buffer', None)
+        if self.buffer is not scratch:
+            owner = getattr(_recv_scratch, 'owner', None)
+            if owner is not None and owner.buffer is scratch:
+                owner.buffer = owner.buffer[owner.start:owner.end]
+                owner.start, owner.end = 0, len(owner.buffer)
+            _recv_scratch.owner = self
+        elif len(scratch) - self.end >= nbytes:
+            if pending == 0:
+                self.start = self.end = 0
+            return
+        needed = pending + nbytes
+        if scratch is None or needed > len(scratch):
+            scratch = _recv_scratch.buffer = bytearray(max(needed, self.bufsize))
+        # slides the unconsumed tail to the front, or moves it into the scratch
+        scratch[:pending] = self.buffer[self.start:self.end]
+        self.buffer = scratch
+        self.start, self.end = 0, pending
+
+    def feed(self, data):
+        ''' appends received bytes to the buffer '''
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def recv_from(self, sock, nbytes=RECV_BUFSIZE):
+        ''' reads up to nbytes from sock straight into the buffer
+        '   returns the number of bytes read, 0 meaning the peer hung up
+        '''
+        self._reserve(nbytes)
+        received = sock.recv_into(memoryview(self.buffer)[self.end:self.end + nbytes])
+        self.end += received
+        return received
+
+    def last_received(self, nbytes):
+        ''' a view of the last nbytes appended, valid until the next read '''
+        return memoryview(self.buffer)[self.end - nbytes:self.end]
+
+    def next_frame(self):
+        ''' returns the next complete packet or None if more bytes are needed
+        '   raises an IRCException if the header announces an oversized payload
+        '''
+        if self.end - self.start < IrcHeader.header_length:
+            return None
+        _, length = HEADER_STRUCT.unpack_from(self.buffer, self.start)
+        if self.max_length is not None and length > self.max_length:
+            raise IRCException(IRC_ERR_ILLEGAL_LENGTH, f'Invalid length: {length}')
+        frame_end = self.start + IrcHeader.header_length + length
+        if frame_end > self.end:
+            return None
+        frame = memoryview(self.buffer)[self.start:frame_end]
+        self.start = frame_end
+        if frame_end == self.end and not self.shared:
+            self.buffer = bytearray()  # the view keeps the old one alive
+            self.start = self.end = 0
+        return frame
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        frame = self.next_frame()
+        if frame is None:
+            raise StopIteration
+        return frame
+
+
+class KeepaliveScheduler:
+    ''' tracks when each connection last sent and received anything
+    '   a connection needs a keepalive once nothing was sent to it for
+    '   interval seconds, and its peer counts as dead once nothing was heard
+    '   from it for max_missed intervals (None: never)
+    '   connections sit in a heap keyed by the earliest of those two times;
+    '   traffic only updates timestamps, and an entry popped early is pushed
+    '   back at its real deadline, so a tick costs O(expiring connections)
+    '   rather than O(all connections)
+    '   a connection may be any hashable object (a User, a socket, ...)
+    '''
+
+    def __init__(self, interval=KEEPALIVE_INTERVAL, max_missed=KEEPALIVE_MAX_MISSED, clock=monotonic):
+        self.interval = interval
+        self.max_missed = max_missed
+        self.clock = clock
+        self.times = {}  # connection -> [last sent, last received, heap entry id]
+        self.heap = []  # (deadline, entry id, connection); stale ids are skipped
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.times)
+
+    def _push(self, conn, entry):
+        last_sent, last_received, _ = entry
+        deadline = last_sent + self.interval
+        if self.max_missed is not None:
+            deadline = min(deadline, last_received + self.max_missed * self.interval)
+        entry[2] = self.next_id
+        heapq.heappush(self.heap, (deadline, self.next_id, conn))
+        self.next_id += 1
+
+    def add(self, conn):
+        now = self.clock()
+        entry = self.times[conn] = [now, now, None]
+        self._push(conn, entry)
+
+    def remove(self, conn):
+        self.times.pop(conn, None)  # its heap entry is dropped when popped
+
+    def sent(self, conn):
+        entry = self.times.get(conn)
+        if entry is not None:
+            entry[0] = self.clock()
+
+    def received(self, conn):
+        entry = self.times.get(conn)
+        if entry is not None:
+            entry[1] = self.clock()
+
+    def next_deadline(self):
+        ''' earliest time due() may have work, or None if nothing is tracked '''
+        return self.heap[0][0] if self.heap else None
+
+    def due(self):
+        ''' returns (idle, dead): connections that need a keepalive now, and
+        '   connections whose peer missed too many; dead ones are no longer
+        '   tracked and idle ones are counted as sent to
+        '''
+        now = self.clock()
+        idle, dead = [], []
+        while self.heap and self.heap[0][0] <= now:
+            _, entry_id, conn = heapq.heappop(self.heap)
+            entry = self.times.get(conn)
+            if entry is None or entry[2] != entry_id:
+                continue  # removed or rescheduled since this was pushed
+            # same sums as in _push, so a popped deadline always makes progress
+            if self.max_missed is not None and \
+                    entry[1] + self.max_missed * self.interval <= now:
+                del self.times[conn]
+                dead.append(conn)
+                continue
+            if entry[0] + self.interval <= now:
+                idle.append(conn)
+                entry[0] = now
+            self._push(conn, entry)
+        return idle, dead
+
+
 # globally useful functions
 
 def close_on_err(sock, err_code, err_msg=None):
-    ''' closes a socket and prints an error message
+    ''' closes a socket and logs an error message
     '   sock: socket to close
-    '   err_code: error code to send
-    '   err_msg: error message to print
+    '   err_code: error code to send, None to close without an error packet
+    '   err_msg: error message to log
     '   sel: selector to remove socket from (if closing from server)
     '''
     if err_msg is not None:
-        print(err_msg)
+        _log.warning('%s', err_msg)
     try:
-        if sock is not None and sock.fileno() != -1:
-            print(f'closing {sock.getpeername()} due to error {err_code}')
+        if sock is not None and sock.fileno() != -1 and err_code is not None:
+            _log.info('closing %s due to error %#x', sock.getpeername(), err_code)
             sock.send(IrcPacketErr(err_code).to_bytes())
-            sock.close()
     except (socket.error, KeyError, ValueError, OSError):
-        pass # socket already closed
+        pass # socket already closed, or its send buffer is full
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+# byte class table for validation ~ translate() maps every byte the RFC allows
+# in labels and messages (0x20-0x7E, 0x0A, 0x0D) to 0x01 and everything else,
+# including the null byte, to 0x00, so one translate + find(0) locates the
+# first byte that ends or breaks a string without leaving C
+_VALID_BYTE_TABLE = bytes(
+    1 if 0x20 <= byte <= 0x7E or byte in (0x0A, 0x0D) else 0 for byte in range(256)
+)
+
+
+def _as_ascii_bytes(string):
+    ''' returns string as bytes (or a bytes-like object) for validation
+    '   returns None if a str holds non-ascii characters
+    '''
+    if type(string) is str:
+        try:
+            return string.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+    if type(string) is memoryview:
+        return string.tobytes()
+    return string
 
 
 def validate_string(string):
     ''' checks that all chars in a string are between ascii 0x20 and 0x7E (inclusive)
     '   or are 0x0A or 0x0D
+    '   a null byte ends the string, but only if there's at least 1 char prior
+    '   accepts str, bytes, bytearray or memoryview
     '   called only within packet classes, not client or server code
     '''
-    bytestring = type(string) is bytes
-    if not bytestring:
-        try:
-            string.encode('ascii')
-        except UnicodeEncodeError:
-            return False
-    for i, char in enumerate(string):
-        if not bytestring:
-            if ord(char) < 0x20 or ord(char) > 0x7E and (ord(char) != 0x0A or ord(char) != 0x0D):
-                if ord(char) == 0x00 and i != 0:
-                    break  # null terminator is allowed, but only if there's at least 1 char prior
-                return False
-        elif (char < 0x20 or char > 0x7E) and (char != 0x0A and char != 0x0D):
-            if char == 0x00 and i != 0:
-                break
-            return False
-    return True
+    data = _as_ascii_bytes(string)
+    if data is None:
+        return False
+    first_invalid = data.translate(_VALID_BYTE_TABLE).find(0)
+    if first_invalid == -1:
+        return True
+    return first_invalid != 0 and data[first_invalid] == 0x00
 
 
 def validate_label(label):
     ''' checks if a label is a valid string & valid length
     '   called only within packet classes, not client or server code
-    '   label: label to check
+    '   label: label to check (str, bytes, bytearray or memoryview)
     '   returns: True if valid, False otherwise
     '''
-    space = ' '
-    if type(label) is bytes:
-        space = 32
-    if len(label) > 32 or len(label) < 1:
-        return False
-    if len(label) < 32 and label.find('\0') == -1:
+    data = _as_ascii_bytes(label)
+    if data is None:
         return False
-    label = strip_null_bytes(label)
-    if label[0] == space or label[-1] == space:
+    if len(data) > LABEL_LENGTH or len(data) < 1:
         return False
-    if not validate_string(label):
+    if len(data) < LABEL_LENGTH and data.find(0) == -1:
+        return False  # short labels must be null terminated
+    data = data.rstrip(b'\x00')
+    if not data or data[0] == 0x20 or data[-1] == 0x20:
         return False
-    return True
+    return validate_string(data)
 
 
 def validate_message(message):
     ''' checks if a msg body conforms to the rfc
+    '   exactly one null byte, at the end, after at least one valid char
+    '   accepts str, bytes, bytearray or memoryview
     '   called only within packet classes, not client or server code
     '''
-    if message[-1] != '\0':
+    data = _as_ascii_bytes(message)
+    if data is None:
         return False
-    if message[:-1].find('\0') != -1:
+    if not len(data) <= MAX_MSG_LENGTH:
         return False
-    if not validate_string(message):
+    if len(data) < 2 or data[-1] != 0x00:
         return False
-    if not len(message) <= MAX_MSG_LENGTH:
-        return False
-    return True
+    # the body before the terminator may not hold a null or any disallowed byte
+    return data.translate(_VALID_BYTE_TABLE).find(0, 0, len(data) - 1) == -1
+
+
+def encode_labels(labels):
+    ''' validates labels (strs) and returns them as one buffer of null-padded
+    '   LABEL_LENGTH byte labels, checking every character in a single pass
+    '   over the joined names rather than label by label; WireLabels are
+    '   copied as they are
+    '   raises IRCException on the first invalid label
+    '''
+    untrusted = [label for label in labels if type(label) is not WireLabel]
+    if untrusted:
+        try:
+            names = [label.encode('ascii').rstrip(b'\x00') for label in untrusted]
+        except UnicodeEncodeError:
+            raise IRCException(IRC_ERR_ILLEGAL_LABEL, 'Non-ascii label')
+        check_label_names(names, untrusted)
+    return b''.join([label_to_bytes(label) for label in labels])
+
+
+def decode_labels(data):
+    ''' validates a buffer of LABEL_LENGTH byte labels, like decoded list
+    '   payloads, and returns the labels as strs without their padding
+    '   raises IRCException on the first invalid label
+    '''
+    names = [label.rstrip(b'\x00') for (label,) in LABEL_STRUCT.iter_unpack(data)]
+    return [name.decode('ascii') for name in check_label_names(names, names)]
+
+
+def check_label_names(names, labels):
+    ''' the shared checks of encode_labels and decode_labels on unpadded names '''
+    for name, label in zip(names, labels):
+        if not 0 < len(name) <= LABEL_LENGTH or name[0] == 0x20 or name[-1] == 0x20:
+            raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {label}')
+    # nulls inside a name, like any disallowed byte, translate to 0
+    if b''.join(names).translate(_VALID_BYTE_TABLE).find(0) != -1:
+        for name, label in zip(names, labels):
+            if name.translate(_VALID_BYTE_TABLE).find(0) != -1:
+                raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {label}')
+    return names
+
+
+def validate_native_label(label):
+    ''' validate_label for a label given as a name (str), the native_labels
+    '   form of the packet classes; WireLabels pass without another look
+    '''
+    return type(label) is WireLabel or validate_label(label_to_bytes(label))
 
 
 def label_to_bytes(label):
     ''' converts a label to 32 byte null-padded bstring
     '   label: label to convert
-    '   returns: byte representation of label
+    '   returns: byte representation of label (a WireLabel's is reused)
     '''
+    if type(label) is WireLabel:
+        return label.wire
     return label.encode('ascii').ljust(32, b'\x00')
 
 
+class WireLabel(str):
+    ''' a validated name that carries its 32 byte wire form in wire
+    '   it is equal to, hashes like and prints as the plain name, so it can
+    '   stand in for one anywhere (dict keys, comparisons, f-strings), while
+    '   the packet classes copy wire instead of encoding and validating again
+    '   make them with wire_label() so each name has one shared instance
+    '''
+
+
+_wire_labels = weakref.WeakValueDictionary()  # interned name -> its WireLabel
+
+
+def wire_label(name):
+    ''' returns the WireLabel for a name, validating and encoding it only if
+    '   no WireLabel for that name is alive yet; the name is interned
+    '   raises IRCException if it is not a valid label
+    '''
+    if type(name) is WireLabel:
+        return name
+    label = _wire_labels.get(name)
+    if label is None:
+        try:
+            wire = label_to_bytes(name)
+        except UnicodeEncodeError:
+            raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {name!r}')
+        if not validate_label(wire):
+            raise IRCException(IRC_ERR_ILLEGAL_LABEL, f'Invalid label: {name!r}')
+        name = sys.intern(strip_null_bytes(name))
+        label = WireLabel(name)
+        label.wire = wire
+        _wire_labels[name] = label
+    return label
+
+
 def strip_null_bytes(string):
     ''' strips null bytes from a string '''
     if type(string) is bytes:
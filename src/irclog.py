@@ -0,0 +1,119 @@
+''' irclog.py
+'   leveled logging for server.py, client.py and friends, built on the
+'   stdlib logging module
+'   call sites pass printf-style arguments (log.debug('told %s', name)), so
+'   nothing is formatted unless the level is on; a disabled debug line costs
+'   one isEnabledFor check
+'   setup() routes every 'irc.*' logger through a QueueHandler: the calling
+'   thread only appends the unformatted record to a bounded queue and a
+'   QueueListener thread formats and writes it, so a slow stdout/stderr
+'   pipe never blocks the event loop; when the queue is full records are
+'   dropped and counted instead
+'   SampledLogger passes one in every N records of very noisy events
+'   (per-recipient fanout lines and the like)
+'''
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+RECORD_QUEUE_MAX = 10000  # records waiting for the writer thread before drops
+LEVELS = ['debug', 'info', 'warning', 'error']
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+root = logging.getLogger('irc')
+root.setLevel(logging.WARNING)  # until setup() says otherwise
+listener = None
+
+
+def get_logger(name):
+    ''' the logger for one module, a child of 'irc' '''
+    return root.getChild(name)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    ''' a QueueHandler that never blocks or formats in the caller's thread '''
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the listener lives in this process, so the record can travel as is
+        # and be formatted over there
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup(level='info', stream=None, queue_max=RECORD_QUEUE_MAX):
+    ''' sends every 'irc.*' record at or above level to stream (stderr by
+    '   default) through the background writer; safe to call again to change
+    '   the level or stream
+    '''
+    global listener
+    shutdown()
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    writer = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    writer.setFormatter(logging.Formatter(LOG_FORMAT))
+    record_queue = queue.Queue(queue_max)
+    root.handlers[:] = [DroppingQueueHandler(record_queue)]
+    root.propagate = False
+    listener = logging.handlers.QueueListener(record_queue, writer)
+    listener.start()
+
+
+def shutdown():
+    ''' writes out whatever is still queued and stops the writer thread '''
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def dropped():
+    ''' records lost to a full queue since setup() '''
+    return sum(getattr(handler, 'dropped', 0) for handler in root.handlers)
+
+
+atexit.register(shutdown)
+
+
+class SampledLogger:
+    ''' logs one in every `every` calls, marking the line with the rate
+    '   the level is checked before anything else, so a sampled line below
+    '   the level costs no more than a plain one
+    '''
+
+    def __init__(self, logger, every):
+        self.logger = logger
+        self.every = every
+        self.seen = 0
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        self.seen += 1
+        if self.seen >= self.every:
+            self.seen = 0
+            self.logger.log(level, msg + ' (1 in %d)', *args, self.every)
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, *args)
@@ -0,0 +1,269 @@
+''' metrics.py
+'   in-process counters, gauges and fixed-bucket histograms for the server,
+'   rendered in the Prometheus text exposition format
+'   recording is plain attribute arithmetic on objects created up front
+'   (a histogram observation is one bisect over its bucket bounds), so the
+'   registry can stay on in production; rendering and serving happen on the
+'   admin thread and only read what the event loop writes
+'   AdminServer answers GET /metrics (and any route added to it later) on
+'   a localhost-only port from a daemon thread
+'''
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import irclog
+from conf import *
+
+log = irclog.get_logger('metrics')
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    ''' a count that only goes up '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge:
+    ''' a value that goes up and down, or is read from func when rendered '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=None, func=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.labels, self.func() if self.func is not None else self.value
+
+
+class Histogram:
+    ''' counts observations into fixed buckets
+    '   buckets: ascending upper bounds; counts[i] holds the observations
+    '   above buckets[i - 1] and at most buckets[i], counts[-1] those above
+    '   every bound, and the cumulative Prometheus buckets are summed up only
+    '   when rendered
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self):
+        counts = list(self.counts)  # one consistent-ish copy while the loop runs
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield self.name + '_bucket', {**self.labels, 'le': format_value(float(bound))}, cumulative
+        yield self.name + '_sum', self.labels, self.sum
+        yield self.name + '_count', self.labels, cumulative
+
+
+class Registry:
+    ''' the metrics of one process, in registration order
+    '   metrics sharing a name (with different labels) are rendered as one
+    '   family under a single HELP and TYPE line
+    '''
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()  # registration may race a scrape
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, func=None, **labels):
+        return self.register(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help, buckets, **labels):
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def render(self):
+        ''' the whole registry in the Prometheus text format '''
+        with self.lock:
+            metrics = list(self.metrics)
+        families = {}
+        for metric in metrics:
+            families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name, family in families.items():
+            lines.append(f'# HELP {name} {family[0].help}')
+            lines.append(f'# TYPE {name} {family[0].kind}')
+            for metric in family:
+                for sample_name, labels, value in metric.samples():
+                    lines.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class ServerMetrics:
+    ''' everything Server records, created up front so the hot paths only
+    '   index lists and bump attributes
+    '   handler_seconds and packets_received are indexed by opcode (0-255);
+    '   opcodes missing from opcode_names share the opcode="other" entries
+    '''
+
+    def __init__(self, registry=None, opcode_names=IRC_OPCODE_NAMES):
+        self.registry = registry = registry if registry is not None else Registry()
+        handlers = {}
+        received = {}
+        for opcode, name in list(opcode_names.items()) + [(None, 'other')]:
+            handlers[opcode] = registry.histogram('irc_handler_seconds',
+                                                  'time spent handling one packet',
+                                                  LATENCY_BUCKETS, opcode=name)
+            received[opcode] = registry.counter('irc_packets_received_total',
+                                                'packets read from clients', opcode=name)
+        self.handler_seconds = [handlers.get(opcode, handlers[None]) for opcode in range(256)]
+        self.packets_received = [received.get(opcode, received[None]) for opcode in range(256)]
+        self.bytes_received = registry.counter('irc_received_bytes_total',
+                                               'bytes read from client sockets')
+        self.bytes_sent = registry.counter('irc_sent_bytes_total', 'bytes written to client sockets')
+        self.relayed_bytes = registry.counter('irc_relayed_bytes_total',
+                                              'message bytes queued for recipients, '
+                                              + 'counted once per recipient')
+        self.room_fanout = registry.histogram('irc_room_fanout_recipients',
+                                              'recipients of each room message', FANOUT_BUCKETS)
+        self.private_messages = registry.counter('irc_private_messages_total',
+                                                 'private messages relayed')
+        self.undeliverable = registry.counter('irc_undeliverable_messages_total',
+                                              'messages to rooms or users that do not exist')
+        self.handshake_seconds = registry.histogram('irc_handshake_seconds',
+                                                    'time from accept to a complete hello',
+                                                    LATENCY_BUCKETS)
+        self.handshake_failures = registry.counter('irc_handshake_failures_total',
+                                                   'connections closed before or at their hello')
+        self.keepalives_sent = registry.counter('irc_keepalives_sent_total',
+                                                'keepalives sent to idle users')
+        self.keepalive_timeouts = registry.counter('irc_keepalive_timeouts_total',
+                                                   'users dropped for missing keepalives')
+        self.slow_consumer_drops = registry.counter('irc_slow_consumer_drops_total',
+                                                    'packets dropped for slow consumers')
+        self.slow_consumer_disconnects = registry.counter('irc_slow_consumer_disconnects_total',
+                                                          'slow consumers disconnected')
+        self.errors = {code: registry.counter('irc_errors_sent_total',
+                                              'connections closed with an error packet',
+                                              code=f'{code:#x}')
+                       for code in IRC_ERR_VALUES}
+        self.lost_connections = registry.counter('irc_lost_connections_total',
+                                                 'connections that died without an error packet')
+
+    def watch_server(self, server):
+        ''' adds gauges read from the server's state at scrape time '''
+        registry = self.registry
+        registry.gauge('irc_users', 'users past hello', lambda: len(server.users))
+        registry.gauge('irc_pending_handshakes', 'connections waiting on a hello',
+                       lambda: len(server.pending))
+        registry.gauge('irc_rooms', 'rooms', lambda: len(server.rooms))
+        registry.gauge('irc_outbound_bytes', 'bytes queued for all users',
+                       lambda: sum(user.outbound_bytes for user in list(server.connections.values())))
+        registry.gauge('irc_paused_readers', 'users whose input is paused by backpressure',
+                       lambda: sum(user.reading_paused for user in list(server.connections.values())))
+        if server.room_log is not None:
+            registry.gauge('irc_room_log_dropped', 'room log records dropped on a full queue',
+                           lambda: server.room_log.dropped)
+        registry.gauge('irc_log_records_dropped', 'diagnostic log records dropped on a full queue',
+                       irclog.dropped)
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+    ''' answers GET requests from AdminServer.routes '''
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = self.server.routes.get(url.path)
+        if route is None:
+            self.send_error(404)
+            return
+        try:
+            content_type, body = route(parse_qs(url.query))
+        except Exception as e:  # a broken route must not take the admin thread down
+            log.error('admin route %s failed: %s', url.path, e)
+            self.send_error(500)
+            return
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('admin %s: ' + format, self.address_string(), *args)
+
+
+class AdminServer(ThreadingHTTPServer):
+    ''' a localhost-only HTTP endpoint served from a daemon thread
+    '   routes: path -> callable(query dict) returning (content type, body)
+    '''
+    daemon_threads = True
+
+    def __init__(self, registry, port=ADMIN_PORT, host='127.0.0.1'):
+        super().__init__((host, port), AdminHandler)
+        self.routes = {'/metrics': lambda query: (PROMETHEUS_CONTENT_TYPE, registry.render())}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='admin', daemon=True)
+        self.thread.start()
+        log.info('admin endpoint on http://%s:%d/metrics', *self.server_address[:2])
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
@@ -0,0 +1,149 @@
+''' profiler.py
+'   opt-in sampling profiler for the server's event loop
+'   while running, an ITIMER_PROF timer raises SIGPROF every interval seconds
+'   of CPU time; Python runs the handler on the loop thread at the next
+'   bytecode boundary, so it sees the frame that was actually executing
+'   (a sampler thread would only get the GIL while the loop sits in a
+'   system call, and never see the handlers) and the loop pays one stack
+'   walk per sample; since the timer counts CPU time, idle time in select
+'   is not sampled
+'   stacks are written every write_interval seconds (and when stopped) to
+'   path in the collapsed format flamegraph.pl, speedscope and friends
+'   read: root;caller;callee <samples>
+'   the root frame of each stack is the opcode whose handler was running,
+'   as read from current_opcode (handler:sendmsg, ...), or "loop" outside
+'   any handler, which makes the per-opcode breakdown a sum over roots
+'   toggled with SIGUSR2 (install_signal) or the admin endpoint
+'   (admin_route: GET /profile?action=start|stop, plain /profile reports)
+'''
+
+import os
+import signal
+import threading
+from collections import Counter
+
+from conf import *
+from irclog import get_logger
+
+log = get_logger('profiler')
+
+
+class SamplingProfiler:
+    ''' samples the stack of the main thread, which has to create it
+    '   current_opcode: callable returning the opcode being handled or None
+    '   opcode_names: opcode -> name for the root frames
+    '''
+
+    def __init__(self, path, interval=PROFILE_INTERVAL, write_interval=PROFILE_WRITE_INTERVAL,
+                 current_opcode=None, opcode_names=IRC_OPCODE_NAMES):
+        self.path = path
+        self.interval = interval
+        self.write_interval = write_interval
+        self.current_opcode = current_opcode or (lambda: None)
+        self.opcode_names = opcode_names
+        # only ever added to by the handler; readers copy it in one C call,
+        # so no lock (which the handler could deadlock on) is needed
+        self.counts = Counter()  # collapsed stack -> samples
+        self.frame_names = {}  # code object -> frame name, built as seen
+        self.running = False
+        self.stopping = threading.Event()
+        self.writer = None  # thread writing the file every write_interval
+        self.toggle_lock = threading.Lock()  # start/stop come from signals and the admin thread
+        signal.signal(signal.SIGPROF, self.sample)
+
+    def start(self):
+        ''' starts sampling from a clean slate; no-op if already running '''
+        with self.toggle_lock:
+            if self.running:
+                return
+            self.counts = Counter()
+            self.running = True
+            self.stopping.clear()
+            self.writer = threading.Thread(target=self.write_periodically, name='profiler',
+                                           daemon=True)
+            self.writer.start()
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        log.info('profiling every %ss of CPU time into %s', self.interval, self.path)
+
+    def stop(self):
+        ''' stops sampling and writes out what was collected '''
+        with self.toggle_lock:
+            if not self.running:
+                return
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            self.running = False
+            self.stopping.set()
+            self.writer.join()
+            self.writer = None
+            self.write()
+        log.info('profile written to %s', self.path)
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def write_periodically(self):
+        while not self.stopping.wait(self.write_interval):
+            self.write()
+
+    def sample(self, signum, frame):
+        ''' the SIGPROF handler; frame is where the loop thread was '''
+        if not self.running:
+            return  # a tick that was already pending when the timer stopped
+        opcode = self.current_opcode()
+        names = []
+        frame_names = self.frame_names
+        while frame is not None:
+            code = frame.f_code
+            name = frame_names.get(code)
+            if name is None:
+                name = frame_names[code] = (f'{code.co_name} '
+                                            + f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            names.append(name)
+            frame = frame.f_back
+        names.append('loop' if opcode is None else f'handler:{self.opcode_names.get(opcode, hex(opcode))}')
+        self.counts[';'.join(reversed(names))] += 1
+
+    def collapsed(self):
+        ''' the samples so far in the collapsed stack format '''
+        counts = self.counts.copy()
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(counts.items()))
+
+    def write(self):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as output:
+            output.write(self.collapsed())
+        os.replace(temporary_path, self.path)  # readers never see half a profile
+
+    def breakdown(self):
+        ''' [(root frame, samples, estimated CPU seconds)], most samples first '''
+        roots = Counter()
+        for stack, count in self.counts.copy().items():
+            roots[stack.split(';', 1)[0]] += count
+        return [(root, count, count * self.interval) for root, count in roots.most_common()]
+
+    def report(self):
+        ''' a plain text status and per-opcode breakdown '''
+        breakdown = self.breakdown()
+        total = sum(count for _, count, _ in breakdown)
+        lines = [f'profiler {"running" if self.running else "stopped"}, {total} samples every '
+                 + f'{self.interval}s of CPU time, written to {self.path}',
+                 f'{"root":<28} {"samples":>8} {"~cpu s":>9} {"share":>7}']
+        for root, count, seconds in breakdown:
+            lines.append(f'{root:<28} {count:8d} {seconds:9.3f} {count / total:7.1%}')
+        return '\n'.join(lines) + '\n'
+
+    def admin_route(self, query):
+        ''' GET /profile?action=start|stop|toggle for metrics.AdminServer '''
+        action = query.get('action', [''])[0]
+        if action in ('start', 'stop', 'toggle'):
+            getattr(self, action)()
+        return 'text/plain; charset=utf-8', self.report()
+
+    def install_signal(self, signum=signal.SIGUSR2):
+        ''' toggles the profiler whenever signum arrives; the toggle runs on a
+        '   thread of its own, since the handler may interrupt start or stop
+        '''
+        signal.signal(signum, lambda received, frame: threading.Thread(target=self.toggle).start())
@@ -0,0 +1,414 @@
+''' replay.py
+'   plays traffic recorded with server.py --capture-file back against a
+'   local server (started here unless --no-server), for regression runs
+'   every captured connection is reopened and sent its recorded recv chunks
+'   in the recorded order across all connections: at the original pace
+'   (--speed 2 for twice as fast) or, with --fast, as fast as the server
+'   takes them, except that around every hello, join, leave and hangup the
+'   replay waits until the server has read everything sent before, so no
+'   message overtakes the membership change it was recorded behind and
+'   the server does the same work every time; captures of several cluster
+'   workers are merged on their wall clock start times (the --fast ordering
+'   assumes a single process server, though)
+'   the sent streams are split into packets and the responses decoded with
+'   the conf.py codec, and both are counted by opcode; responses are read
+'   all along so the server never sees a slow consumer
+'   --runs replays several times, each against a fresh server, checks they
+'   all got the same responses and reports the fastest
+'   --save writes the results as JSON; --compare checks them against such a
+'   file from a replay in the same mode and exits with status 1 if
+'   the TELLMSG, TELLPRIVMSG or error counts differ, i.e. the server
+'   behaves differently, or, for --fast runs, packets/s dropped by more than
+'   --threshold
+'   usage: python replay.py traffic.cap [traffic.cap.worker1 ...] [--fast]
+'          [--runs 3] [--save replay.json] [--compare replay.json --threshold 0.1]
+'''
+
+import argparse
+import json
+import os
+import platform
+import selectors
+import socket
+import subprocess
+import sys
+from time import monotonic, time
+
+from bench_load import wait_for_port
+from capture import CAPTURE_CLOSE, CAPTURE_DATA, CAPTURE_OPEN, read_capture
+from conf import *
+
+MAX_QUEUED_BYTES = 4 * 1024 * 1024  # unsent replay bytes before --fast waits on the server
+POLL_EVERY = 64  # records sent between reads in --fast mode
+DETERMINISTIC = ['tellmsg', 'tellprivmsg', 'err']  # response counts that must match a baseline
+MEMBERSHIP_OPCODES = {IRC_HELLO, IRC_JOINROOM, IRC_LEAVEROOM}  # --fast keeps these in order
+SYNC_NAME = 'replaysync'  # the user --fast checks the server's progress with
+
+
+class ReplayConnection:
+    ''' one recorded connection: its socket, what is left to send, and
+    '   decoders for both directions
+    '''
+
+    def __init__(self, key):
+        self.key = key  # (capture index, connection id)
+        self.sock = None
+        self.outbound = bytearray()
+        self.sent_decoder = FrameDecoder(max_length=None)
+        self.decoder = FrameDecoder(max_length=None)
+        self.closing = False
+
+
+def load_events(paths):
+    ''' merges captures into [(seconds after the first record, kind, key, data)] '''
+    events = []
+    for index, path in enumerate(paths):
+        started, records = read_capture(path)
+        for order, (kind, connection_id, elapsed, data) in enumerate(records):
+            events.append((started + elapsed / 1e9, index, order, kind, (index, connection_id), data))
+    events.sort(key=lambda event: event[:3])
+    first = events[0][0] if events else 0
+    return [(at - first, kind, key, data) for at, _, _, kind, key, data in events]
+
+
+class Replayer:
+    ''' replays events against address; speed None means as fast as possible,
+    '   with the server brought up to date around membership changes
+    '''
+
+    def __init__(self, address, speed):
+        self.address = address
+        self.speed = speed
+        self.sel = selectors.DefaultSelector()
+        self.connections = {}  # key -> ReplayConnection
+        self.queued_bytes = 0
+        self.sent = {}  # opcode name -> packets
+        self.received = {}  # opcode name -> packets
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.last_received = None  # monotonic time of the last response
+        self.responses = 0  # packets received, keepalives aside
+        self.probe = None  # connection of our own that sync() messages itself over
+        self.probe_replies = 0
+        self.unsynced = False  # sent anything since the last sync()
+
+    def connect(self, connection):
+        connection.sock = socket.create_connection(self.address)
+        # no Nagle: a chunk held back for an ACK could fall behind a sync()
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.sock.setblocking(False)
+        self.sel.register(connection.sock, selectors.EVENT_READ, connection)
+
+    def open(self, key):
+        connection = self.connections[key] = ReplayConnection(key)
+        try:
+            self.connect(connection)
+        except OSError:
+            self.connect_failures += 1
+            del self.connections[key]
+
+    def count_sent(self, key, data):
+        ''' counts and returns the opcodes of the packets data completes '''
+        connection = self.connections.get(key)
+        if connection is None:
+            return []
+        connection.sent_decoder.feed(data)
+        opcodes = [frame[0] for frame in connection.sent_decoder]
+        for opcode in opcodes:
+            name = IRC_OPCODE_NAMES.get(opcode, hex(opcode))
+            self.sent[name] = self.sent.get(name, 0) + 1
+        return opcodes
+
+    def send(self, key, data):
+        connection = self.connections.get(key)
+        if connection is None or connection.sock is None:
+            return  # never connected, or dropped by the server
+        connection.outbound += data
+        self.queued_bytes += len(data)
+        self.unsynced = True
+        self.flush(connection)
+
+    def close(self, key):
+        ''' hangs up once everything is sent, but only the sending half: the
+        '   server still delivers what it had for the connection (a few bytes
+        '   may be held back by Nagle's algorithm) before closing its end
+        '''
+        connection = self.connections.get(key)
+        if connection is None:
+            return
+        connection.closing = True
+        self.unsynced = True
+        if not connection.outbound:
+            self.hang_up(connection)
+
+    def hang_up(self, connection):
+        try:
+            connection.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.drop(connection)
+
+    def flush(self, connection):
+        try:
+            sent = connection.sock.send(connection.outbound)
+            del connection.outbound[:sent]
+            self.queued_bytes -= sent
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop(connection)
+            return
+        if connection.closing and not connection.outbound:
+            self.hang_up(connection)
+            if connection.sock is None:
+                return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.outbound else 0)
+        self.sel.modify(connection.sock, events, connection)
+
+    def drop(self, connection, hung_up=True):
+        if connection.sock is None:
+            return
+        if connection is self.probe:
+            raise ConnectionResetError('server dropped the sync connection')
+        if hung_up:
+            self.disconnects += 1
+        self.queued_bytes -= len(connection.outbound)
+        connection.outbound.clear()
+        self.sel.unregister(connection.sock)
+        connection.sock.close()
+        connection.sock = None
+        del self.connections[connection.key]
+
+    def receive(self, connection):
+        try:
+            if connection.decoder.recv_from(connection.sock) == 0:
+                raise ConnectionResetError('server closed the connection')
+        except BlockingIOError:
+            return
+        except OSError:
+            self.drop(connection, hung_up=not connection.closing)
+            return
+        if connection is self.probe:
+            for frame in connection.decoder:
+                if frame[0] == IRC_TELLPRIVMSG:
+                    self.probe_replies += 1
+                elif frame[0] == IRC_KEEPALIVE:
+                    connection.outbound += IrcPacketKeepalive().to_bytes()
+                    self.flush(connection)
+            return
+        for frame in connection.decoder:
+            if frame[0] != IRC_KEEPALIVE:  # sent on the server's clock, not in reply to the replay
+                self.last_received = monotonic()
+                self.responses += 1
+            name = IRC_OPCODE_NAMES.get(frame[0], hex(frame[0]))
+            self.received[name] = self.received.get(name, 0) + 1
+
+    def poll(self, timeout):
+        for key, mask in self.sel.select(timeout):
+            connection = key.data
+            if mask & selectors.EVENT_WRITE and connection.sock is not None:
+                self.flush(connection)
+            if mask & selectors.EVENT_READ and connection.sock is not None:
+                self.receive(connection)
+
+    def sync(self):
+        ''' returns once the server has handled everything sent so far
+        '   a message the probe sends itself comes back at the end of the loop
+        '   iteration that read it, and everything sent before it was readable
+        '   by then; but the server may not have read all of it (a recv is at
+        '   most RECV_BUFSIZE, and reading from users with a full outbound
+        '   queue is paused), so probes go out until one comes back without
+        '   any replayed connection having heard from the server meanwhile
+        '''
+        if not self.unsynced:
+            return
+        while self.queued_bytes > 0:
+            self.poll(0.05)
+        if self.probe is None:
+            self.probe = ReplayConnection(None)
+            self.connect(self.probe)
+            self.probe.outbound += IrcPacketHello(SYNC_NAME).to_bytes()
+        while True:
+            expected = self.probe_replies + 1
+            responses = self.responses
+            self.probe.outbound += IrcPacketSendPrivMsg('sync', SYNC_NAME, SYNC_NAME).to_bytes()
+            self.flush(self.probe)
+            while self.probe_replies < expected:
+                self.poll(TIMEOUT)
+            if self.responses == responses:
+                break
+        self.unsynced = False
+
+    def run(self, events, drain):
+        ''' replays events, then reads until the server has been quiet for
+        '   drain seconds; returns the seconds from the first record to the
+        '   last response other than a keepalive or, in --fast mode, until the
+        '   server had read the last record
+        '''
+        fast = self.speed is None
+        started = monotonic()
+        for count, (at, kind, key, data) in enumerate(events):
+            if not fast:
+                due = started + at / self.speed
+                while monotonic() < due:
+                    self.poll(due - monotonic())
+            else:
+                if count % POLL_EVERY == 0:
+                    self.poll(0)
+                while self.queued_bytes > MAX_QUEUED_BYTES:
+                    self.poll(0.05)
+            if kind == CAPTURE_OPEN:
+                self.open(key)
+            elif kind == CAPTURE_DATA:
+                opcodes = self.count_sent(key, data)
+                ordered = fast and not MEMBERSHIP_OPCODES.isdisjoint(opcodes)
+                if ordered:
+                    self.sync()
+                self.send(key, data)
+                if ordered:
+                    self.sync()
+            elif kind == CAPTURE_CLOSE:
+                if fast:
+                    self.sync()
+                self.close(key)
+                if fast:
+                    self.sync()
+        if fast:
+            self.sync()
+            seconds = monotonic() - started
+        while self.queued_bytes > 0:
+            self.poll(0.05)
+        quiet_since = monotonic()
+        while monotonic() - max(quiet_since, self.last_received or 0) < drain:
+            self.poll(drain / 10)
+        if not fast:
+            seconds = (self.last_received or monotonic()) - started
+        for connection in list(self.connections.values()):
+            self.drop(connection, hung_up=False)
+        if self.probe is not None:
+            self.sel.unregister(self.probe.sock)
+            self.probe.sock.close()  # hanging up first leaves the server nothing in TIME_WAIT
+            self.probe = None
+        return seconds
+
+
+def compare(results, baseline, threshold):
+    ''' returns a line for every difference that fails the gate; both runs
+    '   have to be in the same mode (and at the same speed)
+    '''
+    failures = []
+    for name in DETERMINISTIC:
+        old, new = baseline['received'].get(name, 0), results['received'].get(name, 0)
+        if old != new:
+            failures.append(f'{name} responses: {old} -> {new}')
+    if results['mode'] == 'fast':
+        old, new = baseline['packets_per_s'], results['packets_per_s']
+        if new < old * (1 - threshold):
+            failures.append(f'throughput: {old:.0f} -> {new:.0f} packets/s')
+    return failures
+
+
+def replay_once(args, events):
+    ''' one replay, against a fresh server unless --no-server; returns the
+    '   Replayer and its seconds
+    '''
+    server = None
+    if not args.no_server:
+        server_log = open(os.devnull, 'w')
+        server = subprocess.Popen([sys.executable, 'server.py', '--admin-port', '0'] + args.server_arg,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  stdout=server_log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(args.port, TIMEOUT)
+        replayer = Replayer(('127.0.0.1', args.port), None if args.fast else args.speed)
+        return replayer, replayer.run(events, args.drain)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay captured 594irc traffic')
+    parser.add_argument('captures', nargs='+', help='capture files, e.g. one per cluster worker')
+    parser.add_argument('--fast', action='store_true', help='send as fast as the server reads')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='multiple of the recorded pace (ignored with --fast)')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='replays, each against a fresh server; the fastest one counts')
+    parser.add_argument('--drain', type=float, default=1.0,
+                        help='seconds without responses that end the replay')
+    parser.add_argument('--port', type=int, default=IRC_SERVER_PORT)
+    parser.add_argument('--no-server', action='store_true',
+                        help='replay against a server that is already running on --port')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='extra argument for server.py, repeatable')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from --save to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction of packets/s a --fast run may lose against the baseline')
+    args = parser.parse_args()
+    if not args.no_server and args.port != IRC_SERVER_PORT:
+        parser.error('server.py always listens on IRC_SERVER_PORT; use --no-server for other ports')
+    if args.no_server and args.runs > 1:
+        parser.error('--runs needs a fresh server for every replay, so not --no-server')
+    events = load_events(args.captures)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        if baseline['mode'] != ('fast' if args.fast else 'paced') \
+                or (not args.fast and baseline['speed'] != args.speed):
+            parser.error(f'{args.compare} is a {baseline["mode"]} run, replay the same way to compare')
+    failures = []
+    run_seconds = []
+    for run in range(args.runs):
+        replayer, seconds = replay_once(args, events)
+        counts = [replayer.received.get(name, 0) for name in DETERMINISTIC]
+        if not run_seconds:
+            first_counts = counts
+        elif counts != first_counts:
+            failures.append(f'run {run + 1} got other TELLMSG/TELLPRIVMSG/error counts than run 1')
+        if not run_seconds or seconds < min(run_seconds):
+            best = replayer
+        run_seconds.append(seconds)
+    seconds = min(run_seconds)
+    packets = sum(best.sent.values())
+    results = {
+        'mode': 'fast' if args.fast else 'paced',
+        'speed': None if args.fast else args.speed,
+        'captured_seconds': events[-1][0] if events else 0,
+        'connections': sum(kind == CAPTURE_OPEN for _, kind, _, _ in events),
+        'sent': best.sent,
+        'received': best.received,
+        'seconds': seconds,
+        'run_seconds': run_seconds,
+        'packets_per_s': packets / seconds if seconds > 0 else 0,
+        'connect_failures': best.connect_failures,
+        'disconnects': best.disconnects,
+    }
+    print(f'{results["mode"]} replay of {results["connections"]} connections, {packets} packets '
+          + f'in {seconds:.3f}s ({results["packets_per_s"]:.0f} packets/s), '
+          + f'{best.received.get("err", 0)} errors, {best.disconnects} disconnects')
+    if args.runs > 1:
+        print('runs: ' + ', '.join(f'{run:.3f}s' for run in run_seconds))
+    for name in sorted(set(best.sent) | set(best.received)):
+        print(f'{name:<20} sent {best.sent.get(name, 0):>10}  '
+              + f'received {best.received.get(name, 0):>10}')
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump({'time': time(), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'captures': args.captures,
+                       'results': results}, output, indent=2)
+        print(f'wrote {args.save}')
+    if baseline is not None:
+        failures += compare(results, baseline, args.threshold)
+    for line in failures:
+        print(f'REGRESSION {line}')
+    if failures:
+        sys.exit(1)
+    if baseline is not None:
+        print('matches the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+''' roomlog.py
+'   optional on-disk retention of room traffic for server.py, enabled with
+'   `python server.py --log-dir DIR`
+'   every room gets a directory (its name, hex encoded) of append-only
+'   segment files holding the TELLMSG frames relayed to it, in order, each
+'   behind a record header of frame length, sequence number and unix time.
+'   Next to every segment a sparse index file maps a record every
+'   index_interval bytes to its offset, so reads by sequence number or time
+'   bisect the index and scan at most index_interval bytes of an mmap
+'   instead of loading whole files.
+'   The server only puts (room, frame) on a bounded queue; a writer thread
+'   batches whatever is queued into one os.writev per room, fsyncs every
+'   fsync_interval seconds, rolls segments over at segment_bytes and drops
+'   the oldest segments past retention_bytes or retention_age seconds.
+'   usage: python roomlog.py DIR ROOM [--since-seq N | --since-time T] [--limit N]
+'''
+
+import argparse
+import bisect
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+from conf import *
+from irclog import get_logger
+
+log = get_logger('roomlog')
+
+RECORD_STRUCT = struct.Struct('>IQd')  # frame length, sequence number, unix time
+INDEX_STRUCT = struct.Struct('>QdQ')  # sequence number, unix time, offset in segment
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+
+
+class Segment:
+    ''' one append-only file of a room's log and its sparse index
+    '   size counts only whole records, so readers never see a torn one
+    '''
+
+    def __init__(self, path, first_seq):
+        self.path = path
+        self.index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        self.first_seq = first_seq
+        self.size = 0
+        self.index = []  # (seq, time, offset) tuples, ascending
+        self.last_seq = None
+        self.last_time = None
+
+    def recover(self):
+        ''' rebuilds the in-memory state of a segment found on disk, cutting
+        '   off a record that was only partly written when the server died
+        '''
+        file_size = os.path.getsize(self.path)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as index_file:
+                data = index_file.read()
+            whole = len(data) - len(data) % INDEX_STRUCT.size
+            self.index = [entry for entry in INDEX_STRUCT.iter_unpack(data[:whole])
+                          if entry[2] < file_size]
+        offset = self.index[-1][2] if self.index else 0
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(offset)
+            tail = log_file.read()
+        position = 0
+        while position + RECORD_STRUCT.size <= len(tail):
+            length, seq, timestamp = RECORD_STRUCT.unpack_from(tail, position)
+            if position + RECORD_STRUCT.size + length > len(tail):
+                break
+            self.last_seq, self.last_time = seq, timestamp
+            position += RECORD_STRUCT.size + length
+        self.size = offset + position
+        if self.size < file_size:
+            log.warning('truncating torn record in %s', self.path)
+            os.truncate(self.path, self.size)
+
+
+class RoomFiles:
+    ''' the segments of one room's log, oldest first; the last one is
+    '   appended to through fd and index_fd, owned by the writer thread
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []
+        self.next_seq = 0
+        self.fd = None
+        self.index_fd = None
+        self.next_index_offset = 0
+        self.dirty = False  # written since the last fsync
+
+
+class RoomLog:
+    ''' segmented, append-only log of the frames relayed to each room
+    '   append() is the only call made from the server's loop and never
+    '   blocks; when the queue holds queue_max records, records are dropped
+    '   and counted in dropped rather than stalling fanout
+    '''
+
+    def __init__(self, directory, fsync_interval=LOG_FSYNC_INTERVAL, segment_bytes=LOG_SEGMENT_BYTES,
+                 retention_bytes=None, retention_age=None, index_interval=LOG_INDEX_INTERVAL,
+                 queue_max=LOG_QUEUE_MAX):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        self.index_interval = index_interval
+        self.rooms = {}  # room name -> RoomFiles
+        self.lock = threading.Lock()  # guards rooms and every room's segments
+        self.queue = queue.Queue(queue_max)
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='roomlog', daemon=True)
+        self.thread.start()
+
+    def append(self, room_name, frame):
+        ''' hands a relayed frame (bytes or tuple of buffers) to the writer '''
+        try:
+            self.queue.put_nowait((room_name, frame, time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        ''' writes and fsyncs everything queued, then stops the writer '''
+        self.queue.put(None)
+        self.thread.join()
+
+    def room_files(self, room_name):
+        ''' returns the RoomFiles of a room, loading them from disk the first time '''
+        with self.lock:
+            files = self.rooms.get(room_name)
+            if files is None:
+                directory = os.path.join(self.directory, room_name.encode('ascii').hex())
+                files = self.rooms[room_name] = RoomFiles(directory)
+                if os.path.isdir(directory):
+                    for name in sorted(os.listdir(directory)):
+                        if name.endswith(SEGMENT_SUFFIX):
+                            segment = Segment(os.path.join(directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+                            segment.recover()
+                            files.segments.append(segment)
+                    seqs = [segment.last_seq for segment in files.segments if segment.last_seq is not None]
+                    files.next_seq = max(seqs) + 1 if seqs else 0
+            return files
+
+    # writer thread
+
+    def run(self):
+        next_fsync = time.monotonic() + self.fsync_interval
+        running = True
+        while running:
+            batch, running = self.take_batch(max(0, next_fsync - time.monotonic()))
+            by_room = {}
+            for room_name, frame, timestamp in batch:
+                by_room.setdefault(room_name, []).append((frame, timestamp))
+            for room_name, records in by_room.items():
+                try:
+                    self.write_records(self.room_files(room_name), records)
+                except OSError as e:
+                    log.error('failed to write %s: %s', room_name, e)
+            if not running or time.monotonic() >= next_fsync:
+                self.sync_and_expire()
+                next_fsync = time.monotonic() + self.fsync_interval
+        for files in list(self.rooms.values()):
+            self.close_active(files)
+
+    def take_batch(self, timeout):
+        ''' waits up to timeout for a record, then takes whatever else is
+        '   already queued; returns (records, False once close() was called)
+        '''
+        batch = []
+        try:
+            item = self.queue.get(timeout=timeout)
+            while len(batch) < LOG_BATCH_RECORDS:
+                if item is None:
+                    return batch, False
+                batch.append(item)
+                item = self.queue.get_nowait()
+            self.queue.put(item)  # batch is full; leave the rest for next time
+        except queue.Empty:
+            pass
+        return batch, True
+
+    def open_segment(self, files):
+        ''' starts a new segment at the room's next sequence number '''
+        os.makedirs(files.directory, exist_ok=True)
+        path = os.path.join(files.directory, f'{files.next_seq:020d}{SEGMENT_SUFFIX}')
+        segment = Segment(path, files.next_seq)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        files.fd = os.open(segment.path, flags, 0o644)
+        files.index_fd = os.open(segment.index_path, flags, 0o644)
+        files.next_index_offset = 0
+        with self.lock:
+            files.segments.append(segment)
+
+    def close_active(self, files):
+        if files.fd is None:
+            return
+        if files.dirty:
+            os.fsync(files.fd)
+            os.fsync(files.index_fd)
+            files.dirty = False
+        os.close(files.fd)
+        os.close(files.index_fd)
+        files.fd = files.index_fd = None
+
+    def write_records(self, files, records):
+        ''' appends records to the room's active segment with one writev per
+        '   segment touched, rolling over to a new segment when it is full
+        '''
+        if files.fd is None:
+            if files.segments and files.segments[-1].size < self.segment_bytes:
+                segment = files.segments[-1]  # resume the newest segment
+                flags = os.O_WRONLY | os.O_APPEND
+                files.fd = os.open(segment.path, flags)
+                files.index_fd = os.open(segment.index_path, flags | os.O_CREAT, 0o644)
+                files.next_index_offset = segment.index[-1][2] + self.index_interval if segment.index else 0
+            else:
+                self.open_segment(files)
+        position = 0
+        while position < len(records):
+            segment = files.segments[-1]
+            offset = segment.size
+            buffers, index_entries = [], []
+            seq = files.next_seq
+            while position < len(records) and (offset == segment.size or offset < self.segment_bytes):
+                frame, timestamp = records[position]
+                parts = frame if type(frame) is tuple else (frame,)
+                if offset >= files.next_index_offset:
+                    index_entries.append(INDEX_STRUCT.pack(seq, timestamp, offset))
+                    files.next_index_offset = offset + self.index_interval
+                buffers.append(RECORD_STRUCT.pack(frame_length(frame), seq, timestamp))
+                buffers.extend(parts)
+                offset += RECORD_STRUCT.size + frame_length(frame)
+                seq += 1
+                position += 1
+            write_all(files.fd, buffers)
+            if index_entries:
+                write_all(files.index_fd, index_entries)
+            files.dirty = True
+            with self.lock:  # publish the new records to readers
+                segment.index.extend(INDEX_STRUCT.unpack(entry) for entry in index_entries)
+                segment.size = offset
+                segment.last_seq, segment.last_time = seq - 1, records[position - 1][1]
+                files.next_seq = seq
+            if offset >= self.segment_bytes:
+                self.close_active(files)
+                if position < len(records):
+                    self.open_segment(files)
+
+    def sync_and_expire(self):
+        ''' fsyncs every room written since the last call and applies retention '''
+        now = time.time()
+        with self.lock:
+            rooms = list(self.rooms.values())
+        for files in rooms:
+            try:
+                if files.dirty and files.fd is not None:
+                    os.fsync(files.fd)
+                    os.fsync(files.index_fd)
+                    files.dirty = False
+                self.expire_segments(files, now)
+            except OSError as e:
+                log.error('failed to sync %s: %s', files.directory, e)
+
+    def expire_segments(self, files, now):
+        ''' removes the oldest segments past the size or age limit; the
+        '   segment being appended to is always kept
+        '''
+        total = sum(segment.size for segment in files.segments)
+        while len(files.segments) > 1:
+            oldest = files.segments[0]
+            too_big = self.retention_bytes is not None and total > self.retention_bytes
+            too_old = self.retention_age is not None and oldest.last_time is not None \
+                and oldest.last_time < now - self.retention_age
+            if not (too_big or too_old):
+                return
+            with self.lock:
+                files.segments.pop(0)
+            total -= oldest.size
+            for path in (oldest.path, oldest.index_path):
+                if os.path.exists(path):
+                    os.unlink(path)  # open maps of it stay readable
+
+    # readers
+
+    def read(self, room_name, since_seq=None, since_time=None, limit=None):
+        ''' returns [(seq, unix time, frame bytes)] for the room, oldest first,
+        '   starting at sequence number since_seq or unix time since_time
+        '   (from the beginning of the retained log if neither is given);
+        '   records the writer hasn't finished are not visible yet
+        '''
+        files = self.room_files(room_name)
+        with self.lock:
+            segments = [(segment.path, segment.size, list(segment.index), segment.first_seq,
+                         segment.last_time) for segment in files.segments]
+        records = []
+        for path, size, index, first_seq, last_time in segments:
+            if size == 0:
+                continue
+            next_first_seq = None
+            if since_seq is not None:  # skip segments wholly before since_seq
+                later = [segment[3] for segment in segments if segment[3] > first_seq]
+                next_first_seq = min(later) if later else None
+                if next_first_seq is not None and next_first_seq <= since_seq:
+                    continue
+            if since_time is not None and last_time is not None and last_time < since_time:
+                continue
+            offset = 0
+            if since_seq is not None:
+                position = bisect.bisect_right(index, since_seq, key=lambda entry: entry[0]) - 1
+                offset = index[position][2] if position >= 0 else 0
+            elif since_time is not None:
+                position = bisect.bisect_left(index, since_time, key=lambda entry: entry[1]) - 1
+                offset = index[position][2] if position >= 0 else 0
+            try:
+                records += scan_segment(path, size, offset, since_seq, since_time,
+                                        None if limit is None else limit - len(records))
+            except FileNotFoundError:
+                continue  # expired while we were reading
+            if limit is not None and len(records) >= limit:
+                break
+        return records
+
+
+def write_all(fd, buffers):
+    ''' os.writev, repeated until every buffer is written out '''
+    buffers = list(buffers)
+    while buffers:
+        written = os.writev(fd, buffers[:SENDMSG_MAX_BUFFERS])
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers.pop(0))
+        if written:
+            buffers[0] = memoryview(buffers[0])[written:]
+
+
+def scan_segment(path, size, offset, since_seq=None, since_time=None, limit=None):
+    ''' reads whole records from offset up to size through an mmap '''
+    records = []
+    with open(path, 'rb') as log_file:
+        with mmap.mmap(log_file.fileno(), size, access=mmap.ACCESS_READ) as view:
+            while offset < size and (limit is None or len(records) < limit):
+                length, seq, timestamp = RECORD_STRUCT.unpack_from(view, offset)
+                start = offset + RECORD_STRUCT.size
+                offset = start + length
+                if since_seq is not None and seq < since_seq:
+                    continue
+                if since_time is not None and timestamp < since_time:
+                    continue
+                records.append((seq, timestamp, view[start:offset]))
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print the logged messages of a room')
+    parser.add_argument('directory')
+    parser.add_argument('room')
+    parser.add_argument('--since-seq', type=int)
+    parser.add_argument('--since-time', type=float)
+    parser.add_argument('--limit', type=int)
+    args = parser.parse_args()
+    room_log = RoomLog(args.directory)
+    for seq, timestamp, frame in room_log.read(args.room, args.since_seq, args.since_time, args.limit):
+        msg = IrcPacketTellMsg().from_bytes(frame)
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        print(f'{seq:>8} {stamp} {msg.sending_user}: {msg.payload}')
+    room_log.close()
@@ -3,43 +3,216 @@
 '   under /docs.
 '''
 
+import argparse
+import atexit
 import selectors
 import socket
-import threading
-from time import sleep
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice
+from time import monotonic, perf_counter
 
+import irclog
+from capture import CaptureWriter
 from conf import *
+from irclog import SampledLogger
+from metrics import AdminServer, ServerMetrics
+from profiler import SamplingProfiler
+from tracing import Tracer
+
+log = irclog.get_logger('server')
+# one line per recipient (or per dropped packet) would swamp the log under
+# load, so those are sampled
+fanout_log = SampledLogger(log.getChild('fanout'), FANOUT_LOG_EVERY)
 
 
 class User:
-    ''' represents a user with a username and a socket '''
+    ''' represents a user with a username, a socket, the decoder
+    '   buffering that socket's inbound byte stream and the queue of
+    '   packets waiting to be written to it
+    '''
 
     def __init__(self, username, sock):
         self.username = username
+        self.label = None  # username as a 32 byte wire label, set after hello
+        self.handshake_deadline = None  # monotonic time hello is due by, None once received
         self.sock = sock
+        self.decoder = FrameDecoder()
+        self.outbound = deque()  # buffers (or the unsent tail of one) to write, in order
+        self.outbound_bytes = 0
+        self.frame_lengths = deque()  # length of each queued packet, oldest first
+        self.frame_sent = 0  # bytes of the oldest queued packet already written
+        self.reading_paused = False  # True while outbound is over the high watermark
+        self.events = selectors.EVENT_READ  # what the selector currently watches
+        self.rooms = set()  # Rooms this user has joined
+        self.caps = 0  # IRC_CAP_* bits negotiated with IRC_CAPS
+
+
+class Room:
+    ''' represents a room with a name and its members
+    '   members is a dict used as an insertion-ordered set of Users, so joins,
+    '   leaves and membership tests are O(1) and user lists keep join order
+    '   every member's User.rooms holds the Room back, so a leaving user only
+    '   touches the rooms they are actually in
+    '   history is a ring buffer of the encoded TELLMSG frames last relayed
+    '   to the room, bounded by history_count frames and history_budget bytes
+    '''
+
+    def __init__(self, name, history_count=ROOM_HISTORY_COUNT, history_budget=ROOM_HISTORY_BYTES):
+        self.name = name
+        self.members = {}
+        self.history = deque()
+        self.history_bytes = 0
+        self.history_count = history_count
+        self.history_budget = history_budget
+        self.last_message = None  # monotonic time of the newest history frame
+
+    def add(self, user):
+        ''' adds user to the room; returns False if they were already in it '''
+        if user in self.members:
+            return False
+        self.members[user] = None
+        user.rooms.add(self)
+        return True
+
+    def remove(self, user):
+        ''' removes user from the room; returns False if they were not in it '''
+        if user not in self.members:
+            return False
+        del self.members[user]
+        user.rooms.discard(self)
+        return True
+
+    def usernames(self):
+        return [user.username for user in self.members]
+
+    def remember(self, frame, now):
+        ''' appends a relayed frame (bytes or tuple of buffers) to the history,
+        '   evicting the oldest frames until both bounds hold again
+        '   returns False if the room keeps no history
+        '''
+        if self.history_count <= 0:
+            return False
+        self.history.append(frame)
+        self.history_bytes += frame_length(frame)
+        self.last_message = now
+        while len(self.history) > self.history_count or self.history_bytes > self.history_budget:
+            self.history_bytes -= frame_length(self.history.popleft())
+        return True
+
+    def forget_history(self):
+        self.history.clear()
+        self.history_bytes = 0
 
-# should really have written a room class but too far along now
-# just access room lists via self.rooms[room_name]
 
 class Server:
     ''' represents the server with users, rooms, a selector,
     '   and a flag that tells child processes to terminate
+    '   every client socket is non-blocking; packets are queued per user
+    '   and each user's queue is written with one sendmsg at the end of the
+    '   loop iteration, then again whenever the socket becomes writable
+    '   high_watermark, low_watermark: outbound bytes at which reading from a
+    '   user is paused and resumed
+    '   queue_cap: outbound bytes past which slow_consumer_policy applies,
+    '   SLOW_CONSUMER_DROP or SLOW_CONSUMER_DISCONNECT
+    '   new connections wait in a pending state, driven by the selector like
+    '   any other socket, until their hello arrives; at most max_pending may
+    '   wait at once, each for up to handshake_timeout seconds
+    '   reuse_port: bind the listening socket with SO_REUSEPORT so several
+    '   worker processes can share the port (see cluster.py)
+    '   users get a keepalive only after KEEPALIVE_INTERVAL seconds without
+    '   any other traffic, and are dropped after max_missed_keepalives silent
+    '   intervals (None to never drop them)
+    '   list responses are encoded once and cached until the room set or the
+    '   room's membership changes, so repeated requests and the user list
+    '   fanout on every join send the same bytes; paged requests
+    '   (IRC_CAP_LIST_PAGES) are cut from sorted name lists cached the same way
+    '   joins and leaves are announced once per membership_window seconds
+    '   per room: members that negotiated IRC_CAP_MEMBERSHIP_DELTAS get
+    '   USERS_JOINED / USERS_LEFT deltas, the rest a full user list if anyone
+    '   joined
+    '   each room replays its last history_count messages (at most
+    '   history_bytes) to new members; after history_idle quiet seconds a
+    '   room drops them
+    '   room_log, if given, is a roomlog.RoomLog every relayed message is
+    '   handed to for retention on disk
+    '   metrics is the metrics.ServerMetrics the server records into (a fresh
+    '   one by default); handling times are kept per opcode_names entry
+    '   tracer, if given, is a tracing.Tracer that follows sampled room
+    '   messages from recv to every recipient's flush
+    '   capture, if given, is a capture.CaptureWriter recording every client
+    '   connection's inbound bytes for replay.py
     '''
-
-    def __init__(self):
+    opcode_names = IRC_OPCODE_NAMES
+
+    def __init__(self, high_watermark=OUTBOUND_HIGH_WATERMARK,
+                 low_watermark=OUTBOUND_LOW_WATERMARK, queue_cap=OUTBOUND_QUEUE_CAP,
+                 slow_consumer_policy=SLOW_CONSUMER_DISCONNECT,
+                 max_pending=MAX_PENDING_HANDSHAKES, handshake_timeout=HANDSHAKE_TIMEOUT,
+                 reuse_port=False, max_missed_keepalives=KEEPALIVE_MAX_MISSED,
+                 membership_window=MEMBERSHIP_COALESCE_WINDOW,
+                 history_count=ROOM_HISTORY_COUNT, history_bytes=ROOM_HISTORY_BYTES,
+                 history_idle=ROOM_HISTORY_IDLE, room_log=None, metrics=None,
+                 tracer=None, capture=None):
         self.sel = selectors.DefaultSelector()
-        self.users = []
-        self.rooms = {}
+        self.users = {}  # username -> User, for users past hello
+        self.connections = {}  # socket -> User, for every client socket
+        self.dirty = {}  # Users with packets queued this loop iteration
+        self.pending = {}  # socket -> User awaiting hello, oldest first
+        self.max_pending = max_pending
+        self.handshake_timeout = handshake_timeout
+        self.rooms = {}  # room name -> Room
+        self.room_list_frame = None  # cached LISTROOMS_RESP, None when stale
+        self.user_list_frames = {}  # room name -> cached LISTUSERS_RESP
+        self.sorted_room_names = None  # room names paged through, None when stale
+        self.sorted_user_names = {}  # room name -> usernames paged through
+        self.membership_window = membership_window
+        self.membership_changes = {}  # room name -> {username: joined?} not yet announced
+        self.membership_flush_at = None  # when the pending changes are announced
+        self.history_count = history_count
+        self.history_bytes = history_bytes
+        self.history_idle = history_idle
+        self.history_rooms = {}  # Rooms holding history, least recently active first
+        self.room_log = room_log
         self.terminate_flag = False
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.queue_cap = queue_cap
+        self.slow_consumer_policy = slow_consumer_policy
+        self.keepalives = KeepaliveScheduler(KEEPALIVE_INTERVAL, max_missed_keepalives)
+        self.reuse_port = reuse_port
+        self.metrics = metrics if metrics is not None else ServerMetrics(opcode_names=self.opcode_names)
+        self.metrics.watch_server(self)
+        self.tracer = tracer
+        self.capture = capture
+        self.active_trace = None  # Trace of the message being relayed right now
+        self.recv_started = self.recv_done = 0  # around the last recv, kept while tracing
+        self.handling_opcode = None  # opcode of the packet being handled, for the profiler
 
     def close_and_clean(self, sock=None, err_code=IRC_ERR_UNKNOWN):
         ''' closes a socket and cleans up the userlist and selector 
-        '   if sock is None, closes all sockets and cleans up all users
+        '   if sock is None, closes all sockets and cleans up all users, then
+        '   writes out the room log
         '''
         if sock is None:  # disconnect all users
-            for user in self.users:
+            for user in list(self.connections.values()):
                 self.close_and_clean(user.sock, err_code)
+            if self.room_log is not None:
+                self.room_log.close()
+            if self.tracer is not None:
+                self.tracer.close()
+            if self.capture is not None:
+                self.capture.close()
             return
+        if sock.fileno() != -1 and err_code in self.metrics.errors:
+            self.metrics.errors[err_code].inc()
+        user = self.connections.get(sock)
+        if user is not None:
+            if user.frame_sent:
+                err_code = None  # an error packet now would land inside a half sent one
+            user.outbound.clear()
+            user.frame_lengths.clear()
+            user.outbound_bytes = user.frame_sent = 0
         close_on_err(sock, err_code)
         try:
             self.sel.unregister(sock)
@@ -47,218 +220,481 @@ class Server:
             pass  # socket already unregistered
         self.clean_userlist(sock)
 
-    def accept_new_user(self, sock):
-        ''' accepts a new user and adds them to the users list '''
+    def queue_packet(self, user, packet_bytes):
+        ''' queues a packet for the user; it is written by flush_dirty at the
+        '   end of the loop iteration together with everything else queued
+        '   packet_bytes: bytes, or a tuple of buffers that make up one packet
+        '   (as from tellmsg_frame_parts), which are written without joining
+        '   returns False if the packet was dropped or the user disconnected
+        '   because their queue is over the cap (see slow_consumer_policy)
+        '''
+        if user.sock.fileno() == -1:
+            return False  # closed earlier in this loop iteration
+        length = frame_length(packet_bytes)
+        if user.outbound_bytes + length > self.queue_cap:
+            if self.slow_consumer_policy == SLOW_CONSUMER_DROP:
+                self.metrics.slow_consumer_drops.inc()
+                fanout_log.warning('dropped %d byte packet for slow consumer %s',
+                                   length, user.username)
+            else:
+                self.metrics.slow_consumer_disconnects.inc()
+                log.warning('disconnecting slow consumer %s', user.username)
+                self.close_and_clean(user.sock, IRC_ERR_UNKNOWN)
+            return False
+        if type(packet_bytes) is tuple:
+            user.outbound.extend(packet_bytes)
+        else:
+            user.outbound.append(packet_bytes)
+        user.outbound_bytes += length
+        user.frame_lengths.append(length)
+        if not user.reading_paused and user.outbound_bytes >= self.high_watermark:
+            self.update_interest(user)
+        self.dirty[user] = None
+        return True
+
+    def flush_dirty(self):
+        ''' writes out every queue that got packets since the last call '''
+        while self.dirty:  # a flush can resume reading, which queues more
+            dirty, self.dirty = self.dirty, {}
+            for user in dirty:
+                if user.outbound and user.sock.fileno() != -1:
+                    self.flush_outbound(user)
+
+    def flush_outbound(self, user):
+        ''' writes as much of the user's queue as the socket will take,
+        '   up to SENDMSG_MAX_BUFFERS buffers per sendmsg call
+        '''
+        outbound = user.outbound
+        frame_lengths = user.frame_lengths
+        bytes_sent = self.metrics.bytes_sent
+        tracer = self.tracer
         try:
-            client_sock = None
-            username = ''
-            client_sock, client_tcpip_tuple = sock.accept()
-            client_sock.settimeout(TIMEOUT)
-            new_user = User(username, client_sock)
-            rcvd_hello_bytes = client_sock.recv(IrcPacketHello.packet_length)
-            username = IrcPacketHello().from_bytes(rcvd_hello_bytes).payload
-            new_user.username = username
-            if username in [user.username for user in self.users]:
-                self.close_and_clean(client_sock, IRC_ERR_NAME_EXISTS)
+            while outbound:
+                buffers = list(islice(outbound, SENDMSG_MAX_BUFFERS))
+                sent = user.sock.sendmsg(buffers)
+                user.outbound_bytes -= sent
+                frame_sent = user.frame_sent + sent
+                while frame_sent and frame_sent >= frame_lengths[0]:
+                    frame_sent -= frame_lengths.popleft()
+                user.frame_sent = frame_sent
+                bytes_sent.value += sent
+                if tracer is not None and user in tracer.waiting:
+                    tracer.sent(user, sent)
+                self.keepalives.sent(user)
+                for buffer in buffers:
+                    if sent < len(buffer):
+                        break
+                    sent -= len(buffer)
+                    outbound.popleft()
+                else:
+                    continue  # everything offered went out
+                if sent:
+                    outbound[0] = memoryview(buffer)[sent:]
+                break  # socket buffer is full
+        except BlockingIOError:
+            pass  # socket buffer is full, wait for EVENT_WRITE
+        except OSError:
+            self.drop_lost_connection(user)
+            return
+        self.update_interest(user)
+
+    def update_interest(self, user):
+        ''' applies backpressure and watches for writability as needed '''
+        if not user.reading_paused and user.outbound_bytes >= self.high_watermark:
+            user.reading_paused = True
+        elif user.reading_paused and user.outbound_bytes <= self.low_watermark:
+            user.reading_paused = False
+            # packets read before the pause may still be waiting
+            self.handle_buffered_packets(user)
+            if user.sock.fileno() == -1:
+                return
+        events = 0 if user.reading_paused else selectors.EVENT_READ
+        if user.outbound:
+            events |= selectors.EVENT_WRITE
+        if events != user.events and user.sock in self.connections:
+            self.sel.modify(user.sock, events, data=user)
+            user.events = events
+
+    def accept_new_users(self, main_sock):
+        ''' accepts up to ACCEPT_BATCH waiting connections into the pending
+        '   handshake state; their hellos are read as the selector reports them
+        '''
+        for _ in range(ACCEPT_BATCH):
+            try:
+                client_sock, client_tcpip_tuple = main_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return  # backlog drained
+            except OSError as e:  # e.g. out of file descriptors
+                log.error('failed to accept a connection: %s', e)
                 return
-            self.users.append(new_user)
-            self.sel.register(client_sock, selectors.EVENT_READ)
-            print(f'added {username} at {client_tcpip_tuple} ',
-                  f'(fd {client_sock.fileno()}) to server')  # DEBUG
+            client_sock.setblocking(False)
+            if len(self.pending) >= self.max_pending:
+                log.warning('too many pending handshakes, refusing %s', client_tcpip_tuple)
+                close_on_err(client_sock, IRC_ERR_TOO_MANY_USERS)
+                continue
+            new_user = User('', client_sock)
+            new_user.handshake_deadline = monotonic() + self.handshake_timeout
+            self.pending[client_sock] = new_user
+            self.connections[client_sock] = new_user
+            # the selector hands the User back with every event
+            self.sel.register(client_sock, selectors.EVENT_READ, data=new_user)
+            if self.capture is not None:
+                self.capture.opened(new_user)
+
+    def receive_hello(self, new_user):
+        ''' reads from a pending connection and, once its hello is complete,
+        '   adds it to the users list
+        '''
+        client_sock = new_user.sock
+        try:
+            received = new_user.decoder.recv_from(client_sock)
+            if received == 0:
+                raise ConnectionResetError('connection closed before hello')
+            self.metrics.bytes_received.inc(received)
+            if self.capture is not None:
+                self.capture.received(new_user, new_user.decoder.last_received(received))
+            rcvd_hello_bytes = new_user.decoder.next_frame()
+            if rcvd_hello_bytes is None:
+                return  # rest of the hello hasn't arrived yet
+            username = IrcPacketHello().from_bytes(rcvd_hello_bytes).payload
+            self.claim_username(new_user, username)
+        except BlockingIOError:
+            return  # spurious wakeup, nothing to read after all
         except IRCException as e:
+            self.metrics.handshake_failures.inc()
             self.close_and_clean(client_sock, e.err_code)
         except ValueError as e:
-            print('client connection at addr/port already exists')  # ERR
+            log.warning('undecodable hello: %s', e)
+            self.metrics.handshake_failures.inc()
+            self.close_and_clean(client_sock, IRC_ERR_ILLEGAL_LABEL)
+        except OSError as e:
+            self.metrics.handshake_failures.inc()
+            self.drop_lost_connection(new_user)
+
+    def claim_username(self, new_user, username):
+        ''' admits a pending connection under username unless it is taken '''
+        if username in self.users:
+            self.metrics.handshake_failures.inc()
+            self.close_and_clean(new_user.sock, IRC_ERR_NAME_EXISTS)
+            return
+        self.admit_user(new_user, username)
+
+    def admit_user(self, new_user, username):
+        ''' moves a pending connection into the users list '''
+        client_sock = new_user.sock
+        del self.pending[client_sock]
+        accepted_at = new_user.handshake_deadline - self.handshake_timeout
+        self.metrics.handshake_seconds.observe(monotonic() - accepted_at)
+        new_user.handshake_deadline = None
+        new_user.username = username = wire_label(username)
+        new_user.label = username.wire
+        self.users[username] = new_user
+        self.keepalives.add(new_user)
+        log.info('added %s (fd %d) to server', username, client_sock.fileno())
+        # packets sent right behind the hello may already be buffered
+        self.handle_buffered_packets(new_user)
+
+    def expire_pending(self, now):
+        ''' closes pending connections whose hello is overdue
+        '   pending is ordered by accept time, so only expired entries are visited
+        '''
+        while self.pending:
+            client_sock, new_user = next(iter(self.pending.items()))
+            if new_user.handshake_deadline > now:
+                return
+            log.warning('no hello within %ss, closing fd %d',
+                        self.handshake_timeout, client_sock.fileno())
+            self.metrics.handshake_failures.inc()
             self.close_and_clean(client_sock, IRC_ERR_UNKNOWN)
 
     def add_user_to_room(self, user, join_msg):
-        ''' adds a user to a room and sends the user list to all users in the
-        '   room
+        ''' adds a user to a room, sends them the user list and schedules
+        '   the join announcement for everyone else in the room
         '''
         # create room if it doesn't exist
-        room_name = join_msg.payload
-        if room_name not in self.rooms.keys():
-            self.rooms[room_name] = []
-        this_room = self.rooms[room_name]
-        # add user to room
-        this_room.append(user)
-        # send list of users to all users in room
-        for other_user in self.rooms[room_name]:
-            try:
-                self.send_user_list(other_user, room_name)
-            except IRCException as e:
-                self.close_and_clean(user.sock, e.err_code)
+        this_room = self.rooms.get(join_msg.payload)
+        if this_room is None:
+            room_name = wire_label(join_msg.payload)
+            this_room = self.rooms[room_name] = Room(room_name, self.history_count, self.history_bytes)
+            self.rooms_changed()
+        room_name = this_room.name
+        # add user to room; joining twice only re-sends them the list
+        if not this_room.add(user):
+            self.send_user_list(user, room_name)
+            return
+        self.members_changed(room_name)
+        self.send_user_list(user, room_name)
+        # replay what was said before; it leaves with the list in one sendmsg
+        for frame in this_room.history:
+            self.queue_packet(user, frame)
+        self.note_membership_change(room_name, user.username, True)
+
+    def note_membership_change(self, room_name, username, joined):
+        ''' records a join or leave to announce at the end of the window '''
+        changes = self.membership_changes.get(room_name)
+        if changes is None:
+            changes = self.membership_changes[room_name] = {}
+            if self.membership_flush_at is None:
+                self.membership_flush_at = monotonic() + self.membership_window
+        changes.pop(username, None)  # only the latest change counts
+        changes[username] = joined
+
+    def flush_membership_changes(self):
+        ''' announces the joins and leaves recorded since the last flush
+        '   each room's delta packets are encoded once for all its members;
+        '   clients apply them as set operations, so a member that was sent a
+        '   full list after their own join may safely see overlapping deltas
+        '   RFC members get a fresh full list, except the window's last joiner,
+        '   whose list from add_user_to_room already names every other joiner
+        '''
+        changes_by_room, self.membership_changes = self.membership_changes, {}
+        self.membership_flush_at = None
+        for room_name, changes in changes_by_room.items():
+            room = self.rooms.get(room_name)
+            if room is None:
+                continue
+            joined = [name for name, has_joined in changes.items() if has_joined]
+            left = [name for name, has_joined in changes.items() if not has_joined]
+            latest_joiner = joined[-1] if joined else None
+            delta_frames = []
+            if joined:
+                delta_frames.append(IrcPacketUsersJoined(payload=joined, identifier=room_name).to_bytes())
+            if left:
+                delta_frames.append(IrcPacketUsersLeft(payload=left, identifier=room_name).to_bytes())
+            for member in list(room.members):
+                if member.caps & IRC_CAP_MEMBERSHIP_DELTAS:
+                    for frame in delta_frames:
+                        self.queue_packet(member, frame)
+                elif joined and member.username != latest_joiner:  # RFC clients only hear of joins
+                    self.send_user_list(member, room_name)
 
     def user_requests_user_list(self, user, list_users_msg):
         ''' receives a request for a list of users in a room 
         '   and sends it to the user
         '''
         room_name = list_users_msg.payload
-        bad_room_name = False
-        if room_name not in self.rooms.keys():
-            bad_room_name = True  # will return empty list
         try:
-            self.send_user_list(user, room_name, bad_room_name)
+            self.send_user_list(user, room_name)
         except IRCException as e:
             self.close_and_clean(user.sock, e.err_code)
 
-    def send_user_list(self, user, room_name, bad_room_name=False):
+    def room_usernames(self, room_name):
+        ''' names of the users in a room, empty if there is no such room '''
+        room = self.rooms.get(room_name)
+        return room.usernames() if room is not None else []
+
+    def room_names(self):
+        return list(self.rooms.keys())
+
+    def rooms_changed(self):
+        ''' drops the cached room lists after a room was created '''
+        self.room_list_frame = None
+        self.sorted_room_names = None
+
+    def members_changed(self, room_name):
+        ''' drops the cached user lists of a room after a join or leave '''
+        self.user_list_frames.pop(room_name, None)
+        self.sorted_user_names.pop(room_name, None)
+
+    def user_list_frame(self, room_name):
+        ''' returns the encoded user list of a room, from the cache if its
+        '   membership hasn't changed since it was last encoded
+        '''
+        frame = self.user_list_frames.get(room_name)
+        if frame is None:
+            room = self.rooms.get(room_name)
+            frame = IrcPacketListUsersResp(
+                payload=self.room_usernames(room_name),
+                identifier=room.name if room is not None else room_name
+            ).to_bytes()
+            # unknown rooms are named by clients, so they are never cached
+            if room_name in self.rooms:
+                self.user_list_frames[room_name] = frame
+        return frame
+
+    def send_user_list(self, user, room_name):
         ''' sends a list of users in a room to a user '''
-        if bad_room_name:
-            payload = []
-        else:
-            this_room = self.rooms[room_name]
-            payload = [u.username for u in this_room]
         try:
-            list_users_packet = IrcPacketListUsersResp(
-                payload=payload,
-                identifier=room_name
-            )
-            list_users_packet_bytes = list_users_packet.to_bytes()
-            user.sock.sendall(list_users_packet_bytes)
+            self.queue_packet(user, self.user_list_frame(room_name))
         except IRCException as e:
-            print(f'ERROR: encountered protocol error while '
-                      + f'sending user list to {user.username}', e)
+            log.error('protocol error while sending user list to %s: %s', user.username, e)
             self.close_and_clean(user.sock, e.err_code)
-        except socket.timeout:
-            print(f'connection to {user.sock} timed out while '
-                      + f'sending user list')  # ERR
-        except OSError:
-            print(f'connection to {user.sock} errored while '
-                      + f'sending user list')  # ERR
 
     def send_room_list(self, user):
         try:
-            room_list = [room for room in self.rooms.keys()]
-            room_list_packet = IrcPacketListRoomsResp(payload=room_list)
-            room_list_packet_bytes = room_list_packet.to_bytes()
-            print(f'sending room list {room_list} to {user.username}')  # DEBUG
-            user.sock.sendall(room_list_packet_bytes)
+            if self.room_list_frame is None:
+                self.room_list_frame = IrcPacketListRoomsResp(payload=self.room_names()).to_bytes()
+            log.debug('sending room list to %s', user.username)
+            self.queue_packet(user, self.room_list_frame)
         except IRCException as e:
             self.close_and_clean(user.sock, e.err_code)
 
-    def send_msg(self, user, msg):
-        print(f'relaying "{msg.payload}" from {user.username} '
-                      + f'to {msg.target_label}')  # DEBUG
-        if msg.target_label in self.rooms.keys():
-            try:
-                tell_msg = IrcPacketTellMsg(
-                    payload=msg.payload,
-                    target_label=msg.target_label,
-                    sending_user=user.username
-                )
-                tell_msg_bytes = tell_msg.to_bytes()
-            except IRCException as e:
-                print(f'ERROR: encountered protocol error while sending '
-                      + f'msg to {user.username}')
-                self.close_and_clean(user.sock, e.err_code)
-            for user in self.rooms[msg.target_label]:
-                try:
-                    user.sock.sendall(tell_msg_bytes)
-                    print(f'told "{msg.payload}" to {user.username} in '
-                      + f'{msg.target_label}')  # DEBUG
-                except socket.timeout:
-                    print(f'connection to {user.sock.getpeername()} timed out '
-                      + f'while telling msg')  # ERR
-                    self.close_and_clean(user.sock, IRC_ERR)
-                except OSError:
-                    print(f'connection to {user.sock.getpeername()} errored '
-                      + f'while telling msg')  # ERR
-                    self.close_and_clean(user.sock, IRC_ERR)
-        else:  # behavior not defined in RFC!
-            print(f'no room named "{msg.target_label}" exists... '
-                      + f'silently ignoring send for now')  # DEBUG
+    def send_room_page(self, user, request):
+        ''' answers an IrcPacketListRoomsPage '''
+        if self.sorted_room_names is None:
+            self.sorted_room_names = sorted(self.room_names())
+        page, more = list_page(self.sorted_room_names, request.limit, request.cursor, request.prefix)
+        self.queue_packet(user, IrcPacketListRoomsPageResp(page, more).to_bytes())
+
+    def send_user_page(self, user, request):
+        ''' answers an IrcPacketListUsersPage '''
+        room_name = request.room_name
+        names = self.sorted_user_names.get(room_name)
+        if names is None:
+            names = sorted(self.room_usernames(room_name))
+            if room_name in self.rooms:  # unknown rooms are never cached
+                self.sorted_user_names[room_name] = names
+        page, more = list_page(names, request.limit, request.cursor, request.prefix)
+        self.queue_packet(user, IrcPacketListUsersPageResp(page, room_name, more).to_bytes())
+
+    def send_msg(self, user, payload, room_label):
+        ''' relays a validated SENDMSG body to every user in the room
+        '   payload, room_label: wire bytes as returned by split_sendmsg_frame
+        '   the TELLMSG pieces are built once from those bytes and shared by
+        '   every recipient; the message is never decoded or re-validated
+        '''
+        room_name = strip_null_bytes(bytes(room_label)).decode('ascii')
+        log.debug('relaying %d byte msg from %s to %s', len(payload), user.username, room_name)
+        # the body is copied out of the receive buffer once, since queues may
+        # still hold it after the decoder has reused that memory
+        tell_msg_parts = tellmsg_frame_parts(bytes(payload), user.label, bytes(room_label))
+        if self.active_trace is not None:
+            self.active_trace.phase('encode')
+        if not self.deliver_to_room(room_name, tell_msg_parts):  # behavior not defined in RFC!
+            self.metrics.undeliverable.inc()
+            log.debug('no room named "%s" exists... silently ignoring send for now', room_name)
+        elif self.room_log is not None:
+            self.room_log.append(room_name, tell_msg_parts)
+
+    def traced_send_msg(self, trace, user, payload, room_label):
+        ''' send_msg with trace following the message to its recipients '''
+        trace.phase('decode')
+        trace.room = strip_null_bytes(bytes(room_label)).decode('ascii')
+        trace.length = len(payload)
+        self.active_trace = trace
+        try:
+            self.send_msg(user, payload, room_label)
+        finally:
+            self.active_trace = None
+            trace.done()
+
+    def deliver_to_room(self, room_name, tell_msg_bytes):
+        ''' queues a TELLMSG frame (bytes or a tuple of buffers) for every
+        '   member of the room
+        '   returns False if there is no such room
+        '''
+        room = self.rooms.get(room_name)
+        if room is None:
+            return False
+        metrics = self.metrics
+        metrics.room_fanout.observe(len(room.members))
+        metrics.relayed_bytes.inc(frame_length(tell_msg_bytes) * len(room.members))
+        trace = self.active_trace
+        for user in list(room.members):
+            if self.queue_packet(user, tell_msg_bytes):
+                fanout_log.debug('told msg to %s in %s', user.username, room_name)
+                if trace is not None:
+                    trace.enqueued(user)
+        if trace is not None:
+            trace.phase('enqueue')
+        if room.remember(tell_msg_bytes, monotonic()):
+            self.history_rooms.pop(room, None)  # move to the most recent end
+            self.history_rooms[room] = None
+        return True
+
+    def expire_history(self, now):
+        ''' drops the history of rooms that have been quiet for history_idle
+        '   seconds; only rooms that actually expire are visited
+        '''
+        while self.history_rooms:
+            room = next(iter(self.history_rooms))
+            if room.last_message + self.history_idle > now:
+                return
+            del self.history_rooms[room]
+            room.forget_history()
 
     def send_priv_msg(self, user, msg):
-        print(f'relaying "{msg.payload}" from {user.username} to {msg.target_label}')  # DEBUG
-        if msg.target_label in [u.username for u in self.users]:
-            try:
-                target_user = [u for u in self.users if u.username == msg.target_label][0]
-                tell_msg = IrcPacketTellPrivMsg(
-                    payload=msg.payload,
-                    target_label=msg.target_label,
-                    sending_user=user.username
-                )
-                tell_msg_bytes = tell_msg.to_bytes()
-            except IRCException as e:
-                print(f'ERROR: encountered protocol error while '
-                      + f'telling msg to {msg.target_label}')
-                self.close_and_clean(user.sock, e.err_code)
-            try:
-                target_user.sock.sendall(tell_msg_bytes)
-                print(f'told "{msg.payload}" to {msg.target_label}')  # DEBUG
-            except socket.timeout:
-                print(f'connection to {user.sock.getpeername()} '
-                      + f'timed out while telling msg')  # ERR
-                self.close_and_clean(user.sock, IRC_ERR)
-            except OSError:
-                print(f'connection to {user.sock.getpeername()} '
-                      + f'errored while telling msg')  # ERR
-                self.close_and_clean(user.sock, IRC_ERR)
-        else:  # behavior not defined in RFC!
-            print(f'No user named "{msg.target_label}" exists... '
-                      + f'silently ignoring send for now')  # DEBUG
+        log.debug('relaying "%s" from %s to %s', msg.payload, user.username, msg.target_label)
+        target_user = self.users.get(msg.target_label)
+        try:
+            tell_msg = IrcPacketTellPrivMsg(
+                payload=msg.payload,
+                target_label=target_user.username if target_user is not None else msg.target_label,
+                sending_user=user.username
+            )
+            tell_msg_bytes = tell_msg.to_bytes()
+        except IRCException as e:
+            log.error('protocol error while telling msg to %s: %s', msg.target_label, e)
+            self.close_and_clean(user.sock, e.err_code)
+            return
+        if not self.deliver_to_user(msg.target_label, tell_msg_bytes):  # behavior not defined in RFC!
+            self.metrics.undeliverable.inc()
+            log.debug('no user named "%s" exists... silently ignoring send for now',
+                      msg.target_label)
+
+    def deliver_to_user(self, username, tell_msg_bytes):
+        ''' queues a TELLPRIVMSG frame for the named user
+        '   returns False if there is no such user
+        '''
+        target_user = self.users.get(username)
+        if target_user is None:
+            return False
+        self.metrics.private_messages.inc()
+        self.metrics.relayed_bytes.inc(len(tell_msg_bytes))
+        if self.queue_packet(target_user, tell_msg_bytes):
+            log.debug('told private msg to %s', username)
+        return True
 
     def react_to_client_err(self, user, err_msg):
-        print(f'closed on by {user.sock.getpeername()} '
-                      + f'due to error {err_msg.payload}')  # ERR
-        print(f'removing {user.username} from server')  # ERR
+        log.warning('closed on by %s due to error %#x, removing from server',
+                    user.username, err_msg.payload)
         self.close_and_clean(user.sock, err_msg.payload)
 
     def clean_userlist(self, bad_sock=None):
         ''' Removes user from server's user list and all rooms '''
-        # find bad user using socket
-        bad_user = None
-        for user in self.users:
-            if user.sock == bad_sock:
-                bad_user = user
-                break
-        if bad_user in self.users:
-            self.users.remove(bad_user)
-        # self.users = [user for user in self.users \
-        # if user.sock != bad_sock and user.sock.fileno() != -1]
-        if bad_user is not None:
-            self.remove_user_from_room(bad_user)
+        bad_user = self.connections.pop(bad_sock, None)
+        self.pending.pop(bad_sock, None)
+        if bad_user is None:
+            return  # already cleaned up
+        if self.users.get(bad_user.username) is bad_user:
+            del self.users[bad_user.username]
+        self.keepalives.remove(bad_user)
+        if self.tracer is not None:
+            self.tracer.forget(bad_user)
+        if self.capture is not None:
+            self.capture.closed(bad_user)
+        self.remove_user_from_room(bad_user)
 
     def remove_user_from_room(self, user, room_to_leave=None):
-        ''' if room_to_leave is None, removes user from all rooms
-        '   also removes dead connections
+        ''' if room_to_leave is None, removes user from all rooms they joined
+        '   room_to_leave: name of the room to leave
         '''
-        bad_sock = user.sock
-        for room in self.rooms:
-            if room is not None and room != room_to_leave:
-                continue
-            print(f'removing {user.username} from {room}')  # DEBUG
-            self.rooms[room] = [u for u in self.rooms[room] if \
-                                u.sock != bad_sock and u.sock.fileno() != -1]
-
-    def send_keepalive(self, sock):
-        ''' sends a keepalive packet to the given socket '''
-        try:
-            sock.sendall(IrcPacketKeepalive().to_bytes())
-        except IRCException as e:
-            print(f'KEEPALIVE THREAD: encountered protocol error '
-                  + f'while sending keepalive to {sock}')
-            self.close_and_clean(sock, e.err_code)
-        except socket.timeout:
-            print(f'connection to {sock.getpeername()} timed out')  # ERR
-            sock.close()
-        except (socket.error, BrokenPipeError, OSError) as e:
-            print(f'KEEPALIVE THREAD: connection to fd {sock} errored: {e}')  # ERR
-            self.close_and_clean(sock, IRC_ERR_UNKNOWN)  # timeout err?
-            sock.close()
-
-    def send_keepalives(self, main_sock):
-        ''' Should be its own thread '''
-        while True:
-            sleep(4)
-            if self.terminate_flag:
-                print('\nServer terminated; Exiting keepalive thread')  # DEBUG
-                return
-            clients = [val.fileobj for val in self.sel.get_map().values() \
-                       if val.fileobj != main_sock]
-            for client in clients:
-                self.send_keepalive(client)
+        if room_to_leave is None:
+            rooms = list(user.rooms)
+        elif room_to_leave in self.rooms:
+            rooms = [self.rooms[room_to_leave]]
+        else:
+            return  # leaving a room that doesn't exist is a no-op
+        for room in rooms:
+            if room.remove(user):
+                self.members_changed(room.name)
+                self.note_membership_change(room.name, user.username, False)
+                log.debug('removing %s from %s', user.username, room.name)
+
+    def send_keepalives(self):
+        ''' queues a keepalive for every user that has gone idle and drops
+        '   users that stopped talking; called from the main loop whenever the
+        '   scheduler's next deadline passes
+        '''
+        idle, dead = self.keepalives.due()
+        self.metrics.keepalive_timeouts.inc(len(dead))
+        self.metrics.keepalives_sent.inc(len(idle))
+        for user in dead:
+            log.warning('%s missed %d keepalives, removing from server', user.username,
+                        self.keepalives.max_missed)
+            self.close_and_clean(user.sock, IRC_ERR_UNKNOWN)
+        for user in idle:
+            self.queue_packet(user, EMPTY_FRAMES[IRC_KEEPALIVE])
 
     def setup_err(self, e=None):
         if e is not None:
@@ -276,127 +712,291 @@ class Server:
         ''' creates a socket to listen on and enters a loop '''
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as main_sock:
             self.sel.register(main_sock, selectors.EVENT_READ)
-            main_sock.settimeout(TIMEOUT)
+            main_sock.setblocking(False)
+            if self.reuse_port:  # every worker binds the same port
+                main_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             try:
                 main_sock.bind(('', IRC_SERVER_PORT))
             except OSError as e:
                 return self.setup_err(e)
-            print("listening")  # DEBUG
             main_sock.listen()
-            print("looping")  # DEBUG
-            try:
-                keepalive_thread = threading.Thread(
-                    target=self.send_keepalives, args=[main_sock]
-                )
-                keepalive_thread.start()
-            except OSError as e:
-                return self.setup_err(e)
+            log.info('listening on port %d', IRC_SERVER_PORT)
             self.mainloop(main_sock)
 
     def mainloop(self, main_sock):
         try:
             while True:
-                events = self.sel.select(timeout=TIMEOUT)
-                for key, _ in events:
-                    if key.fileobj == main_sock:  # new client
-                        self.accept_new_user(main_sock)
-                    else:  # established client
-                        # (keepalive, msg, err, join, leave, or list pkt)
-                        client_sock = key.fileobj
-                        this_user = None
-                        for user in self.users:
-                            if user.sock == client_sock:
-                                this_user = user
-                                break
-                        if this_user is None:
-                            print(f'ERROR: could not find user '
-                                  + f'with socket {client_sock}')  # ERR
-                            continue
-                        self.receive_from_client(this_user)
+                deadline = monotonic() + TIMEOUT
+                keepalive_deadline = self.keepalives.next_deadline()
+                if keepalive_deadline is not None:
+                    deadline = min(deadline, keepalive_deadline)
+                if self.membership_flush_at is not None:
+                    deadline = min(deadline, self.membership_flush_at)
+                if self.pending:  # oldest pending handshake expires first
+                    deadline = min(deadline, next(iter(self.pending.values())).handshake_deadline)
+                timeout = max(0, deadline - monotonic())
+                events = self.sel.select(timeout=timeout)
+                for key, mask in events:
+                    if key.data is None:  # listening socket, new clients
+                        self.accept_new_users(main_sock)
+                        continue
+                    # client socket, data is its User
+                    this_user = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush_outbound(this_user)
+                    if mask & selectors.EVENT_READ and this_user.sock.fileno() != -1:
+                        if this_user.handshake_deadline is not None:
+                            self.receive_hello(this_user)
+                        else:  # (keepalive, msg, err, join, leave, or list pkt)
+                            self.receive_from_client(this_user)
+                now = monotonic()
+                self.expire_pending(now)
+                self.expire_history(now)
+                if self.membership_flush_at is not None and now >= self.membership_flush_at:
+                    self.flush_membership_changes()
+                keepalive_deadline = self.keepalives.next_deadline()
+                if keepalive_deadline is not None and now >= keepalive_deadline:
+                    self.send_keepalives()
+                # everything queued this iteration goes out, one sendmsg per user
+                self.flush_dirty()
         except KeyboardInterrupt as kbi:
-            self.terminate_flag = True  # terminate keepalive thread
+            self.terminate_flag = True
             self.close_and_clean()  # close all connections
             main_sock.close()
             exit(0)
 
     def receive_from_client(self, this_user):
-        ''' receives a packet from the given socket and reacts to it '''
+        ''' reads whatever the given user's socket has ready and reacts to
+        '   every complete packet in it; partial packets stay buffered
+        '''
+        tracing = self.tracer is not None
         try:
-            header_bytes = this_user.sock.recv(IrcHeader.header_length)
-            if header_bytes == b'':
-                # print(f'received nothing from {this_user.sock.getpeername()}')
-                return  # not sure why this happens...
-                # if there's no inbound traffic why does the FD get selected?
-            header_obj = IrcHeader().from_bytes(header_bytes)
-            payload_bytes = this_user.sock.recv(header_obj.length)
-            packet_bytes = header_bytes + payload_bytes
-            msg_obj = None
-
-            if header_obj.opcode == IRC_KEEPALIVE:
-                print(f'received keepalive from '
-                      + f'{this_user.sock.getpeername()}') # DEBUG
-                # RFC does not specify that we have to do anything here
-                # only that we MUST send keepalives and SHOULD receive them
-
-            elif header_obj.opcode == IRC_SENDMSG:
-                msg_obj = IrcPacketSendMsg().from_bytes(packet_bytes)
-                print(f'received sendmsg from '
-                      + f'{this_user.sock.getpeername()}')  # DEBUG
-                self.send_msg(this_user, msg_obj)
-
-            elif header_obj.opcode == IRC_SENDPRIVMSG:
-                msg_obj = IrcPacketSendPrivMsg().from_bytes(packet_bytes)
-                print(f'received send priv msg from '
-                      + f'{this_user.sock.getpeername()}')  # DEBUG
-                self.send_priv_msg(this_user, msg_obj)
-
-            elif header_obj.opcode == IRC_ERR:
-                print(f'received err from '
-                      + f'{this_user.sock.getpeername()}')  # DEBUG
-                msg_obj = IrcPacketErr().from_bytes(packet_bytes)
-                self.react_to_client_err(this_user, msg_obj)
-
-            elif header_obj.opcode == IRC_JOINROOM:
-                print(f'received join from '
-                      + f'{this_user.sock.getpeername()}')  # DEBUG
-                msg_obj = IrcPacketJoinRoom().from_bytes(packet_bytes)
-                self.add_user_to_room(this_user, msg_obj)
-
-            elif header_obj.opcode == IRC_LEAVEROOM:
-                print(f'received leave from '
-                      + f'{this_user.sock.getpeername()}')  # DEBUG
-                msg_obj = IrcPacketLeaveRoom().from_bytes(packet_bytes)
-                self.remove_user_from_room(this_user, msg_obj.payload)
-
-            elif header_obj.opcode == IRC_LISTROOMS:
-                print(f'received listrooms from '
-                      + f'{this_user.sock.getpeername()}')  # DEBUG
-                self.send_room_list(this_user)
-
-            elif header_obj.opcode == IRC_LISTUSERS:
-                print(f'received listusers from '
-                      + f'{this_user.sock.getpeername()}')  # DEBUG
-                msg_obj = IrcPacketListUsers().from_bytes(packet_bytes)
-                self.user_requests_user_list(this_user, msg_obj)
-
-            else:
-                print(f'WARNING! OPCODE NOT KNOWN TO SERVER\nreceived opcode '
-                      + f'{header_obj.opcode} from {this_user.sock.getpeername()};'
-                        + f'\nnot yet implemented!')  # DEBUG
-
-        except IRCException as e:
-            print('ERROR: receive_from_client() caught an IRCException - '
-                  + f'malformed client packet?')  # ERR
-            self.close_and_clean(this_user.sock)
+            if tracing:
+                self.recv_started = perf_counter()
+            received = this_user.decoder.recv_from(this_user.sock)
+            if received == 0:
+                raise ConnectionResetError('peer closed the connection')
+        except BlockingIOError:
+            return  # spurious wakeup, nothing to read after all
         except OSError as e:  # tried to read from a dead connection
-            if this_user.sock.fileno() != -1:
-                print(f'Lost connection to {this_user.sock}; '
-                      + f'removing from server')  # DEBUG
-                self.sel.unregister(this_user.sock)
-            self.clean_userlist(this_user.sock)
-            this_user.sock.close()
+            self.drop_lost_connection(this_user)
             return
+        if tracing:
+            self.recv_done = perf_counter()
+        self.metrics.bytes_received.inc(received)
+        if self.capture is not None:
+            self.capture.received(this_user, this_user.decoder.last_received(received))
+        self.keepalives.received(this_user)
+        self.handle_buffered_packets(this_user)
+
+    def handle_buffered_packets(self, this_user):
+        ''' reacts to every complete packet waiting in the user's decoder,
+        '   timing each one into the handler histogram of its opcode
+        '''
+        handler_seconds = self.metrics.handler_seconds
+        packets_received = self.metrics.packets_received
+        outer_opcode = self.handling_opcode  # set if a handler resumed this user
+        try:
+            while not this_user.reading_paused:
+                packet_bytes = this_user.decoder.next_frame()
+                if packet_bytes is None:
+                    break
+                self.handling_opcode = opcode = packet_bytes[0]
+                started = perf_counter()
+                self.handle_packet(this_user, packet_bytes)
+                handler_seconds[opcode].observe(perf_counter() - started)
+                packets_received[opcode].value += 1
+                if this_user.sock.fileno() == -1:
+                    return  # connection was closed while handling the packet
+        except IRCException as e:
+            log.warning('malformed packet from %s: %s', this_user.username, e)
+            self.close_and_clean(this_user.sock, e.err_code)
+        except OSError as e:  # tried to write to a dead connection
+            self.drop_lost_connection(this_user)
+        finally:
+            self.handling_opcode = outer_opcode
+
+    def drop_lost_connection(self, this_user):
+        ''' unregisters and forgets a user whose connection died '''
+        if this_user.sock.fileno() != -1:
+            log.info('lost connection to %s, removing from server', this_user.username)
+            self.metrics.lost_connections.inc()
+            try:
+                self.sel.unregister(this_user.sock)
+            except (KeyError, ValueError):
+                pass  # never registered (died during hello)
+        self.clean_userlist(this_user.sock)
+        this_user.sock.close()
+
+    def handle_packet(self, this_user, packet_bytes):
+        ''' reacts to one complete packet received from the given user '''
+        header_obj = IrcHeader().from_bytes(packet_bytes)
+        msg_obj = None
+
+        if header_obj.opcode == IRC_KEEPALIVE:
+            log.debug('received keepalive from %s', this_user.username)
+            # RFC does not specify that we have to do anything here
+            # only that we MUST send keepalives and SHOULD receive them
+
+        elif header_obj.opcode == IRC_SENDMSG:
+            trace = None
+            if self.tracer is not None:
+                trace = self.tracer.sample(this_user.username, self.recv_started, self.recv_done)
+            payload, room_label = split_sendmsg_frame(packet_bytes)
+            log.debug('received sendmsg from %s', this_user.username)
+            if trace is None:
+                self.send_msg(this_user, payload, room_label)
+            else:
+                self.traced_send_msg(trace, this_user, payload, room_label)
+
+        elif header_obj.opcode == IRC_SENDPRIVMSG:
+            msg_obj = IrcPacketSendPrivMsg().from_bytes(packet_bytes)
+            log.debug('received send priv msg from %s', this_user.username)
+            self.send_priv_msg(this_user, msg_obj)
+
+        elif header_obj.opcode == IRC_ERR:
+            log.debug('received err from %s', this_user.username)
+            msg_obj = IrcPacketErr().from_bytes(packet_bytes)
+            self.react_to_client_err(this_user, msg_obj)
+
+        elif header_obj.opcode == IRC_JOINROOM:
+            log.debug('received join from %s', this_user.username)
+            msg_obj = IrcPacketJoinRoom().from_bytes(packet_bytes)
+            self.add_user_to_room(this_user, msg_obj)
+
+        elif header_obj.opcode == IRC_LEAVEROOM:
+            log.debug('received leave from %s', this_user.username)
+            msg_obj = IrcPacketLeaveRoom().from_bytes(packet_bytes)
+            self.remove_user_from_room(this_user, msg_obj.payload)
+
+        elif header_obj.opcode == IRC_LISTROOMS:
+            log.debug('received listrooms from %s', this_user.username)
+            self.send_room_list(this_user)
+
+        elif header_obj.opcode == IRC_LISTROOMS_PAGE:
+            msg_obj = IrcPacketListRoomsPage().from_bytes(packet_bytes)
+            log.debug('received listrooms page after "%s" from %s',
+                      msg_obj.cursor, this_user.username)
+            self.send_room_page(this_user, msg_obj)
+
+        elif header_obj.opcode == IRC_LISTUSERS_PAGE:
+            msg_obj = IrcPacketListUsersPage().from_bytes(packet_bytes)
+            log.debug('received listusers page of %s after "%s" from %s', msg_obj.room_name,
+                      msg_obj.cursor, this_user.username)
+            self.send_user_page(this_user, msg_obj)
+
+        elif header_obj.opcode == IRC_CAPS:
+            msg_obj = IrcPacketCaps().from_bytes(packet_bytes)
+            this_user.caps = msg_obj.payload & IRC_SUPPORTED_CAPS
+            log.debug('negotiated caps %#x with %s', this_user.caps, this_user.username)
+            self.queue_packet(this_user, IrcPacketCaps(this_user.caps).to_bytes())
+
+        elif header_obj.opcode == IRC_LISTUSERS:
+            log.debug('received listusers from %s', this_user.username)
+            msg_obj = IrcPacketListUsers().from_bytes(packet_bytes)
+            self.user_requests_user_list(this_user, msg_obj)
+
+        else:
+            log.warning('opcode %#x from %s is not known to the server', header_obj.opcode,
+                        this_user.username)
+
+
+def list_page(names, limit, cursor, prefix):
+    ''' the slice of an ascending list of names a page request asks for:
+    '   at most limit names after cursor that start with prefix
+    '   returns (names, whether more follow)
+    '''
+    limit = min(limit or LIST_PAGE_MAX, LIST_PAGE_MAX)
+    start = bisect_right(names, cursor) if cursor else 0
+    if prefix:  # names sharing a prefix sit together in sorted order
+        start = max(start, bisect_left(names, prefix))
+    page = []
+    for name in names[start:start + limit + 1]:
+        if not name.startswith(prefix):
+            break
+        page.append(name)
+    return page[:limit], len(page) > limit
+
+
+def serve_diagnostics(server, admin_port, profile_options, profile_now=False):
+    ''' sets up the admin endpoint and the profiler of a server that is
+    '   about to run its loop in this thread; the profiler samples that
+    '   thread and is toggled by SIGUSR2 or GET /profile?action=...
+    '''
+    profiler = SamplingProfiler(current_opcode=lambda: server.handling_opcode,
+                                opcode_names=server.opcode_names, **profile_options)
+    profiler.install_signal()
+    atexit.register(profiler.stop)  # the last samples reach the file
+    if admin_port:
+        admin = AdminServer(server.metrics.registry, admin_port)
+        admin.routes['/profile'] = profiler.admin_route
+        admin.start()
+    if profile_now:
+        profiler.start()
+    return profiler
 
 
 if __name__ == '__main__':
-    Server().main()
+    parser = argparse.ArgumentParser(description='594irc chat server')
+    parser.add_argument('--engine', choices=['selectors', 'asyncio'], default='selectors',
+                        help='event loop implementation to serve clients with')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes sharing the port (selectors engine only)')
+    parser.add_argument('--log-dir',
+                        help='keep an on-disk log of every room under this directory '
+                             + '(selectors engine only)')
+    parser.add_argument('--log-fsync-interval', type=float, default=LOG_FSYNC_INTERVAL,
+                        help='seconds between fsyncs of the room log')
+    parser.add_argument('--log-retention-bytes', type=int,
+                        help='drop the oldest log segments of a room past this size')
+    parser.add_argument('--log-retention-age', type=float,
+                        help='drop log segments older than this many seconds')
+    parser.add_argument('--admin-port', type=int, default=0,
+                        help=f'localhost port serving /metrics, e.g. {ADMIN_PORT} (worker i of a '
+                             + 'cluster uses this port + i); off by default')
+    parser.add_argument('--trace-file',
+                        help='write sampled relay traces here (workers add .worker<i>)')
+    parser.add_argument('--trace-sample', type=int, default=TRACE_SAMPLE_EVERY,
+                        help='trace one in every this many room messages')
+    parser.add_argument('--capture-file',
+                        help='record every connection\'s inbound bytes here for replay.py '
+                             + '(workers add .worker<i>)')
+    parser.add_argument('--profile', action='store_true',
+                        help='start the sampling profiler right away (SIGUSR2 toggles it)')
+    parser.add_argument('--profile-file', default=PROFILE_FILE,
+                        help='collapsed stacks of the profiler (workers add .worker<i>)')
+    parser.add_argument('--profile-interval', type=float, default=PROFILE_INTERVAL,
+                        help='seconds between profiler samples')
+    parser.add_argument('--log-level', choices=irclog.LEVELS, default='info',
+                        help='least severe diagnostic lines written to stderr')
+    parser.add_argument('--log-sample', type=int, default=FANOUT_LOG_EVERY,
+                        help='log one in every this many per-recipient lines')
+    args = parser.parse_args()
+    irclog.setup(args.log_level)
+    fanout_log.every = args.log_sample
+    log_options = None
+    if args.log_dir is not None:
+        log_options = dict(fsync_interval=args.log_fsync_interval,
+                           retention_bytes=args.log_retention_bytes,
+                           retention_age=args.log_retention_age)
+    trace_options = None
+    if args.trace_file is not None:
+        trace_options = dict(path=args.trace_file, sample_every=args.trace_sample)
+    profile_options = dict(path=args.profile_file, interval=args.profile_interval)
+    if args.workers > 1:
+        from cluster import run_cluster
+        run_cluster(args.workers, args.log_dir, log_options, args.log_level, args.admin_port,
+                    trace_options, profile_options, args.profile, args.capture_file)
+    elif args.engine == 'asyncio':
+        from async_server import AsyncServer
+        AsyncServer().main()
+    else:
+        room_log = None
+        if args.log_dir is not None:
+            from roomlog import RoomLog
+            room_log = RoomLog(args.log_dir, **log_options)
+        tracer = Tracer(**trace_options) if trace_options is not None else None
+        capture = CaptureWriter(args.capture_file) if args.capture_file is not None else None
+        server = Server(room_log=room_log, tracer=tracer, capture=capture)
+        serve_diagnostics(server, args.admin_port, profile_options, args.profile)
+        server.main()
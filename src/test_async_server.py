@@ -0,0 +1,75 @@
+''' tests the asyncio engine over real loopback connections
+'   each test runs its own event loop with the server on an ephemeral port
+'''
+
+import asyncio
+
+from async_server import AsyncServer
+from conf import *
+
+
+def run_with_server(client_code):
+    ''' serves an AsyncServer on 127.0.0.1 while client_code(server, port) runs '''
+    async def main():
+        server = AsyncServer()
+        listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0)
+        try:
+            await client_code(server, listener.sockets[0].getsockname()[1])
+        finally:
+            listener.close()
+    asyncio.run(main())
+
+
+async def read_packets(reader, count):
+    ''' reads count whole packets off a client stream '''
+    decoder = FrameDecoder(max_length=None, shared=False)
+    frames = []
+    while len(frames) < count:
+        decoder.feed(await asyncio.wait_for(reader.read(RECV_BUFSIZE), TIMEOUT))
+        frames += [bytes(frame) for frame in decoder]
+    return frames
+
+
+def test_concurrent_hellos():
+    names = [f'user{i}' for i in range(8)]
+
+    async def clients(server, port):
+        connections = await asyncio.gather(*[asyncio.open_connection('127.0.0.1', port) for _ in names])
+        for (_, writer), name in zip(connections, names):
+            writer.write(IrcPacketHello(name).to_bytes())
+        # sent together, so the server reads several hellos before parsing one
+        await asyncio.gather(*[writer.drain() for _, writer in connections])
+        for _ in range(100):
+            if len(server.users) == len(names):
+                break
+            await asyncio.sleep(0.01)
+        assert sorted(server.users) == names
+        assert all(server.users[name].username == name for name in names)
+        for _, writer in connections:
+            writer.close()
+
+    run_with_server(clients)
+
+
+def test_join_and_message():
+    async def clients(server, port):
+        streams = {}
+        for name in ['alice', 'bob']:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            # the join rides in the same segment as the hello
+            writer.write(IrcPacketHello(name).to_bytes() + IrcPacketJoinRoom('room').to_bytes())
+            streams[name] = reader, writer
+            (frame,) = await read_packets(reader, 1)
+            assert IrcPacketListUsersResp().from_bytes(frame).payload[-1] == name
+        (frame,) = await read_packets(streams['alice'][0], 1)  # bob joined after her
+        assert IrcPacketListUsersResp().from_bytes(frame).payload == ['alice', 'bob']
+        streams['alice'][1].write(IrcPacketSendMsg(payload='hi', target_label='room').to_bytes())
+        for reader, _ in streams.values():
+            (frame,) = await read_packets(reader, 1)
+            tell = IrcPacketTellMsg().from_bytes(frame)
+            assert (tell.payload, tell.target_label, tell.sending_user) == ('hi', 'room', 'alice')
+        for _, writer in streams.values():
+            writer.close()
+
+    run_with_server(clients)
+
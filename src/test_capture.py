@@ -0,0 +1,56 @@
+''' tests traffic capture: recv chunks are recorded as the server read them,
+'   replay.py merges several captures into one timeline and gates on its results
+'''
+
+from capture import CAPTURE_CLOSE, CAPTURE_DATA, CAPTURE_OPEN, CaptureWriter, read_capture, split_packets
+from conf import *
+from replay import compare, load_events
+from server import Server
+from test_server import make_user
+
+
+def test_capture_round_trip(tmp_path):
+    path = str(tmp_path / 'traffic.cap')
+    server = Server(capture=CaptureWriter(path))
+    alice, alice_sock = make_user(server, 'alice')
+    server.capture.opened(alice)
+    packets = IrcPacketJoinRoom('room').to_bytes() + IrcPacketSendMsg('hi', 'room').to_bytes()
+    alice_sock.sendall(packets[:5])
+    server.receive_from_client(alice)
+    alice_sock.sendall(packets[5:])
+    server.receive_from_client(alice)
+    server.close_and_clean(alice.sock)
+    server.close_and_clean()
+    _, records = read_capture(path)
+    assert [kind for kind, *_ in records] == [CAPTURE_OPEN, CAPTURE_DATA, CAPTURE_DATA, CAPTURE_CLOSE]
+    assert [data for *_, data in records[1:3]] == [packets[:5], packets[5:]]
+    assert [elapsed for _, _, elapsed, _ in records] == sorted(elapsed for _, _, elapsed, _ in records)
+    assert split_packets(data for *_, data in records) == [IRC_JOINROOM, IRC_SENDMSG]
+
+
+def test_torn_tail_and_merge(tmp_path):
+    paths = [str(tmp_path / 'traffic.cap'), str(tmp_path / 'traffic.cap.worker1')]
+    for path in paths:
+        writer = CaptureWriter(path)
+        writer.opened('connection')
+        writer.received('connection', b'hello')
+        writer.received('stranger', b'ignored')
+        writer.close()
+    with open(paths[1], 'ab') as capture_file:
+        capture_file.write(b'\x02\x00\x00')  # a crash mid-record
+    assert [data for *_, data in read_capture(paths[1])[1]] == [b'', b'hello']
+    events = load_events(paths)
+    assert events[0][0] == 0 and [at for at, *_ in events] == sorted(at for at, *_ in events)
+    assert sorted(key for _, kind, key, _ in events if kind == CAPTURE_DATA) == [(0, 1), (1, 1)]
+
+
+def test_compare():
+    baseline = {'mode': 'fast', 'packets_per_s': 1000, 'received': {'tellmsg': 10, 'err': 1}}
+    same = dict(baseline, packets_per_s=950)
+    assert compare(same, baseline, threshold=0.1) == []
+    slower = dict(baseline, packets_per_s=850)
+    assert compare(slower, baseline, threshold=0.1) == ['throughput: 1000 -> 850 packets/s']
+    changed = dict(baseline, received={'tellmsg': 9, 'err': 1, 'listusers_resp': 3})
+    assert compare(changed, baseline, threshold=0.1) == ['tellmsg responses: 10 -> 9']
+    paced = {'mode': 'paced', 'packets_per_s': 1, 'received': {'tellmsg': 10, 'err': 1}}
+    assert compare(paced, dict(paced, packets_per_s=1000), threshold=0.1) == []
@@ -0,0 +1,22 @@
+''' tests client bookkeeping without a server; the connection is a socketpair '''
+
+from socket import socketpair
+
+from client import Client
+from conf import *
+
+
+def test_sends_postpone_keepalives():
+    client = Client()
+    client.client_socket, server_sock = socketpair()
+    clock = [100.0]
+    client.keepalives = KeepaliveScheduler(interval=4, max_missed=None, clock=lambda: clock[0])
+    client.keepalives.add(client.client_socket)
+    clock[0] = 103.0
+    client.send_packet(IrcPacketJoinRoom('room').to_bytes())
+    clock[0] = 104.0
+    assert client.keepalives.due() == ([], [])  # the join went out 1s ago
+    clock[0] = 107.0
+    assert client.keepalives.due() == ([client.client_socket], [])
+    assert IrcPacketJoinRoom().from_bytes(server_sock.recv(64)).payload == 'room'
+    client.client_socket.close(), server_sock.close()
@@ -0,0 +1,93 @@
+''' tests the cluster bus with a hub and two workers in one process
+'   workers never listen; clients are socketpairs handed to them as if
+'   accepted, and the bus is pumped by hand instead of by the event loops
+'''
+
+import selectors
+from socket import socketpair
+from time import monotonic
+
+from conf import *
+from cluster import BusHub, ClusterServer
+from server import User
+
+
+def pump(hub, workers, rounds=5):
+    ''' lets bus packets travel hub <-> workers until things settle '''
+    for _ in range(rounds):
+        for worker in workers:
+            worker.flush_dirty()
+        hub.poll(timeout=0.01)
+        for worker in workers:
+            worker.receive_from_client(worker.bus)
+
+
+def connect(worker, name):
+    ''' hands the worker a new connection and sends its hello '''
+    server_end, client_end = socketpair()
+    client_end.settimeout(1)
+    server_end.setblocking(False)
+    user = User('', server_end)
+    user.handshake_deadline = monotonic() + 5
+    worker.pending[server_end] = user
+    worker.connections[server_end] = user
+    worker.sel.register(server_end, selectors.EVENT_READ, data=user)
+    client_end.sendall(IrcPacketHello(name).to_bytes())
+    worker.receive_hello(user)
+    return user, client_end
+
+
+def read_packets(sock):
+    decoder = FrameDecoder(max_length=None)
+    sock.setblocking(False)
+    try:
+        while decoder.recv_from(sock):
+            pass
+    except BlockingIOError:
+        pass
+    return [bytes(frame) for frame in decoder]
+
+
+def test_cluster_bus(tmp_path):
+    hub = BusHub(str(tmp_path / 'bus.sock'))
+    workers = [ClusterServer(hub.path), ClusterServer(hub.path)]
+    for worker in workers:
+        worker.connect_bus()
+    pump(hub, workers)
+    one, two = workers
+    alice, alice_sock = connect(one, 'alice')
+    pump(hub, workers)
+    assert one.users['alice'] is alice
+    # the same name on the other worker is refused cluster-wide
+    impostor, impostor_sock = connect(two, 'alice')
+    pump(hub, workers)
+    assert 'alice' not in two.users and impostor.sock.fileno() == -1
+    assert IrcPacketErr().from_bytes(read_packets(impostor_sock)[0]).payload == IRC_ERR_NAME_EXISTS
+    bob, bob_sock = connect(two, 'bob')
+    pump(hub, workers)
+    one.add_user_to_room(alice, IrcPacketJoinRoom('room'))
+    pump(hub, workers)
+    two.add_user_to_room(bob, IrcPacketJoinRoom('room'))
+    pump(hub, workers)
+    assert one.room_usernames('room') == ['alice', 'bob']
+    assert two.room_names() == ['room']
+    read_packets(alice_sock)
+    # room and private messages cross to the other worker
+    sendbytes = IrcPacketSendMsg(payload='hi', target_label='room').to_bytes()
+    two.send_msg(bob, *split_sendmsg_frame(sendbytes))
+    two.send_priv_msg(bob, IrcPacketSendPrivMsg(payload='psst', target_label='alice',
+                                                sending_user='bob'))
+    pump(hub, workers)
+    tell, priv = read_packets(alice_sock)
+    assert IrcPacketTellMsg().from_bytes(tell).sending_user == 'bob'
+    assert IrcPacketTellPrivMsg().from_bytes(priv).payload == 'psst'
+    # a disconnect frees the name and the room seat everywhere
+    one.close_and_clean(alice.sock)
+    pump(hub, workers)
+    assert two.room_usernames('room') == ['bob']
+    connect(two, 'alice')
+    pump(hub, workers)
+    assert 'alice' in two.users
+    for worker in workers:
+        worker.close_and_clean()
+    hub.close()
@@ -0,0 +1,42 @@
+''' tests the logging pipeline: records go through the background writer,
+'   arguments are only formatted for enabled levels and sampled loggers pass
+'   one in every N records
+'''
+
+import io
+
+import irclog
+
+
+class Exploding:
+    ''' fails the test if anything tries to format it '''
+
+    def __str__(self):
+        raise AssertionError('formatted a disabled record')
+
+
+def test_levels_and_lazy_formatting():
+    stream = io.StringIO()
+    irclog.setup('info', stream)
+    log = irclog.get_logger('test')
+    log.debug('never written %s', Exploding())
+    log.info('added %s to %s', 'alice', 'lobby')
+    irclog.shutdown()  # waits for the writer thread
+    assert 'never written' not in stream.getvalue()
+    assert 'irc.test: added alice to lobby' in stream.getvalue()
+    assert irclog.dropped() == 0
+
+
+def test_sampling():
+    stream = io.StringIO()
+    irclog.setup('debug', stream)
+    sampled = irclog.SampledLogger(irclog.get_logger('test.fanout'), 10)
+    for i in range(35):
+        sampled.debug('told msg %d', i)
+    irclog.setup('info', stream)  # below the level: not even counted
+    for i in range(35):
+        sampled.debug('told msg %s', Exploding())
+    irclog.shutdown()
+    lines = stream.getvalue().splitlines()
+    assert [line.split(': ', 1)[1] for line in lines] == [
+        f'told msg {i} (1 in 10)' for i in (9, 19, 29)]
@@ -0,0 +1,60 @@
+''' tests the metrics registry, its Prometheus rendering and what the server
+'   records while relaying
+'''
+
+from urllib.request import urlopen
+
+from conf import *
+from metrics import AdminServer, Registry
+from server import Server
+from test_server import make_user
+
+
+def test_render():
+    registry = Registry()
+    registry.counter('packets_total', 'packets', opcode='join').inc(3)
+    registry.counter('packets_total', 'packets', opcode='leave').inc()
+    registry.gauge('users', 'users', lambda: 7)
+    histogram = registry.histogram('seconds', 'latency', (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert registry.render().splitlines() == [
+        '# HELP packets_total packets',
+        '# TYPE packets_total counter',
+        'packets_total{opcode="join"} 3',
+        'packets_total{opcode="leave"} 1',
+        '# HELP users users',
+        '# TYPE users gauge',
+        'users 7',
+        '# HELP seconds latency',
+        '# TYPE seconds histogram',
+        'seconds_bucket{le="0.1"} 2',  # buckets are inclusive upper bounds
+        'seconds_bucket{le="1.0"} 3',
+        'seconds_bucket{le="+Inf"} 4',
+        'seconds_sum 2.65',
+        'seconds_count 4',
+    ]
+
+
+def test_server_metrics():
+    server = Server()
+    alice, alice_sock = make_user(server, 'alice')
+    bob, bob_sock = make_user(server, 'bob')
+    alice_sock.sendall(IrcPacketJoinRoom('room').to_bytes())
+    bob_sock.sendall(IrcPacketJoinRoom('room').to_bytes() + IrcPacketSendMsg('hi', 'room').to_bytes())
+    server.receive_from_client(alice)
+    server.receive_from_client(bob)
+    server.flush_dirty()
+    metrics = server.metrics
+    assert metrics.packets_received[IRC_JOINROOM].value == 2
+    assert metrics.handler_seconds[IRC_SENDMSG].count() == 1
+    assert metrics.room_fanout.counts == [0, 0, 1] + [0] * (len(FANOUT_BUCKETS) - 2)
+    assert metrics.bytes_sent.value > 0 and metrics.bytes_received.value > 0
+    admin = AdminServer(metrics.registry, 0).start()  # any free port
+    try:
+        with urlopen(f'http://127.0.0.1:{admin.server_address[1]}/metrics', timeout=5) as response:
+            text = response.read().decode()
+    finally:
+        admin.close()
+    assert 'irc_packets_received_total{opcode="sendmsg"} 1' in text
+    assert 'irc_users 2' in text and 'irc_rooms 1' in text
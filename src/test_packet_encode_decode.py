@@ -118,6 +118,136 @@ def test_tell():
     assert tellmsgtest2.sending_user == usr
     print('test_tell passed')
 
+def test_wire_layout():
+    print('entering test_wire_layout')
+    # struct-packed frames must match the hand-concatenated RFC layout
+    label = choice(VALID_LABELS)
+    label_bytes = label.encode('ascii').ljust(LABEL_LENGTH, b'\x00')
+    assert IrcPacketKeepalive().to_bytes() == IRC_KEEPALIVE.to_bytes(1, 'big') + (0).to_bytes(4, 'big')
+    assert IrcPacketErr(IRC_ERR_NAME_EXISTS).to_bytes() == b'\x00' + (1).to_bytes(4, 'big') + b'\x16'
+    assert IrcPacketHello(label).to_bytes() == \
+        b'\x02' + (34).to_bytes(4, 'big') + label_bytes + IRC_VERSION.to_bytes(2, 'big')
+    assert IrcPacketJoinRoom(label).to_bytes() == b'\x05' + (32).to_bytes(4, 'big') + label_bytes
+    payload = choice(VALID_MESSAGES)
+    tellbytes = IrcPacketTellMsg(payload=payload, target_label=label, sending_user=label).to_bytes()
+    body = payload.encode('ascii') + b'\x00' + label_bytes + label_bytes
+    assert tellbytes == b'\x0A' + len(body).to_bytes(4, 'big') + body
+    listbytes = IrcPacketListUsersResp(payload=[label, label], identifier=label).to_bytes()
+    assert listbytes == b'\x09' + (96).to_bytes(4, 'big') + label_bytes * 3
+    # decoding straight out of a memoryview must work too
+    assert IrcPacketListUsersResp().from_bytes(memoryview(listbytes)).payload == [label, label]
+    print('test_wire_layout passed')
+
+def test_frame_decoder():
+    print('entering test_frame_decoder')
+    frames = [IrcPacketJoinRoom(choice(VALID_LABELS)).to_bytes(), IrcPacketKeepalive().to_bytes(),
+              IrcPacketSendMsg(payload=choice(VALID_MESSAGES), target_label=choice(VALID_LABELS)).to_bytes()]
+    stream = b''.join(frames) * 3
+    # split and coalesced reads must yield the same packets in order
+    for chunk_size in [1, 7, len(stream)]:
+        decoder = FrameDecoder(bufsize=16)
+        decoded = []
+        for i in range(0, len(stream), chunk_size):
+            decoder.feed(stream[i:i + chunk_size])
+            decoded += [bytes(frame) for frame in decoder]
+        assert decoded == frames * 3
+        assert decoder.pending() == 0
+    # oversized length field is a protocol violation
+    decoder = FrameDecoder()
+    decoder.feed(IrcHeader(IRC_SENDMSG, MAX_CLIENT_PAYLOAD_LENGTH + 1).to_bytes())
+    expect_exception(decoder.next_frame, ex_type=IRCException)
+    print('test_frame_decoder passed')
+
+def test_frame_decoder_idle_memory():
+    print('entering test_frame_decoder_idle_memory')
+    frame = IrcPacketSendMsg(payload=choice(VALID_MESSAGES), target_label=choice(VALID_LABELS)).to_bytes()
+    idle, partial, busy = FrameDecoder(), FrameDecoder(), FrameDecoder()
+    idle.feed(frame)
+    assert [bytes(f) for f in idle] == [frame]
+    partial.feed(frame[:7])
+    assert list(partial) == [] and len(idle.buffer) == 0
+    busy.feed(frame * 2)
+    # once another decoder reads, each keeps only its unfinished packet
+    assert len(idle.buffer) == 0 and bytes(partial.buffer) == frame[:7]
+    assert [bytes(f) for f in busy] == [frame, frame]
+    partial.feed(frame[7:])
+    assert [bytes(f) for f in partial] == [frame] and len(busy.buffer) == 0
+    # a private decoder's views survive other decoders' reads
+    private = FrameDecoder(shared=False)
+    private.feed(frame)
+    (view,) = private
+    busy.feed(frame[::-1])
+    assert bytes(view) == frame and len(private.buffer) == 0
+    print('test_frame_decoder_idle_memory passed')
+
+def test_validation():
+    print('entering test_validation')
+    for msg in VALID_MESSAGES:
+        for form in [msg + '\0', (msg + '\0').encode('ascii'), memoryview((msg + '\0').encode('ascii'))]:
+            assert validate_message(form)
+    assert validate_message('line\r\nbreak\0')
+    for msg in ['', '\0', 'no terminator', 'inner\0null\0', 'bell\x07\0', 'caf\xe9\0', 'x' * MAX_MSG_LENGTH + '\0']:
+        assert not validate_message(msg)
+    for label in VALID_LABELS:
+        assert validate_label(label_to_bytes(label))
+        assert validate_label(label.ljust(LABEL_LENGTH, '\0'))
+    for label in INVALID_LABELS + ['\0' * LABEL_LENGTH, 'unterminated', 'x' * (LABEL_LENGTH + 1)]:
+        assert not validate_label(label)
+    assert validate_string(b'ok\0\x01garbage after terminator')
+    assert not validate_string(b'\0leading null')
+    print('test_validation passed')
+
+def test_relay_frames():
+    print('entering test_relay_frames')
+    payload = choice(VALID_MESSAGES)
+    room, usr = choice(VALID_LABELS), choice(VALID_LABELS)
+    sendbytes = IrcPacketSendMsg(payload=payload, target_label=room).to_bytes()
+    body, room_label = split_sendmsg_frame(sendbytes)
+    assert bytes(body) == payload.encode('ascii') + b'\x00'
+    assert bytes(room_label) == label_to_bytes(room)
+    # relayed frame is identical to one encoded from a TellMsg object
+    tellbytes = build_tellmsg_frame(body, label_to_bytes(usr), room_label)
+    assert tellbytes == IrcPacketTellMsg(payload=payload, target_label=room, sending_user=usr).to_bytes()
+    expect_exception(split_sendmsg_frame, IrcPacketJoinRoom(room).to_bytes(), ex_type=IRCException)
+    bad_room = sendbytes[:-LABEL_LENGTH] + b' ' * LABEL_LENGTH
+    expect_exception(split_sendmsg_frame, bad_room, ex_type=IRCException)
+    print('test_relay_frames passed')
+
+def test_list_pages():
+    print('entering test_list_pages')
+    labels = [f'room{i:05d}' for i in range(2000)]
+    page = IrcPacketListRoomsPageResp().from_bytes(IrcPacketListRoomsPageResp(labels, more=True).to_bytes())
+    assert page.payload == labels and page.more and page.identifier is None
+    room = choice(VALID_LABELS)
+    users = IrcPacketListUsersPageResp().from_bytes(IrcPacketListUsersPageResp([], room).to_bytes())
+    assert users.payload == [] and users.identifier == room and not users.more
+    request = IrcPacketListUsersPage(room, limit=50, cursor='room00049', prefix='room0 ')
+    request2 = IrcPacketListUsersPage().from_bytes(request.to_bytes())
+    assert (request2.room_name, request2.limit, request2.cursor, request2.prefix) == \
+        (room, 50, 'room00049', 'room0 ')
+    first = IrcPacketListRoomsPage().from_bytes(IrcPacketListRoomsPage().to_bytes())
+    assert (first.limit, first.cursor, first.prefix) == (0, '', '')
+    expect_exception(IrcPacketListRoomsResp([' bad ']).to_bytes, ex_type=IRCException)
+    expect_exception(IrcPacketListRoomsPage(cursor=' bad ').to_bytes, ex_type=IRCException)
+    truncated = IrcPacketListUsersResp([room], room).to_bytes()[:-1]
+    expect_exception(IrcPacketListUsersResp().from_bytes, truncated, ex_type=IRCException)
+    print('test_list_pages passed')
+
+def test_wire_labels():
+    print('entering test_wire_labels')
+    name = choice(VALID_LABELS)
+    label = wire_label(name)
+    assert label == name and hash(label) == hash(name) and f'{label}' == name
+    assert wire_label(''.join(name)) is label  # one shared instance per name
+    assert label.wire == label_to_bytes(name) and label_to_bytes(label) is label.wire
+    # packets built from WireLabels are the same bytes as from plain names
+    assert IrcPacketListUsersResp([label, label], label).to_bytes() == \
+        IrcPacketListUsersResp([name, name], name).to_bytes()
+    assert IrcPacketTellPrivMsg('hi', label, label).to_bytes() == IrcPacketTellPrivMsg('hi', name, name).to_bytes()
+    for bad in INVALID_LABELS + ['caf\xe9']:
+        expect_exception(wire_label, bad, ex_type=IRCException)
+    print('test_wire_labels passed')
+
 def expect_exception(func, *args, ex_type):
     try:
         func(*args)
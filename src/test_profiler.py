@@ -0,0 +1,37 @@
+''' tests the sampling profiler: collapsed stacks rooted at the opcode being
+'   handled, the per-opcode breakdown and the admin toggle
+'''
+
+from time import monotonic, sleep
+
+from conf import *
+from profiler import SamplingProfiler
+
+
+def busy(seconds):
+    ''' keeps this (the sampled) thread on the CPU '''
+    end = monotonic() + seconds
+    while monotonic() < end:
+        pass
+
+
+def test_samples_by_opcode(tmp_path):
+    path = str(tmp_path / 'profile.collapsed')
+    handling = [None]
+    profiler = SamplingProfiler(path, interval=0.001, current_opcode=lambda: handling[0])
+    profiler.admin_route({'action': ['start']})
+    handling[0] = IRC_SENDMSG
+    busy(0.2)
+    handling[0] = None
+    busy(0.1)
+    report = profiler.admin_route({'action': ['stop']})[1]
+    assert not profiler.running and 'profiler stopped' in report
+    with open(path) as collapsed:
+        lines = collapsed.read().splitlines()
+    assert lines
+    stacks = dict(line.rsplit(' ', 1) for line in lines)
+    assert any(stack.startswith('handler:sendmsg;') and 'busy (test_profiler.py:' in stack
+               for stack in stacks)
+    roots = {root: count for root, count, _ in profiler.breakdown()}
+    assert roots['handler:sendmsg'] > roots['loop'] > 0
+    assert sum(roots.values()) == sum(int(count) for count in stacks.values())
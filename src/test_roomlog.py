@@ -0,0 +1,57 @@
+''' tests the on-disk room log: reads by sequence number and time, segment
+'   rollover, retention and recovery after a torn write
+'''
+
+import os
+
+from conf import *
+from roomlog import RECORD_STRUCT, RoomLog
+
+
+def frame(i):
+    return tellmsg_frame_parts(f'message {i}\0'.encode(), label_to_bytes('w'),
+                               label_to_bytes('room'))
+
+
+def payloads(records):
+    return [IrcPacketTellMsg().from_bytes(record[2]).payload for record in records]
+
+
+def test_append_and_read(tmp_path):
+    log = RoomLog(str(tmp_path), segment_bytes=1024, index_interval=256)
+    for i in range(40):
+        log.append('room', frame(i))
+    log.append('other', b''.join(frame(99)))
+    log.close()
+    log = RoomLog(str(tmp_path), segment_bytes=1024, index_interval=256)
+    files = log.room_files('room')
+    assert len(files.segments) > 2 and files.next_seq == 40  # rolled over, state recovered
+    assert all(len(segment.index) > 1 for segment in files.segments[:-1])
+    assert payloads(log.read('room')) == [f'message {i}' for i in range(40)]
+    assert [r[0] for r in log.read('room', since_seq=25, limit=3)] == [25, 26, 27]
+    since = log.read('room')[30][1]
+    assert log.read('room', since_time=since)[0][0] <= 30
+    assert payloads(log.read('other')) == ['message 99']
+    log.append('room', frame(40))  # appends continue the sequence after a restart
+    log.close()
+    assert RoomLog(str(tmp_path)).read('room', since_seq=40)[0][0] == 40
+
+
+def test_retention_and_torn_tail(tmp_path):
+    log = RoomLog(str(tmp_path), segment_bytes=1024, retention_bytes=2048)
+    for i in range(100):
+        log.append('room', frame(i))
+    log.close()
+    log = RoomLog(str(tmp_path), segment_bytes=1024, retention_bytes=2048)
+    log.sync_and_expire()
+    records = log.read('room')
+    assert records[-1][0] == 99 and records[0][0] > 0  # oldest segments are gone
+    assert sum(segment.size for segment in log.room_files('room').segments) <= 2048 + 1024
+    newest = log.room_files('room').segments[-1].path
+    log.close()
+    with open(newest, 'ab') as log_file:  # a crash halfway through a record
+        log_file.write(RECORD_STRUCT.pack(500, 100, 0.0) + b'partial')
+    log = RoomLog(str(tmp_path))
+    assert log.read('room')[-1][0] == 99
+    assert os.path.getsize(newest) == log.room_files('room').segments[-1].size
+    log.close()
@@ -0,0 +1,338 @@
+''' tests server-side bookkeeping (users, rooms) without a listening socket
+'   clients are socketpairs so the server's sends can be read back
+'''
+
+import selectors
+from socket import create_connection, create_server, socketpair
+from time import monotonic, sleep
+
+from conf import *
+from server import Room, Server, User, list_page
+
+
+def make_user(server, name):
+    ''' registers a user on the server as if it had completed hello '''
+    server_end, client_end = socketpair()
+    client_end.settimeout(1)
+    server_end.setblocking(False)
+    user = User(name, server_end)
+    user.label = label_to_bytes(name)
+    server.users[name] = user
+    server.connections[server_end] = user
+    server.sel.register(server_end, selectors.EVENT_READ, data=user)
+    return user, client_end
+
+
+def test_room_membership():
+    room = Room('room')
+    alice, bob = User('alice', None), User('bob', None)
+    assert room.add(alice) and room.add(bob)
+    assert not room.add(alice)  # duplicate joins are idempotent
+    assert room.usernames() == ['alice', 'bob']
+    assert alice.rooms == {room}
+    assert room.remove(alice) and not room.remove(alice)
+    assert room.usernames() == ['bob'] and alice.rooms == set()
+
+
+def test_disconnect_leaves_only_joined_rooms():
+    server = Server()
+    alice, alice_sock = make_user(server, 'alice')
+    bob, bob_sock = make_user(server, 'bob')
+    for name in ['a', 'b']:
+        server.add_user_to_room(alice, IrcPacketJoinRoom(name))
+    server.add_user_to_room(bob, IrcPacketJoinRoom('b'))
+    server.add_user_to_room(bob, IrcPacketJoinRoom('b'))
+    assert server.rooms['b'].usernames() == ['alice', 'bob']
+    server.clean_userlist(alice.sock)
+    assert 'alice' not in server.users
+    assert server.rooms['a'].usernames() == []
+    assert server.rooms['b'].usernames() == ['bob']
+    server.remove_user_from_room(bob, 'b')
+    assert server.rooms['b'].usernames() == [] and bob.rooms == set()
+
+
+def test_slow_consumer_backpressure():
+    server = Server(high_watermark=64 * 1024, low_watermark=16 * 1024, queue_cap=256 * 1024,
+                    slow_consumer_policy=SLOW_CONSUMER_DROP)
+    reader, reader_sock = make_user(server, 'reader')
+    packet = IrcPacketTellMsg(payload='x' * 4000, target_label='room', sending_user='w').to_bytes()
+    # nobody reads reader_sock, so the kernel buffer fills and packets queue up
+    while server.queue_packet(reader, packet):
+        pass
+    assert reader.reading_paused
+    assert reader.events == selectors.EVENT_WRITE
+    assert reader.outbound_bytes + len(packet) > server.queue_cap
+    assert 'reader' in server.users  # drop policy keeps the connection
+    # draining the client side lets the queue flush and reading resume
+    reader_sock.setblocking(False)
+    while reader.outbound:
+        try:
+            while reader_sock.recv(1 << 20):
+                pass
+        except BlockingIOError:
+            pass
+        server.flush_outbound(reader)
+    assert not reader.reading_paused and reader.events == selectors.EVENT_READ
+
+
+def test_slow_consumer_disconnect():
+    server = Server(queue_cap=64 * 1024, slow_consumer_policy=SLOW_CONSUMER_DISCONNECT)
+    reader, reader_sock = make_user(server, 'reader')
+    packet = IrcPacketTellMsg(payload='x' * 4000, target_label='room', sending_user='w').to_bytes()
+    while server.queue_packet(reader, packet):
+        pass
+    assert 'reader' not in server.users and reader.sock.fileno() == -1
+    *frames, err = read_frames(server, reader_sock)  # queued packets are dropped
+    assert frames == [] and IrcPacketErr().from_bytes(err).payload == IRC_ERR_UNKNOWN
+
+
+def test_slow_consumer_disconnect_mid_packet():
+    server = Server(queue_cap=1 << 30, slow_consumer_policy=SLOW_CONSUMER_DISCONNECT)
+    reader, _ = make_user(server, 'reader')
+    listener = create_server(('127.0.0.1', 0))
+    reader_sock = create_connection(listener.getsockname(), timeout=1)
+    # tcp, unlike a socketpair, takes part of a buffer when nearly full
+    server.sel.unregister(reader.sock)
+    del server.connections[reader.sock]
+    reader.sock = listener.accept()[0]
+    reader.sock.setblocking(False)
+    server.connections[reader.sock] = reader
+    server.sel.register(reader.sock, selectors.EVENT_READ, data=reader)
+    packet = IrcPacketTellMsg(payload='x' * 4000, target_label='room', sending_user='w').to_bytes()
+    while not reader.frame_sent:  # until the socket stops partway through a packet
+        server.queue_packet(reader, packet)
+        server.flush_outbound(reader)
+    decoder = FrameDecoder(max_length=None)
+    decoder.recv_from(reader_sock)  # leaves the socket room for an error packet
+    sleep(0.1)
+    server.queue_cap = reader.outbound_bytes
+    assert not server.queue_packet(reader, packet)
+    while decoder.recv_from(reader_sock):
+        pass
+    # the stream ends inside that packet instead of with an error spliced into it
+    frames = [bytes(frame) for frame in decoder]
+    assert set(frames) == {packet} and 0 < decoder.pending() < len(packet)
+    assert len(frames) * len(packet) + decoder.pending() == server.metrics.bytes_sent.value
+    listener.close()
+
+
+def test_pending_handshakes():
+    server = Server(max_pending=2, handshake_timeout=0.5)
+    listener = create_server(('127.0.0.1', 0))
+    listener.setblocking(False)
+    address = listener.getsockname()
+    silent, greeter, refused = [create_connection(address, timeout=1) for _ in range(3)]
+    hello_bytes = IrcPacketHello('greeter').to_bytes()
+    greeter.sendall(hello_bytes[:10])  # hello arrives in two pieces
+    sleep(0.1)
+    server.accept_new_users(listener)  # one readiness event drains the backlog
+    assert len(server.pending) == 2
+    err = IrcPacketErr().from_bytes(refused.recv(IrcPacketErr.packet_length))
+    assert err.payload == IRC_ERR_TOO_MANY_USERS
+    silent_user, greeter_user = list(server.pending.values())
+    server.receive_hello(greeter_user)
+    assert 'greeter' not in server.users  # still waiting on the rest
+    greeter.sendall(hello_bytes[10:] + IrcPacketJoinRoom('room').to_bytes())
+    sleep(0.1)
+    server.receive_hello(greeter_user)
+    assert server.users['greeter'] is greeter_user
+    assert server.rooms['room'].usernames() == ['greeter']  # packet behind hello handled
+    server.expire_pending(monotonic() + 1)
+    assert not server.pending and silent_user.sock.fileno() == -1
+    for sock in [silent, greeter, refused, listener]:
+        sock.close()
+
+
+def test_keepalive_scheduler():
+    clock = [100.0]
+    scheduler = KeepaliveScheduler(interval=4, max_missed=3, clock=lambda: clock[0])
+    for conn in ['quiet', 'chatty', 'gone']:
+        scheduler.add(conn)
+    scheduler.remove('gone')
+    clock[0] = 103.0
+    scheduler.sent('chatty')
+    clock[0] = 104.0
+    assert scheduler.due() == (['quiet'], [])  # chatty got traffic 1s ago
+    assert scheduler.next_deadline() == 107.0
+    for now in [107.0, 108.0, 111.0]:
+        clock[0] = now
+        scheduler.received('chatty')
+        scheduler.due()
+    clock[0] = 112.0
+    idle, dead = scheduler.due()
+    assert dead == ['quiet'] and len(scheduler) == 1  # 12s without hearing back
+
+
+def test_silent_user_is_dropped():
+    server = Server(max_missed_keepalives=1)
+    clock = [0.0]
+    server.keepalives.clock = lambda: clock[0]
+    user, client_sock = make_user(server, 'silent')
+    server.keepalives.add(user)
+    clock[0] = KEEPALIVE_INTERVAL
+    server.send_keepalives()
+    assert 'silent' not in server.users
+    assert IrcPacketErr().from_bytes(client_sock.recv(64)).payload == IRC_ERR_UNKNOWN
+
+
+def test_list_frames_are_cached_until_changed():
+    server = Server()
+    alice, alice_sock = make_user(server, 'alice')
+    bob, bob_sock = make_user(server, 'bob')
+    server.add_user_to_room(alice, IrcPacketJoinRoom('room'))
+    frame = server.user_list_frame('room')
+    assert server.user_list_frame('room') is frame  # served from the cache
+    server.add_user_to_room(bob, IrcPacketJoinRoom('room'))
+    frame = server.user_list_frame('room')
+    assert IrcPacketListUsersResp().from_bytes(frame).payload == ['alice', 'bob']
+    server.remove_user_from_room(alice, 'room')
+    assert IrcPacketListUsersResp().from_bytes(server.user_list_frame('room')).payload == ['bob']
+    assert IrcPacketListUsersResp().from_bytes(server.user_list_frame('nowhere')).payload == []
+    assert 'nowhere' not in server.user_list_frames  # unknown rooms aren't cached
+    server.send_room_list(alice)
+    rooms_frame = server.room_list_frame
+    server.send_room_list(bob)
+    assert server.room_list_frame is rooms_frame
+    server.add_user_to_room(bob, IrcPacketJoinRoom('other'))
+    server.send_room_list(bob)
+    assert IrcPacketListRoomsResp().from_bytes(server.room_list_frame).payload == ['room', 'other']
+
+
+def read_frames(server, sock):
+    ''' every complete packet the server has queued for sock so far '''
+    server.flush_dirty()
+    decoder = FrameDecoder(max_length=None)
+    sock.setblocking(False)
+    try:
+        while decoder.recv_from(sock):
+            pass
+    except BlockingIOError:
+        pass
+    sock.setblocking(True)
+    return [bytes(frame) for frame in decoder]
+
+
+def test_membership_deltas():
+    server = Server()
+    modern, modern_sock = make_user(server, 'modern')
+    legacy, legacy_sock = make_user(server, 'legacy')
+    server.handle_packet(modern, IrcPacketCaps(0xFFFFFFFF).to_bytes())
+    assert modern.caps == IRC_SUPPORTED_CAPS  # unknown bits are refused
+    for user in [modern, legacy]:
+        server.add_user_to_room(user, IrcPacketJoinRoom('room'))
+    server.flush_membership_changes()
+    read_frames(server, modern_sock), read_frames(server, legacy_sock)
+    # a burst of joins and leaves is announced once
+    joiners, joiner_socks = zip(*[make_user(server, f'joiner{i}') for i in range(3)])
+    for user in joiners:
+        server.add_user_to_room(user, IrcPacketJoinRoom('room'))
+    server.remove_user_from_room(joiners[0], 'room')
+    server.remove_user_from_room(legacy, 'room')
+    assert read_frames(server, modern_sock) == []  # nothing before the window closes
+    server.flush_membership_changes()
+    joined, left = read_frames(server, modern_sock)
+    assert IrcPacketUsersJoined().from_bytes(joined).payload == ['joiner1', 'joiner2']
+    assert IrcPacketUsersLeft().from_bytes(left).payload == ['joiner0', 'legacy']
+    # RFC clients get one full list per window instead of one per join
+    server.add_user_to_room(legacy, IrcPacketJoinRoom('room'))
+    server.add_user_to_room(joiners[0], IrcPacketJoinRoom('room'))
+    read_frames(server, legacy_sock)
+    server.flush_membership_changes()
+    (frame,) = read_frames(server, legacy_sock)
+    assert IrcPacketListUsersResp().from_bytes(frame).payload == \
+        ['modern', 'joiner1', 'joiner2', 'legacy', 'joiner0']
+
+
+def test_rfc_joiner_gets_one_list():
+    server = Server()
+    first, first_sock = make_user(server, 'first')
+    joiner, joiner_sock = make_user(server, 'joiner')
+    server.add_user_to_room(first, IrcPacketJoinRoom('room'))
+    server.add_user_to_room(joiner, IrcPacketJoinRoom('room'))
+    server.flush_membership_changes()
+    # the list sent on join is already current for the window's last joiner
+    (frame,) = read_frames(server, joiner_sock)
+    assert IrcPacketListUsersResp().from_bytes(frame).payload == ['first', 'joiner']
+    # an earlier joiner still hears about everyone who came after them
+    frames = read_frames(server, first_sock)
+    assert len(frames) == 2
+    assert IrcPacketListUsersResp().from_bytes(frames[-1]).payload == ['first', 'joiner']
+
+
+def test_scatter_gather_egress():
+    server = Server()
+    reader, reader_sock = make_user(server, 'reader')
+    parts = tellmsg_frame_parts(b'x' * 3000 + b'\0', label_to_bytes('w'), label_to_bytes('room'))
+    for _ in range(200):  # ~600 KB, more than the socket takes in one go
+        server.queue_packet(reader, parts)
+        server.queue_packet(reader, EMPTY_FRAMES[IRC_KEEPALIVE])
+    assert len(reader.outbound) == 200 * 5 and server.dirty
+    decoder = FrameDecoder(max_length=None)
+    frames = []
+    server.flush_dirty()
+    while len(frames) < 400:  # partial writes resume mid-buffer
+        decoder.recv_from(reader_sock)
+        frames += [bytes(frame) for frame in decoder]
+        server.flush_outbound(reader)
+    assert frames == [b''.join(parts), EMPTY_FRAMES[IRC_KEEPALIVE]] * 200
+    assert reader.outbound_bytes == 0 and not reader.outbound
+
+
+def test_room_history():
+    room = Room('room', history_count=3, history_budget=100)
+    for i in range(5):
+        room.remember(bytes([i]) * 30, now=i)
+    assert list(room.history) == [bytes([i]) * 30 for i in [2, 3, 4]]
+    room.remember(b'x' * 60, now=5)  # over the byte budget, oldest two go
+    assert list(room.history) == [bytes([4]) * 30, b'x' * 60] and room.history_bytes == 90
+    server = Server(history_count=2, history_idle=60)
+    talker, talker_sock = make_user(server, 'talker')
+    server.add_user_to_room(talker, IrcPacketJoinRoom('room'))
+    for text in ['one', 'two', 'three']:
+        sendbytes = IrcPacketSendMsg(payload=text, target_label='room').to_bytes()
+        server.send_msg(talker, *split_sendmsg_frame(sendbytes))
+    late, late_sock = make_user(server, 'late')
+    server.add_user_to_room(late, IrcPacketJoinRoom('room'))
+    listing, *replayed = read_frames(server, late_sock)
+    assert IrcPacketListUsersResp().from_bytes(listing).payload == ['talker', 'late']
+    assert [IrcPacketTellMsg().from_bytes(f).payload for f in replayed] == ['two', 'three']
+    server.expire_history(monotonic() + 61)
+    assert not server.rooms['room'].history and not server.history_rooms
+
+
+def test_no_room_history():
+    server = Server(history_count=0)
+    talker, talker_sock = make_user(server, 'talker')
+    server.add_user_to_room(talker, IrcPacketJoinRoom('room'))
+    assert server.deliver_to_room('room', IrcPacketTellMsg(payload='hi', target_label='room', sending_user='talker').to_bytes())
+    assert not server.history_rooms
+    server.expire_history(monotonic() + ROOM_HISTORY_IDLE + 1)
+    assert not server.rooms['room'].history
+
+
+def test_list_pages():
+    server = Server()
+    reader, reader_sock = make_user(server, 'reader')
+    for name in ['b', 'a2', 'c', 'a1', 'a3']:
+        server.add_user_to_room(reader, IrcPacketJoinRoom(name))
+    read_frames(server, reader_sock)
+    pages, cursor, more = [], '', True
+    while more:
+        server.send_room_page(reader, IrcPacketListRoomsPage(limit=2, cursor=cursor))
+        (frame,) = read_frames(server, reader_sock)
+        page = IrcPacketListRoomsPageResp().from_bytes(frame)
+        pages.append(page.payload)
+        cursor, more = page.payload[-1], page.more
+    assert pages == [['a1', 'a2'], ['a3', 'b'], ['c']]
+    server.send_room_page(reader, IrcPacketListRoomsPage(cursor='a1', prefix='a'))
+    assert IrcPacketListRoomsPageResp().from_bytes(read_frames(server, reader_sock)[0]).payload == ['a2', 'a3']
+    server.add_user_to_room(reader, IrcPacketJoinRoom('a0'))  # the sorted cache is refreshed
+    server.send_room_page(reader, IrcPacketListRoomsPage(limit=1, prefix='a'))
+    page = IrcPacketListRoomsPageResp().from_bytes(read_frames(server, reader_sock)[-1])
+    assert page.payload == ['a0'] and page.more
+    other, other_sock = make_user(server, 'another')
+    server.add_user_to_room(other, IrcPacketJoinRoom('b'))
+    server.send_user_page(reader, IrcPacketListUsersPage('b', prefix='an'))
+    page = IrcPacketListUsersPageResp().from_bytes(read_frames(server, reader_sock)[-1])
+    assert (page.payload, page.identifier, page.more) == (['another'], 'b', False)
+    assert list_page([str(i) for i in range(5000)], 0, '', '')[1]  # capped at LIST_PAGE_MAX
@@ -0,0 +1,57 @@
+''' tests relay tracing: sampled messages are followed to every recipient's
+'   flush and written as loadable trace events
+'''
+
+import json
+
+from conf import *
+from server import Server
+from test_server import make_user
+from tracing import Tracer
+
+
+def load_events(path):
+    with open(path) as trace_file:
+        text = trace_file.read()
+    return json.loads(text.rstrip().rstrip(',') + ']')  # the viewer tolerates the open array
+
+
+def test_relay_trace(tmp_path):
+    path = str(tmp_path / 'relay.json')
+    server = Server(tracer=Tracer(path, sample_every=2))
+    users = [make_user(server, name) for name in ['alice', 'bob', 'carol']]
+    for user, sock in users:
+        server.add_user_to_room(user, IrcPacketJoinRoom('room'))
+    alice, alice_sock = users[0]
+    alice_sock.sendall(IrcPacketSendMsg('one', 'room').to_bytes()
+                       + IrcPacketSendMsg('two', 'room').to_bytes())
+    server.receive_from_client(alice)
+    assert server.tracer.waiting  # traced, but nothing has been flushed yet
+    server.flush_dirty()
+    assert not server.tracer.waiting
+    server.close_and_clean()
+    events = load_events(path)
+    assert [event['name'] for event in events] == [
+        'thread_name', 'relay', 'recv', 'buffered', 'decode', 'encode', 'enqueue', 'delivery']
+    relay, delivery = events[1], events[-1]
+    assert relay['args']['recipients'] == 3 and relay['args']['sender'] == 'alice'
+    assert [name for name, _, _ in delivery['args']['recipients']] == ['alice', 'bob', 'carol']
+    assert all(flushed >= enqueued for _, enqueued, flushed in delivery['args']['recipients'])
+    assert len(delivery['args']['slowest']) == 3 and delivery['args']['lost'] == 0
+
+
+def test_lost_recipient(tmp_path):
+    path = str(tmp_path / 'relay.json')
+    server = Server(tracer=Tracer(path, sample_every=1))
+    alice, alice_sock = make_user(server, 'alice')
+    bob, bob_sock = make_user(server, 'bob')
+    for user in [alice, bob]:
+        server.add_user_to_room(user, IrcPacketJoinRoom('room'))
+    alice_sock.sendall(IrcPacketSendMsg('hi', 'room').to_bytes())
+    server.receive_from_client(alice)
+    server.close_and_clean(bob.sock)  # gone before its queue was written
+    server.flush_dirty()
+    server.tracer.close()
+    delivery = load_events(path)[-1]
+    assert delivery['args']['lost'] == 1
+    assert delivery['args']['recipients'][1][0] == 'bob' and delivery['args']['recipients'][1][2] is None
@@ -0,0 +1,164 @@
+''' tracing.py
+'   sampled tracing of the room relay path of server.py
+'   one SENDMSG in every sample_every is followed from the recv that read it,
+'   through decoding and validation, TELLMSG encoding and the enqueue for
+'   every member, until every member's socket has taken the frame (or the
+'   member is gone); the queue position of each recipient is remembered as
+'   a byte count, so its flush time is when sendmsg has written that far
+'   finished traces are written as Chrome trace events (the JSON array
+'   format, one event per line, which chrome://tracing and Perfetto load
+'   as is): a "relay" span with its phases on the event loop's track and a
+'   "delivery" span from enqueue to the last flush on a track of its own,
+'   whose args hold every recipient's enqueue and flush offsets and name
+'   the slowest ones
+'   usage (server): python server.py --trace-file relay.json --trace-sample 100
+'''
+
+import json
+import os
+from time import perf_counter
+
+from conf import *
+from irclog import get_logger
+
+log = get_logger('tracing')
+
+LOOP_TID = 0  # track of the event loop's phases
+
+
+def microseconds(seconds):
+    return round(seconds * 1e6, 1)
+
+
+class Trace:
+    ''' one sampled message on its way through the server
+    '   marks: (phase name, time it ended), starting with the recv that read
+    '   the packet and the wait behind the packets read with it
+    '   recipients: [User, enqueued at, flushed at or None]
+    '''
+
+    def __init__(self, tracer, trace_id, sender, recv_started, recv_done):
+        self.tracer = tracer
+        self.id = trace_id
+        self.sender = sender
+        self.room = None
+        self.length = 0
+        self.marks = [('recv', recv_started), ('recv', recv_done), ('buffered', perf_counter())]
+        self.recipients = []
+        self.pending = 0  # recipients whose flush hasn't been seen yet
+        self.enqueue_done = False
+
+    def phase(self, name):
+        ''' ends the phase called name now; it began where the last one ended '''
+        self.marks.append((name, perf_counter()))
+
+    def enqueued(self, user):
+        ''' notes that the frame now sits at the end of user's queue '''
+        entry = [user, perf_counter(), None]
+        self.recipients.append(entry)
+        self.pending += 1
+        self.tracer.waiting.setdefault(user, []).append([self, entry, user.outbound_bytes])
+
+    def done(self):
+        ''' called once nothing more is enqueued; the trace is written as soon
+        '   as the last recipient's flush is seen
+        '''
+        self.enqueue_done = True
+        if self.pending == 0:
+            self.tracer.write(self)
+
+
+class Tracer:
+    ''' samples traces and writes them to path
+    '   waiting: User -> [[Trace, recipient entry, bytes until flushed]]
+    '''
+
+    def __init__(self, path, sample_every=TRACE_SAMPLE_EVERY, slowest=TRACE_SLOWEST):
+        self.path = path
+        self.sample_every = sample_every
+        self.slowest = slowest
+        self.seen = 0
+        self.traces = 0
+        self.waiting = {}
+        self.pid = os.getpid()
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+        self.emit({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': LOOP_TID,
+                   'args': {'name': 'event loop'}})
+
+    def sample(self, sender, recv_started, recv_done):
+        ''' a new Trace for one in every sample_every calls, otherwise None '''
+        self.seen += 1
+        if self.seen < self.sample_every:
+            return None
+        self.seen = 0
+        self.traces += 1
+        return Trace(self, self.traces, sender, recv_started, recv_done)
+
+    def sent(self, user, sent):
+        ''' counts sent bytes off user's waiting traces, completing those
+        '   whose frame has now been written
+        '''
+        now = perf_counter()
+        waits = self.waiting[user]
+        for wait in list(waits):
+            wait[2] -= sent
+            if wait[2] <= 0:
+                waits.remove(wait)
+                self.complete(wait, now)
+        if not waits:
+            del self.waiting[user]
+
+    def forget(self, user):
+        ''' completes user's waiting traces without a flush time '''
+        for wait in self.waiting.pop(user, ()):
+            self.complete(wait, None)
+
+    def complete(self, wait, flushed_at):
+        trace, entry, _ = wait
+        entry[2] = flushed_at
+        trace.pending -= 1
+        if trace.pending == 0 and trace.enqueue_done:
+            self.write(trace)
+
+    def emit(self, event):
+        self.file.write(json.dumps(event, separators=(',', ':')) + ',\n')
+
+    def write(self, trace):
+        ''' writes a finished trace as trace events '''
+        marks = trace.marks
+        started = marks[0][1]
+        common = {'pid': self.pid, 'ph': 'X'}
+        self.emit({**common, 'name': 'relay', 'tid': LOOP_TID, 'ts': microseconds(started),
+                   'dur': microseconds(marks[-1][1] - started),
+                   'args': {'trace': trace.id, 'sender': trace.sender, 'room': trace.room,
+                            'bytes': trace.length, 'recipients': len(trace.recipients)}})
+        for (_, began), (name, ended) in zip(marks, marks[1:]):
+            self.emit({**common, 'name': name, 'tid': LOOP_TID, 'ts': microseconds(began),
+                       'dur': microseconds(ended - began)})
+        if not trace.recipients:
+            self.file.flush()
+            return
+        enqueue_started = marks[-2][1]
+        flushed = [entry for entry in trace.recipients if entry[2] is not None]
+        finished = max([entry[2] for entry in flushed] + [marks[-1][1]])
+        slowest = sorted(flushed, key=lambda entry: entry[2] - entry[1], reverse=True)[:self.slowest]
+        slowest_names = [(str(user.username), microseconds(flushed_at - enqueued))
+                         for user, enqueued, flushed_at in slowest]
+        self.emit({**common, 'name': 'delivery', 'tid': trace.id, 'ts': microseconds(enqueue_started),
+                   'dur': microseconds(finished - enqueue_started),
+                   'args': {'trace': trace.id, 'room': trace.room,
+                            'lost': len(trace.recipients) - len(flushed),
+                            'slowest': slowest_names,
+                            # [name, enqueued, flushed] in microseconds after the enqueue began
+                            'recipients': [
+                                [str(user.username), microseconds(enqueued - enqueue_started),
+                                 None if flushed_at is None
+                                 else microseconds(flushed_at - enqueue_started)]
+                                for user, enqueued, flushed_at in trace.recipients]}})
+        self.file.flush()
+        log.info('trace %d: %d recipients in %s, slowest %s', trace.id, len(trace.recipients),
+                 trace.room, slowest_names)
+
+    def close(self):
+        self.file.close()